@@ -0,0 +1,376 @@
+"""机器人热点路径的离线性能基准测试
+
+不访问 YouTube 和 Telegram：视频信息来自 fixtures 中录制的 info_dict，
+需要提取信息时用 FixtureYoutubeDL 代替 yt_dlp.YoutubeDL；数据库和下载目录都在临时目录中创建。
+
+用法:
+    python benchmarks/bench.py                          运行全部测试并打印结果
+    python benchmarks/bench.py --output before.json     同时保存结果（记录当前提交）
+    python benchmarks/bench.py --compare before.json    运行后与保存的结果对比
+    python benchmarks/bench.py --compare a.json b.json  只对比两份已保存的结果
+    python benchmarks/bench.py --filter library --scales 10000
+
+对比时单次耗时的中位数变慢超过 --threshold（默认10%）视为性能回退，退出码为1。
+"""
+import argparse
+import asyncio
+import copy
+import importlib.machinery
+import importlib.util
+import json
+import logging
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FIXTURE_PATH = os.path.join(ROOT, 'benchmarks', 'fixtures', 'youtube_info.json')
+
+def load_bot(workdir):
+    """使用 config.py.example 和临时目录导入 bot 模块，不读取本机的 config.py"""
+    os.environ.update({
+        'BOT_TOKEN': '0:benchmark',
+        'ADMIN_USER_ID': '1',
+        'DOWNLOAD_PATH': os.path.join(workdir, 'downloads'),
+        'PROXY_LIST': '',
+        'METRICS_PORT': '0',
+    })
+    os.environ.pop('INFO_CACHE_DIR', None)
+    os.makedirs(os.environ['DOWNLOAD_PATH'], exist_ok=True)
+
+    # 文件名不是 .py 结尾，需要显式指定加载器
+    loader = importlib.machinery.SourceFileLoader('config', os.path.join(ROOT, 'config.py.example'))
+    spec = importlib.util.spec_from_loader('config', loader)
+    config = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(config)
+    sys.modules['config'] = config
+    sys.path.insert(0, ROOT)
+    import bot
+
+    # 日志照常生成，但不输出到终端
+    logging.getLogger().handlers = [logging.NullHandler()]
+    return bot
+
+class FixtureYoutubeDL:
+    """代替 yt_dlp.YoutubeDL，extract_info 直接返回录制的 info_dict"""
+    info = None
+
+    def __init__(self, params=None):
+        self.params = params or {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def extract_info(self, url, download=False, **kwargs):
+        return copy.deepcopy(self.info)
+
+    def sanitize_info(self, info, remove_private_keys=False):
+        return info
+
+def large_info(info, copies):
+    """把录制的格式列表复制多份，模拟格式非常多的视频"""
+    info = copy.deepcopy(info)
+    formats = []
+    for i in range(copies):
+        for fmt in info['formats']:
+            fmt = dict(fmt, format_id=f"{fmt['format_id']}-{i}")
+            if fmt.get('tbr'):
+                fmt['tbr'] = fmt['tbr'] * (1 + i / 1000)
+            formats.append(fmt)
+    info['formats'] = formats
+    return info
+
+def measure(func, number, repeat=5):
+    """运行 repeat 轮、每轮 number 次，返回单次耗时(秒)的最小值和中位数"""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            func()
+        times.append((time.perf_counter() - start) / number)
+    return {'number': number, 'repeat': repeat, 'min': min(times), 'median': statistics.median(times)}
+
+def bench_list_formats(bot, fixture, loop):
+    url = f"https://www.youtube.com/watch?v={fixture['id']}"
+    results = {}
+    for name, info in (('fixture', fixture), ('large', large_info(fixture, 60))):
+        bot.info_cache.put(fixture['id'], info)
+        results[f"list_formats[{name}-{len(info['formats'])}]"] = measure(
+            lambda: loop.run_until_complete(bot.list_formats(url)), 200 if name == 'fixture' else 5)
+
+    # 缓存未命中：经过 get_video_info/extract_video_info，由 FixtureYoutubeDL 返回信息
+    FixtureYoutubeDL.info = fixture
+    original = bot.yt_dlp.YoutubeDL
+    bot.yt_dlp.YoutubeDL = FixtureYoutubeDL
+    try:
+        def extract():
+            bot.info_cache.invalidate(fixture['id'])
+            loop.run_until_complete(bot.list_formats(url))
+        results['list_formats[extract]'] = measure(extract, 100)
+    finally:
+        bot.yt_dlp.YoutubeDL = original
+        bot.info_cache.invalidate(fixture['id'])
+    return results
+
+def bench_progress_hook(bot, fixture, loop):
+    video = next(f for f in fixture['formats'] if f['format_id'] == '137')
+    total = video['filesize']
+    events = [{
+        'status': 'downloading',
+        'filename': '/downloads/Benchmark Fixture Video/Benchmark Fixture Video_1080p.f137.mp4',
+        'tmpfilename': '/downloads/Benchmark Fixture Video/Benchmark Fixture Video_1080p.f137.mp4.part',
+        'downloaded_bytes': total * i // 1000,
+        'total_bytes': total,
+        'speed': 12.5 * 1024 * 1024,
+        'eta': 1000 - i,
+        'info_dict': video,
+    } for i in range(1000)]
+    progress = bot.DownloadProgress(bot.SilentMessage())
+    progress.current_title = fixture['title']
+    state = {'i': 0}
+
+    def call():
+        progress.progress_hook(events[state['i'] % len(events)])
+        state['i'] += 1
+    return {'progress_hook': measure(call, 20000)}
+
+def bench_translate_message(bot, fixture, loop):
+    chinese_logger = bot.ChineseLogger(bot.logger)
+    messages = [
+        '[youtube] Extracting URL: https://www.youtube.com/watch?v=dQw4w9WgXcQ',
+        '[youtube] dQw4w9WgXcQ: Downloading webpage',
+        '[info] dQw4w9WgXcQ: Downloading 1 format(s): 137+140',
+        '[download] Destination: /downloads/Benchmark Fixture Video_1080p.f137.mp4',
+        '[download]  45.3% of  66.25MiB at   12.50MiB/s ETA 00:03',
+        '[Merger] Merging formats into "/downloads/Benchmark Fixture Video_1080p.mp4"',
+        'Deleting original file /downloads/Benchmark Fixture Video_1080p.f140.m4a (pass -k to keep)',
+        'Some unrelated message that matches nothing at all',
+    ]
+    state = {'i': 0}
+
+    def call():
+        chinese_logger._translate_message(messages[state['i'] % len(messages)])
+        state['i'] += 1
+    return {'translate_message': measure(call, 50000)}
+
+def bench_is_valid_url(bot, fixture, loop):
+    urls = [
+        'https://www.youtube.com/watch?v=dQw4w9WgXcQ',
+        'https://youtu.be/dQw4w9WgXcQ?si=abcdef',
+        'https://www.youtube.com/shorts/dQw4w9WgXcQ',
+        'https://www.youtube.com/playlist?list=PL0123456789abcdef',
+        'https://www.youtube.com/@FixtureChannel',
+        'https://example.com/watch?v=dQw4w9WgXcQ',
+        'not a url at all',
+    ]
+    state = {'i': 0}
+
+    def call():
+        bot.is_valid_url(urls[state['i'] % len(urls)])
+        state['i'] += 1
+    return {'is_valid_url': measure(call, 100000)}
+
+def bench_queue(bot, fixture, loop, workdir, count=1000):
+    """入队和按优先级领取任务，每轮使用新的数据库"""
+    url = f"https://www.youtube.com/watch?v={fixture['id']}"
+    enqueue_times, claim_times = [], []
+    for i in range(5):
+        store = bot.JobStore(os.path.join(workdir, f'queue-{i}.db'))
+        start = time.perf_counter()
+        for n in range(count):
+            store.enqueue(url, '137', title=fixture['title'], chat_id=1, message_id=n,
+                          priority=bot.JobStore.PRIORITY_BULK if n % 3 else bot.JobStore.PRIORITY_INTERACTIVE)
+        store.flush()
+        enqueue_times.append((time.perf_counter() - start) / count)
+        start = time.perf_counter()
+        while store.claim_next() is not None:
+            pass
+        store.flush()
+        claim_times.append((time.perf_counter() - start) / count)
+    return {
+        'queue_enqueue': {'number': count, 'repeat': 5, 'min': min(enqueue_times), 'median': statistics.median(enqueue_times)},
+        'queue_claim': {'number': count, 'repeat': 5, 'min': min(claim_times), 'median': statistics.median(claim_times)},
+    }
+
+def build_library(root, files):
+    """生成与机器人下载结果相同结构的目录：每个视频一个文件夹，包含视频、NFO和封面"""
+    resolutions = ['2160p', '1440p', '1080p', '720p', '480p']
+    for i in range(files // 3):
+        title = f"Fixture Video {i:06d}"
+        folder = os.path.join(root, title)
+        os.makedirs(folder)
+        with open(os.path.join(folder, f"{title}.nfo"), 'w', encoding='utf-8') as f:
+            f.write(
+                f'<?xml version="1.0" encoding="UTF-8" standalone="yes" ?>\n<movie>\n'
+                f'    <title>{title}</title>\n    <director>Channel {i % 50}</director>\n'
+                f'    <uniqueid type="YouTube" default="true">{i:011d}</uniqueid>\n</movie>'
+            )
+        with open(os.path.join(folder, f"{title} - {resolutions[i % len(resolutions)]}.mp4"), 'wb') as f:
+            f.write(b'\0' * (i % 4096))
+        open(os.path.join(folder, 'poster.jpg'), 'wb').close()
+
+def bench_library(bot, fixture, loop, workdir, scales):
+    results = {}
+    for files in scales:
+        root = os.path.join(workdir, f'library-{files}')
+        build_library(root, files)
+        index = bot.LibraryIndex(os.path.join(workdir, f'library-{files}.db'))
+
+        start = time.perf_counter()
+        index.reconcile(root)
+        cold = time.perf_counter() - start
+        results[f'library_reconcile_cold[{files}]'] = {'number': 1, 'repeat': 1, 'min': cold, 'median': cold}
+        results[f'library_reconcile_warm[{files}]'] = measure(lambda: index.reconcile(root), 1, repeat=3)
+
+        # /status 只查询索引，不再遍历目录
+        original_index = bot.library_index
+        bot.library_index = index
+        update = FakeUpdate()
+        try:
+            results[f'status_command[{files}]'] = measure(
+                lambda: loop.run_until_complete(bot.status_command(update, None)), 20)
+        finally:
+            bot.library_index = original_index
+        shutil.rmtree(root)
+    return results
+
+class FakeMessage:
+    async def reply_text(self, text, **kwargs):
+        self.text = text
+
+class FakeUser:
+    id = 1
+
+class FakeUpdate:
+    """status_command 只用到 effective_user.id 和 message.reply_text"""
+    def __init__(self):
+        self.effective_user = FakeUser()
+        self.message = FakeMessage()
+
+BENCHMARKS = [
+    ('list_formats', bench_list_formats),
+    ('progress_hook', bench_progress_hook),
+    ('translate_message', bench_translate_message),
+    ('is_valid_url', bench_is_valid_url),
+    ('queue', bench_queue),
+    ('library', bench_library),
+]
+
+def git_commit():
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, text=True).strip()
+        dirty = subprocess.check_output(['git', 'status', '--porcelain', '--untracked-files=no'],
+                                        cwd=ROOT, text=True).strip()
+        return commit + ('-dirty' if dirty else '')
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run(args):
+    workdir = tempfile.mkdtemp(prefix='ytbot-bench-')
+    try:
+        bot = load_bot(workdir)
+        with open(FIXTURE_PATH, 'r', encoding='utf-8') as f:
+            fixture = json.load(f)
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+
+        results = {}
+        for name, func in BENCHMARKS:
+            if args.filter and args.filter not in name:
+                continue
+            print(f"运行 {name} ...", file=sys.stderr)
+            if name == 'queue':
+                results.update(func(bot, fixture, loop, workdir))
+            elif name == 'library':
+                results.update(func(bot, fixture, loop, workdir, args.scales))
+            else:
+                results.update(func(bot, fixture, loop))
+        loop.close()
+
+        return {
+            'commit': git_commit(),
+            'created_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'yt_dlp': bot.yt_dlp.version.__version__,
+            'results': results,
+        }
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+def format_time(seconds):
+    for unit, scale in (('s', 1), ('ms', 1e-3), ('µs', 1e-6)):
+        if seconds >= scale:
+            return f"{seconds / scale:.2f}{unit}"
+    return f"{seconds / 1e-9:.0f}ns"
+
+def print_results(report):
+    print(f"提交: {report['commit']}  Python {report['python']}  yt-dlp {report['yt_dlp']}")
+    width = max(len(name) for name in report['results'])
+    for name, result in report['results'].items():
+        print(f"{name:<{width}}  中位数 {format_time(result['median']):>10}  最小 {format_time(result['min']):>10}"
+              f"  ({result['repeat']} 轮 × {result['number']} 次)")
+
+def compare(base, current, threshold):
+    """打印两份结果的对比，返回是否存在性能回退"""
+    print(f"对比: {base['commit']} -> {current['commit']}")
+    names = [name for name in current['results'] if name in base['results']]
+    if not names:
+        print("两份结果没有相同的测试项")
+        return False
+    width = max(len(name) for name in names)
+    regressed = False
+    for name in names:
+        before = base['results'][name]['median']
+        after = current['results'][name]['median']
+        change = (after - before) / before if before else 0
+        flag = ''
+        if change > threshold:
+            flag = '  ⚠️ 变慢'
+            regressed = True
+        elif change < -threshold:
+            flag = '  ✅ 变快'
+        print(f"{name:<{width}}  {format_time(before):>10} -> {format_time(after):>10}  {change:+.1%}{flag}")
+    return regressed
+
+def main():
+    parser = argparse.ArgumentParser(description="机器人热点路径的离线性能基准测试")
+    parser.add_argument('--output', help="保存结果的JSON文件")
+    parser.add_argument('--compare', nargs='+', metavar='RESULT', help="与保存的结果对比（给出两个文件时不运行测试）")
+    parser.add_argument('--threshold', type=float, default=0.1, help="判断为性能回退的变慢比例，默认0.1")
+    parser.add_argument('--filter', help="只运行名称中包含该文字的测试组")
+    parser.add_argument('--scales', default='10000,100000',
+                        type=lambda value: [int(n) for n in value.split(',') if n],
+                        help="媒体库测试的文件数量，逗号分隔，默认 10000,100000")
+    args = parser.parse_args()
+
+    if args.compare and len(args.compare) > 2:
+        parser.error("--compare 最多接受两个结果文件")
+    if args.compare and len(args.compare) == 2:
+        with open(args.compare[0], 'r', encoding='utf-8') as f:
+            base = json.load(f)
+        with open(args.compare[1], 'r', encoding='utf-8') as f:
+            current = json.load(f)
+        sys.exit(1 if compare(base, current, args.threshold) else 0)
+
+    report = run(args)
+    print_results(report)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    if args.compare:
+        with open(args.compare[0], 'r', encoding='utf-8') as f:
+            base = json.load(f)
+        print()
+        sys.exit(1 if compare(base, report, args.threshold) else 0)
+
+if __name__ == '__main__':
+    main()
@@ -1,25 +1,55 @@
+import time
+PROCESS_START = time.monotonic()  # 在导入其他模块之前记录，用于统计启动耗时
 import os
 import logging
 from telegram import Update, BotCommand, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, filters, ContextTypes
+from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, TypeHandler, filters, ContextTypes
 import yt_dlp
+from yt_dlp.downloader import PROTOCOL_MAP
+from yt_dlp.downloader.dash import DashSegmentsFD
+from yt_dlp.postprocessor.common import PostProcessor
+from yt_dlp.postprocessor import FFmpegMergerPP, FFmpegMetadataPP
 from config import (BOT_TOKEN, DOWNLOAD_PATH, SUPPORTED_URLS, ADMIN_USER_ID, 
-                   HTTP_PROXY, HTTPS_PROXY, enable_quality_selection,
-                   download_queue, is_downloading)
-import time
+                   enable_quality_selection,
+                   STATE_DIR, JOB_DB_PATH,
+                   PROGRESS_EDIT_INTERVAL, PROGRESS_GLOBAL_RATE,
+                   LIBRARY_DB_PATH, LIBRARY_SCAN_INTERVAL, PLAYLIST_MAX_ENTRIES,
+                   INFO_CACHE_SIZE, INFO_CACHE_TTL, INFO_CACHE_DIR, FORMAT_MENU_SIZE, FORMAT_MENU_TTL,
+                   EXTRACT_CONCURRENCY, EXTRACT_TIMEOUT,
+                   DOWNLOAD_CONNECTIONS_TOTAL, DOWNLOAD_CONNECTIONS_PER_JOB, DOWNLOAD_SEGMENT_SIZE,
+                   AUTO_CONCURRENCY, CONCURRENCY_MIN, CONCURRENCY_MAX, CONCURRENCY_INTERVAL,
+                   BANDWIDTH_LIMIT, BANDWIDTH_SCHEDULE, BANDWIDTH_RESERVE,
+                   PROXY_LIST, EXTRACT_PROXY_LIST, PROXY_CHECK_INTERVAL, PROXY_CHECK_URL,
+                   POSTPROCESS_WORKERS, PROBE_CONCURRENCY, PROBE_TIMEOUT, PARTIAL_MAX_AGE,
+                   METRICS_HOST, METRICS_PORT,
+                   WEBHOOK_URL, WEBHOOK_LISTEN, WEBHOOK_PORT, WEBHOOK_SECRET, WEBHOOK_QUEUE_SIZE,
+                   ALLOWED_USERS, USER_MAX_CONCURRENT, USER_DAILY_QUOTA, USER_STORAGE_QUOTA, USER_WEIGHTS,
+                   REMOTE_WORKERS, WORKER_ID, WORKER_LEASE_TIMEOUT, WORKER_CONCURRENT_DOWNLOADS)
 import asyncio
 import json
-import subprocess
 import sys
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
 import threading
-import psutil  # 需要添加到 requirements.txt
+import httpx
 from telegram.request import HTTPXRequest
-from telegram.request import HTTPXRequest as ExtHTTPRequest
-from telegram.error import NetworkError, TimedOut
+from telegram.error import NetworkError, TimedOut, RetryAfter, BadRequest
 import backoff  # 需要添加到 requirements.txt
 import re
 import datetime
+import copy
+import functools
+import glob
+import heapq
+import sqlite3
+import atexit
+import hmac
+import secrets
+import signal
+import socket
+import weakref
+from urllib.parse import urlparse
+from collections import OrderedDict, Counter
 
 # 设置日志
 logging.basicConfig(
@@ -45,32 +75,298 @@ sys.stdout.reconfigure(encoding='utf-8')
 
 # 添加配置
 MAX_CONCURRENT_DOWNLOADS = 3  # 默认值
-concurrent_downloads = MAX_CONCURRENT_DOWNLOADS  # 当前值
-download_semaphore = threading.Semaphore(MAX_CONCURRENT_DOWNLOADS)
-thread_pool = ThreadPoolExecutor(max_workers=MAX_CONCURRENT_DOWNLOADS)
+# 线程数只是上限，实际同时下载的数量由下载调度器的槽位控制，调整时无需重建线程池
+thread_pool = ThreadPoolExecutor(max_workers=max(CONCURRENCY_MAX, 6), thread_name_prefix='download')
+telegram_bot = None  # 启动后保存Bot实例，用于编辑恢复任务的状态消息
+
+class Metrics:
+    """Prometheus 文本格式的运行指标（线程安全）
+    
+    计数器和直方图在各处直接记录；队列长度、槽位、代理状态等当前值在每次抓取时由 collect 回调计算。
+    """
+    SECONDS_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)
+    RATE_BUCKETS = tuple(mb * 1024 * 1024 for mb in (0.25, 0.5, 1, 2, 5, 10, 20, 50, 100))
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._meta = {}  # 指标名 -> (类型, 说明)
+        self._buckets = {}  # 直方图名 -> 桶上限
+        self._values = {}  # (指标名, 标签) -> 计数器的值 或 直方图的 [各桶计数, 总和, 次数]
+        self._collectors = {}  # 指标名 -> 返回 [(标签, 值)] 的回调
+
+    def counter(self, name, help_text):
+        self._meta[name] = ('counter', help_text)
+
+    def histogram(self, name, help_text, buckets=SECONDS_BUCKETS):
+        self._meta[name] = ('histogram', help_text)
+        self._buckets[name] = buckets
+
+    def gauge(self, name, help_text, collect):
+        self._meta[name] = ('gauge', help_text)
+        self._collectors[name] = collect
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        buckets = self._buckets[name]
+        with self._lock:
+            entry = self._values.setdefault(key, [[0] * len(buckets), 0.0, 0])
+            for i, bound in enumerate(buckets):
+                if value <= bound:
+                    entry[0][i] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    @staticmethod
+    def _labels(labels, extra=()):
+        items = [*labels, *extra]
+        if not items:
+            return ""
+        escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, v in items)
+        return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(items, escaped)) + "}"
+
+    def render(self):
+        """生成 Prometheus 文本格式的全部指标"""
+        with self._lock:
+            values = {key: copy.deepcopy(value) for key, value in self._values.items()}
+        lines = []
+        for name, (kind, help_text) in self._meta.items():
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            if kind == 'gauge':
+                try:
+                    samples = [(tuple(sorted(labels.items())), value) for labels, value in self._collectors[name]()]
+                except Exception as e:
+                    logger.warning(f"计算指标 {name} 失败: {str(e)}")
+                    samples = []
+            else:
+                samples = [(labels, value) for (metric, labels), value in values.items() if metric == name]
+            for labels, value in samples:
+                if kind != 'histogram':
+                    lines.append(f"{name}{self._labels(labels)} {value}")
+                    continue
+                counts, total, count = value
+                for bound, bucket_count in zip(self._buckets[name], counts):
+                    lines.append(f"{name}_bucket{self._labels(labels, [('le', bound)])} {bucket_count}")
+                lines.append(f"{name}_bucket{self._labels(labels, [('le', '+Inf')])} {count}")
+                lines.append(f"{name}_sum{self._labels(labels)} {total}")
+                lines.append(f"{name}_count{self._labels(labels)} {count}")
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics()
+metrics.histogram('ytbot_extraction_seconds', '提取视频信息的耗时')
+metrics.counter('ytbot_info_cache_requests_total', '视频信息缓存的命中与未命中次数')
+metrics.histogram('ytbot_queue_wait_seconds', '任务从入队到开始处理的等待时间')
+metrics.histogram('ytbot_download_seconds', '网络下载阶段的耗时')
+metrics.histogram('ytbot_download_throughput_bytes', '单个任务的平均下载速度(字节/秒)', Metrics.RATE_BUCKETS)
+metrics.counter('ytbot_download_bytes_total', '下载的字节数')
+metrics.histogram('ytbot_postprocess_seconds', '后期处理的耗时')
+metrics.counter('ytbot_download_retries_total', '下载重试次数，按错误类型统计')
+metrics.counter('ytbot_jobs_finished_total', '结束的任务数，按最终状态统计')
+metrics.histogram('ytbot_telegram_api_seconds', 'Telegram Bot API 请求的耗时')
+metrics.counter('ytbot_telegram_api_errors_total', 'Telegram Bot API 请求失败次数')
+metrics.counter('ytbot_webhook_updates_total', '收到的 webhook 请求，按处理结果统计')
+
+async def serve_metrics(host, port):
+    """在本地端口上提供 /metrics，供 Prometheus 抓取"""
+    async def handle(reader, writer):
+        try:
+            request_line = await asyncio.wait_for(reader.readline(), 10)
+            # 读完请求头，不关心其中的内容
+            while (await asyncio.wait_for(reader.readline(), 10)) not in (b'\r\n', b'\n', b''):
+                pass
+            parts = request_line.decode('latin-1').split()
+            if len(parts) >= 2 and parts[0] == 'GET' and parts[1].split('?')[0] == '/metrics':
+                status, body = '200 OK', metrics.render().encode('utf-8')
+            else:
+                status, body = '404 Not Found', b'not found\n'
+            writer.write(
+                f"HTTP/1.1 {status}\r\n"
+                f"Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                f"Content-Length: {len(body)}\r\n"
+                f"Connection: close\r\n\r\n".encode('latin-1') + body
+            )
+            await writer.drain()
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    server = await asyncio.start_server(handle, host, port)
+    logger.info(f"📈 指标接口已启动: http://{host}:{port}/metrics")
+    return server
+
+class TimedHTTPXRequest(HTTPXRequest):
+    """记录每次 Telegram Bot API 请求耗时的 HTTPXRequest"""
+    async def do_request(self, url, method, *args, **kwargs):
+        # 地址中包含机器人Token，只取最后的API方法名作为标签
+        api_method = url.rsplit('/', 1)[-1]
+        start_time = time.monotonic()
+        try:
+            return await super().do_request(url, method, *args, **kwargs)
+        except Exception as e:
+            metrics.inc('ytbot_telegram_api_errors_total', method=api_method, error=type(e).__name__)
+            raise
+        finally:
+            metrics.observe('ytbot_telegram_api_seconds', time.monotonic() - start_time, method=api_method)
+
+class WebhookServer:
+    """接收 Telegram webhook 推送的内置 HTTP 服务
+    
+    校验 X-Telegram-Bot-Api-Secret-Token 后把更新放入有界队列并立即返回200；
+    队列已满时返回503，Telegram 会稍后重新推送，积压的更新留在 Telegram 一侧而不是占用内存。
+    """
+    MAX_BODY = 1024 * 1024
+
+    def __init__(self, application, path, secret, queue_size):
+        self.application = application
+        self.path = path
+        self.secret = secret
+        self.queue = asyncio.Queue(maxsize=queue_size)
+        self.server = None
+        self.workers = []
+        metrics.gauge('ytbot_webhook_queue_depth', '已接收、等待处理的 webhook 更新数',
+                      lambda: [({}, self.queue.qsize())])
+
+    async def _read_request(self, reader):
+        """读取请求，返回 (方法, 路径, 请求头, 请求体)；请求体过大时请求体为 None"""
+        request_line = await asyncio.wait_for(reader.readline(), 10)
+        headers = {}
+        while True:
+            line = await asyncio.wait_for(reader.readline(), 10)
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+        parts = request_line.decode('latin-1').split()
+        method, path = (parts[0], parts[1].split('?')[0]) if len(parts) >= 2 else ('', '')
+        length = int(headers.get('content-length') or 0)
+        if length > self.MAX_BODY:
+            return method, path, headers, None
+        body = await asyncio.wait_for(reader.readexactly(length), 10) if length else b''
+        return method, path, headers, body
+
+    def _accept(self, method, path, headers, body):
+        """检查请求并放入队列，返回 HTTP 状态"""
+        if path != self.path:
+            return '404 Not Found'
+        if method != 'POST':
+            return '405 Method Not Allowed'
+        if not hmac.compare_digest(headers.get('x-telegram-bot-api-secret-token', ''), self.secret):
+            metrics.inc('ytbot_webhook_updates_total', result='unauthorized')
+            return '403 Forbidden'
+        if body is None:
+            return '413 Payload Too Large'
+        try:
+            data = json.loads(body)
+            # 合法的 JSON 也可能是数组、数字或 null，只接受对象
+            if not isinstance(data, dict):
+                raise ValueError(f"更新必须是 JSON 对象，实际为 {type(data).__name__}")
+            update = Update.de_json(data, self.application.bot)
+        except (ValueError, TypeError, KeyError) as e:
+            logger.warning(f"无法解析 webhook 更新: {str(e)}")
+            metrics.inc('ytbot_webhook_updates_total', result='invalid')
+            return '400 Bad Request'
+        try:
+            self.queue.put_nowait(update)
+        except asyncio.QueueFull:
+            metrics.inc('ytbot_webhook_updates_total', result='rejected')
+            return '503 Service Unavailable'
+        metrics.inc('ytbot_webhook_updates_total', result='accepted')
+        return '200 OK'
+
+    async def handle(self, reader, writer):
+        try:
+            status = self._accept(*await self._read_request(reader))
+            if status.startswith('503'):
+                logger.warning(f"待处理的更新已达上限 ({self.queue.maxsize})，请 Telegram 稍后重试")
+            writer.write(
+                f"HTTP/1.1 {status}\r\n"
+                f"Content-Length: 0\r\n"
+                f"Connection: close\r\n\r\n".encode('latin-1')
+            )
+            await writer.drain()
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def _process(self):
+        while True:
+            update = await self.queue.get()
+            try:
+                await self.application.process_update(update)
+            except Exception as e:
+                logger.error(f"处理更新失败: {str(e)}")
+            finally:
+                self.queue.task_done()
+
+    async def start(self, host, port):
+        # 与长轮询一致：未开启 concurrent_updates 时按顺序处理
+        for _ in range(max(1, self.application.concurrent_updates)):
+            self.workers.append(asyncio.create_task(self._process()))
+        self.server = await asyncio.start_server(self.handle, host, port)
+        logger.info(f"🪝 Webhook 服务已启动: http://{host}:{port}{self.path}")
+
+    async def stop(self, timeout=30):
+        """停止接收新的更新，处理完已接收的更新后退出"""
+        if self.server:
+            self.server.close()
+            await self.server.wait_closed()
+        try:
+            await asyncio.wait_for(self.queue.join(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"仍有 {self.queue.qsize()} 个更新未处理，Telegram 会在下次启动后重新推送")
+        for worker in self.workers:
+            worker.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+
+class ExtractionCancelled(yt_dlp.utils.DownloadCancelled):
+    """信息提取已被取消（超时或没有人再等待结果）"""
+    msg = '信息提取已取消'
 
 class ChineseLogger:
     """自定义中文日志处理器"""
-    def __init__(self, logger):
+    def __init__(self, logger, cancel_event=None):
         self.logger = logger
+        # yt-dlp 在每次网络请求前都会输出日志，借此实现协作式取消
+        self.cancel_event = cancel_event
+
+    def _check_cancelled(self):
+        if self.cancel_event is not None and self.cancel_event.is_set():
+            raise ExtractionCancelled()
 
     def debug(self, msg):
+        self._check_cancelled()
         # 翻译常见的英文日志消息
         msg = self._translate_message(msg)
         self.logger.debug(msg)
 
     def info(self, msg):
+        self._check_cancelled()
         msg = self._translate_message(msg)
         self.logger.info(msg)
 
     def warning(self, msg):
+        self._check_cancelled()
+        self._check_throttled(msg)
         msg = self._translate_message(msg)
         self.logger.warning(msg)
 
     def error(self, msg):
+        self._check_throttled(msg)
         msg = self._translate_message(msg)
         self.logger.error(msg)
 
+    def _check_throttled(self, msg):
+        # 429 限流会让自动并发减少同时下载的数量
+        if '429' in msg or 'Too Many Requests' in msg:
+            concurrency_controller.report_throttle()
+
     def _translate_message(self, msg):
         translations = {
             'Downloading webpage': '正在获取网页信息',
@@ -97,12 +393,48 @@ class ChineseLogger:
                 return msg.replace(eng, chn)
         return msg
 
+class TaskCancelled(yt_dlp.utils.DownloadCancelled):
+    """下载任务被用户取消"""
+    msg = '任务已取消'
+
+class TaskPaused(yt_dlp.utils.DownloadCancelled):
+    """下载任务被用户暂停，已下载的 .part 文件会保留"""
+    msg = '任务已暂停'
+
+class TaskHandle:
+    """正在运行的下载任务的控制句柄，供按钮回调与下载线程通信"""
+    def __init__(self, job_id):
+        self.job_id = job_id
+        self.cancel_requested = False
+        self.pause_requested = False
+        self.requeue_requested = False  # 为其他用户的交互任务让出槽位，停止后重新排队
+        self.task = None  # 执行 start_download 的 asyncio 任务
+        self.slot_released = None  # 网络下载结束时设置，调度器据此提前释放下载槽位
+        self.failed_proxy = None  # 上次因代理出错失败的代理地址，重试时避开
+
+    def release_slot(self):
+        """网络下载已经结束，释放下载槽位，后期处理在槽位之外继续进行"""
+        if self.slot_released is not None:
+            self.slot_released.set()
+
+    def check(self, allow_pause=True):
+        """在下载线程或各阶段之间调用，收到请求时抛出异常中止任务"""
+        if self.cancel_requested:
+            raise TaskCancelled()
+        if (self.pause_requested or self.requeue_requested) and allow_pause:
+            raise TaskPaused()
+
+task_handles = {}  # 任务ID -> 正在运行任务的 TaskHandle
+
 class DownloadProgress:
-    def __init__(self, status_message):
+    def __init__(self, status_message, handle=None, reply_markup=None):
         self.status_message = status_message
+        self.handle = handle
+        self.reply_markup = reply_markup  # 进度消息下方保留的任务控制按钮
         self.download_finished = False
         self.current_title = None
         self.last_progress = -1
+        self.last_publish = 0
         self.start_time = time.time()
         self.task_id = f"Task-{int(time.time() * 1000)}"[-6:]  # 生成唯一任务ID
         self.download_phase = "video"  # 当前下载阶段：video, audio, merging
@@ -110,9 +442,23 @@ class DownloadProgress:
         
     def progress_hook(self, d):
         """下载回调"""
+        # 取消或暂停时从回调中抛出异常，yt-dlp 会立即中止下载并保留 .part 文件
+        if self.handle is not None:
+            self.handle.check(allow_pause=d.get('status') == 'downloading')
+        
         try:
             status = d['status']
             
+            if 'postprocessor' in d:
+                # 后处理回调：只在开始时更新一次消息
+                if status == 'started':
+                    self._publish(
+                        f"🛠 正在后期处理: {self.current_title}\n"
+                        f"⚙️ {d['postprocessor']}",
+                        force=True
+                    )
+                return
+            
             if status == 'downloading':
                 if not self.current_title:
                     self.current_title = d['filename'].split('/')[-1].split(' - ')[0]  # 只取视频标题部分
@@ -127,12 +473,13 @@ class DownloadProgress:
                     speed_mb = speed / (1024 * 1024) if speed else 0
                     
                     # 确定当前下载阶段
-                    if d.get('info_dict', {}).get('format_id', '').startswith('bestvideo'):
-                        phase = "视频流"
-                    elif d.get('info_dict', {}).get('format_id', '').startswith('bestaudio'):
+                    info_dict = d.get('info_dict', {})
+                    if info_dict.get('vcodec') == 'none':
                         phase = "音频流"
+                    elif info_dict.get('acodec') == 'none':
+                        phase = "视频流"
                     else:
-                        phase = "合并文件"
+                        phase = "视频文件"
                     
                     # 在日志中显示开始下载信息
                     if not self.download_started:
@@ -143,6 +490,16 @@ class DownloadProgress:
                     if current_progress % 20 == 0 and current_progress != self.last_progress:
                         logger.info(f"下载{phase}: {current_progress}% - {speed_mb:.1f}MB/s")
                         self.last_progress = current_progress
+                    
+                    eta = d.get('eta')
+                    eta_text = f"{int(eta) // 60:02d}:{int(eta) % 60:02d}" if eta is not None else "--:--"
+                    self._publish(
+                        f"⬇️ 正在下载: {self.current_title}\n"
+                        f"📦 {phase}\n"
+                        f"{self._get_progress_bar(progress)} {progress:.1f}%\n"
+                        f"⚡️ {speed_mb:.1f}MB/s · ⏱ 剩余 {eta_text}\n"
+                        f"💾 {format_size(downloaded_bytes)} / {format_size(total_bytes)}"
+                    )
                 
             elif status == 'finished':
                 if not self.download_finished:
@@ -154,6 +511,16 @@ class DownloadProgress:
                 
         except Exception as e:
             logger.error(f"进度更新出错: {str(e)}")
+    
+    def _publish(self, text, force=False):
+        """把最新进度交给消息编辑器，回调非常频繁，这里先做一次本地节流"""
+        if self.status_message is None:
+            return
+        now = time.monotonic()
+        if not force and now - self.last_publish < 0.5:
+            return
+        self.last_publish = now
+        progress_publisher.publish(self.status_message, text, self.reply_markup)
             
     def _get_progress_bar(self, percentage, length=20):
         """生成进度条"""
@@ -161,142 +528,314 @@ class DownloadProgress:
         bar = '=' * filled + '-' * (length - filled)
         return f"[{bar}]"
 
-def is_valid_url(url: str) -> bool:
-    """检查URL是否为支持的格式"""
-    try:
-        # 检查是否包含支持的域名
-        if not any(site in url.lower() for site in SUPPORTED_URLS):
-            return False
-            
-        # 检查是否是完整的YouTube链接
-        if 'youtube.com/watch?v=' in url:
-            video_id = url.split('watch?v=')[1].split('&')[0]
-            return len(video_id) == 11  # YouTube视频ID通常是11个字符
-        elif 'youtu.be/' in url:
-            video_id = url.split('youtu.be/')[1].split('?')[0]
-            return len(video_id) == 11
-        elif 'youtube.com/shorts/' in url:  # 添加对 Shorts 的支持
-            video_id = url.split('shorts/')[1].split('?')[0]
-            return len(video_id) == 11
-            
-        return False
-        
-    except Exception:
-        return False
+class TTLCache:
+    """带过期时间的LRU缓存（线程安全）"""
+    def __init__(self, max_entries=256, ttl=1800):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()  # key -> (过期时间, 值)
+        self._lock = threading.Lock()
 
-async def check_admin(update: Update) -> bool:
-    """检查用户是否是管理员"""
-    user_id = update.effective_user.id
-    if str(user_id) != str(ADMIN_USER_ID):
-        await update.message.reply_text("⛔️ 抱歉，你没有使用此机器人的权限。")
-        return False
-    return True
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at < time.time():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
 
-async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """处理 /start 命令"""
-    logger.info(f"收到 /start 命令 from user {update.effective_user.id}")
-    
-    if not await check_admin(update):
-        logger.warning(f"非管理员用户 {update.effective_user.id} 尝试使用机器人")
-        return
+    def put(self, key, value, expires_at=None):
+        if expires_at is None:
+            expires_at = time.time() + self.ttl
+        with self._lock:
+            self._entries[key] = (expires_at, value)
+            self._entries.move_to_end(key)
+            # 超出容量时淘汰最久未使用的条目
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def __len__(self):
+        return len(self._entries)
+
+class InfoCache(TTLCache):
+    """视频信息缓存，按11位视频ID索引，可选磁盘二级缓存"""
+    def __init__(self, max_entries=256, ttl=1800, cache_dir=None):
+        super().__init__(max_entries, ttl)
+        self.cache_dir = cache_dir
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def _disk_path(self, video_id):
+        return os.path.join(self.cache_dir, f"{video_id}.json")
+
+    def get(self, video_id, disk=True):
+        """disk=False 时只查内存，可以在事件循环中调用；读取磁盘缓存的调用应放在线程中"""
+        info = super().get(video_id)
+        if info is not None or not disk or not self.cache_dir:
+            return info
         
-    try:
-        await update.message.reply_text(
-            "👋 你好! 我是一个YouTube视频下载机器人。\n"
-            "只需要发送YouTube视频链接给我，我就会帮你下载视频。\n"
-            "支持的链接格式: youtube.com"
-        )
-        logger.info(f"成功响应 /start 命令 to user {update.effective_user.id}")
-    except Exception as e:
-        logger.error(f"处理 /start 命令时出错: {str(e)}")
-        raise
+        # 内存未命中时尝试读取磁盘缓存
+        path = self._disk_path(video_id)
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        
+        if entry.get('expires_at', 0) < time.time():
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            return None
+        
+        super().put(video_id, entry['info'], entry['expires_at'])
+        return entry['info']
 
-async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """处理 /help 命令"""
-    logger.info(f"收到 /help 命令 from user {update.effective_user.id}")
-    
-    if not await check_admin(update):
-        return
+    def put(self, video_id, info, expires_at=None):
+        if expires_at is None:
+            expires_at = time.time() + self.ttl
+        super().put(video_id, info, expires_at)
+        if not self.cache_dir:
+            return
         
-    proxy_status = '已启用 ✅' if HTTP_PROXY else '未启用 ❌'
-    proxy_address = HTTP_PROXY if HTTP_PROXY else 'N/A'
-    
-    quality_mode = "手动选择" if enable_quality_selection else "自动最高质量"
-    
-    help_text = f"""
-📖 使用说明
+        # 先写临时文件再替换，避免读到写了一半的缓存
+        path = self._disk_path(video_id)
+        tmp_path = f"{path}.tmp"
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump({'expires_at': expires_at, 'info': info}, f, ensure_ascii=False)
+            os.replace(tmp_path, path)
+        except (OSError, TypeError, ValueError) as e:
+            logger.warning(f"写入磁盘缓存失败: {str(e)}")
 
-🤖 基本命令:
-/start - 启动机器人
-/help - 显示此帮助信息
-/status - 显示机器人状态
+    def invalidate(self, video_id):
+        super().invalidate(video_id)
+        if self.cache_dir:
+            try:
+                os.remove(self._disk_path(video_id))
+            except OSError:
+                pass
 
-📥 下载视频:
-1. 直接发送YouTube视频链接给我
-2. {quality_mode}下载质量
-3. 等待下载完成
+info_cache = InfoCache(INFO_CACHE_SIZE, INFO_CACHE_TTL, INFO_CACHE_DIR)
+# 质量选择菜单：菜单令牌 -> {'url', 'title', 'formats', 'user_id'}，令牌写在按钮的 callback_data 中，多个菜单互不影响
+format_menus = TTLCache(FORMAT_MENU_SIZE, FORMAT_MENU_TTL)
 
-🔗 支持的链接格式:
-- https://www.youtube.com/watch?v=...
+def parse_menu_callback(callback_data):
+    """解析 dl_<菜单令牌>_<格式编号>，返回 (菜单令牌, 格式编号)；旧格式的按钮返回空令牌"""
+    _, menu_token, format_id = (callback_data.split('_', 2) + ['', ''])[:3]
+    return menu_token, format_id
 
-📁 下载内容:
-- 视频文件 ({quality_mode})
-- NFO元数据文件 (用于Emby/Plex)
-- 视频封面图片
+VIDEO_ID_PATTERN = re.compile(r'(?:[?&]v=|youtu\.be/|/shorts/|/embed/|/live/)([0-9A-Za-z_-]{11})')
 
-💾 保存位置:
-{DOWNLOAD_PATH}
+def extract_video_id(url):
+    """从链接中提取11位的YouTube视频ID"""
+    match = VIDEO_ID_PATTERN.search(url)
+    return match.group(1) if match else None
 
-⚙️ 其他信息:
-- 代理状态: {proxy_status}
-- 代理地址: {proxy_address}
-- 质量选择: {quality_mode}
-"""
+class ProxyInfo:
+    """代理池中单个代理的状态"""
+    def __init__(self, url, weight=1.0):
+        self.url = url
+        self.weight = weight
+        self.healthy = True
+        self.latency = None  # 健康检查的平均延迟(秒)
+        self.failures = 0  # 连续失败次数
+        self.active = 0  # 正在使用的任务数
+        self.bytes_total = 0
+        self.rate = 0  # 最近一个检查周期的下载速度(字节/秒)
+        self._bytes_sampled = 0
+        self._sampled_at = time.monotonic()
 
-    await update.message.reply_text(help_text)
-    logger.info(f"成功响应 /help 命令 to user {update.effective_user.id}")
+    @property
+    def label(self):
+        # 隐藏代理地址中的用户名和密码
+        return re.sub(r'//[^@/]*@', '//***@', self.url)
 
-async def status_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """处理 /status 命令"""
-    logger.info(f"收到 /status 命令 from user {update.effective_user.id}")
+class ProxyPool:
+    """带健康检查和负载均衡的代理池（线程安全）
     
-    if not await check_admin(update):
-        return
+    按 (使用中的任务数 + 1) / 权重 选择负载最低的健康代理，延迟越高、失败越多权重越低；
+    连续失败的代理暂时停用，直到下一次健康检查成功。代理列表为空时直接连接。
+    """
+    MAX_FAILURES = 3
 
-    # 检查下载目录
-    if not os.path.exists(DOWNLOAD_PATH):
-        status_text = "❌ 下载目录不存在！"
-    else:
-        # 获取目录信息
-        total_videos = len([d for d in os.listdir(DOWNLOAD_PATH) if os.path.isdir(os.path.join(DOWNLOAD_PATH, d))])
-        total_size = sum(os.path.getsize(os.path.join(dirpath,filename)) 
-                        for dirpath, dirnames, filenames in os.walk(DOWNLOAD_PATH) 
-                        for filename in filenames)
+    def __init__(self, name, proxies, check_url, interval=60):
+        self.name = name
+        self.proxies = [ProxyInfo(*self._parse(item)) for item in proxies]
+        self.check_url = check_url
+        self.interval = interval
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _parse(item):
+        url, _, weight = item.partition('|')
+        try:
+            weight = float(weight) if weight else 1.0
+        except ValueError:
+            weight = None
+        # 权重用作除数，必须是正数
+        if weight is None or not 0 < weight < float('inf'):
+            logger.warning(f"代理权重无效（必须大于0），使用默认值: {item}")
+            weight = 1.0
+        return url.strip(), weight
+
+    def find(self, url):
+        return next((proxy for proxy in self.proxies if proxy.url == url), None)
+
+    def acquire(self, prefer=None, exclude=None):
+        """选择一个代理并计入负载，prefer 为健康的代理地址时优先使用，有其他代理时不选 exclude"""
+        if not self.proxies:
+            return None
+        with self._lock:
+            candidates = [proxy for proxy in self.proxies if proxy.healthy] or self.proxies
+            candidates = [proxy for proxy in candidates if proxy.url != exclude] or candidates
+            proxy = next((p for p in candidates if p.url == prefer), None)
+            if proxy is None:
+                proxy = min(candidates, key=lambda p: (p.active + 1) * (1 + (p.latency or 0)) * (1 + p.failures) / p.weight)
+            proxy.active += 1
+            return proxy
+
+    def release(self, proxy):
+        if proxy is None:
+            return
+        with self._lock:
+            proxy.active = max(proxy.active - 1, 0)
+
+    def report(self, proxy, ok):
+        """记录一次请求的结果，连续失败的代理会被暂时停用"""
+        if proxy is None:
+            return
+        with self._lock:
+            if ok:
+                proxy.failures = 0
+                return
+            proxy.failures += 1
+            if proxy.healthy and proxy.failures >= self.MAX_FAILURES:
+                proxy.healthy = False
+                logger.warning(f"{self.name}代理 {proxy.label} 连续失败 {proxy.failures} 次，暂停使用")
+
+    def add_bytes(self, proxy, amount):
+        """累计代理的下载量，多个下载线程同时调用"""
+        if proxy is not None:
+            with self._lock:
+                proxy.bytes_total += amount
+
+    async def check(self):
+        """通过每个代理请求检查地址，更新健康状态和延迟"""
+        async def probe(proxy):
+            start = time.monotonic()
+            try:
+                async with httpx.AsyncClient(proxies=proxy.url, timeout=10) as client:
+                    response = await client.get(self.check_url)
+                ok = response.status_code < 500 and response.status_code != 429
+            except Exception as e:
+                logger.debug(f"代理检查失败 {proxy.label}: {str(e)}")
+                ok = False
+            
+            now = time.monotonic()
+            with self._lock:
+                proxy.rate = (proxy.bytes_total - proxy._bytes_sampled) / max(now - proxy._sampled_at, 1)
+                proxy._bytes_sampled = proxy.bytes_total
+                proxy._sampled_at = now
+                if ok:
+                    latency = now - start
+                    proxy.latency = latency if proxy.latency is None else 0.7 * proxy.latency + 0.3 * latency
+                    if not proxy.healthy:
+                        logger.info(f"{self.name}代理 {proxy.label} 已恢复 ({latency * 1000:.0f}ms)")
+                    proxy.healthy = True
+                    proxy.failures = 0
+                elif proxy.healthy:
+                    proxy.healthy = False
+                    logger.warning(f"{self.name}代理 {proxy.label} 健康检查失败，暂停使用")
         
-        status_text = f"""
-📊 机器人状态
+        await asyncio.gather(*(probe(proxy) for proxy in self.proxies))
+
+    async def run(self):
+        while True:
+            try:
+                await self.check()
+            except Exception as e:
+                logger.error(f"检查{self.name}代理出错: {str(e)}")
+            await asyncio.sleep(self.interval)
 
-🎥 已下载视频: {total_videos} 个
-💾 总占用空间: {total_size / (1024*1024*1024):.2f} GB
+    def describe(self):
+        """代理状态的文字说明，用于 /status"""
+        if not self.proxies:
+            return "  直接连接"
+        lines = []
+        for proxy in self.proxies:
+            latency = f"{proxy.latency * 1000:.0f}ms" if proxy.latency is not None else "--"
+            lines.append(
+                f"  {'✅' if proxy.healthy else '❌'} {proxy.label} · {latency} · "
+                f"{proxy.active} 个任务 · {format_size(proxy.rate)}/s · 共 {format_size(proxy.bytes_total)}"
+            )
+        return "\n".join(lines)
 
-📁 下载目录: {DOWNLOAD_PATH}
-🌐 代理状态: {'已启用 ✅' if HTTP_PROXY else '未启用 ❌'}
-🔗 代理地址: {HTTP_PROXY if HTTP_PROXY else 'N/A'}
+download_proxy_pool = ProxyPool("下载", PROXY_LIST, PROXY_CHECK_URL, PROXY_CHECK_INTERVAL)
+# 提取与下载使用同一组代理时共用一个代理池，负载和健康状态才能统一计算
+extract_proxy_pool = (download_proxy_pool if EXTRACT_PROXY_LIST == PROXY_LIST else
+                      ProxyPool("提取", EXTRACT_PROXY_LIST, PROXY_CHECK_URL, PROXY_CHECK_INTERVAL))
 
-⚡️ 机器人运行正常
-"""
-    
-    await update.message.reply_text(status_text)
-    logger.info(f"成功响应 /status 命令 to user {update.effective_user.id}")
+PROXY_ERROR_PATTERN = re.compile(
+    r'429|too many requests|timed out|unable to connect|connection (refused|reset|aborted)|'
+    r'proxy|tunnel|ssl|remote end closed|not a bot|network is unreachable|name resolution',
+    re.IGNORECASE
+)
 
-async def list_formats(url, proxy=None, status_message=None):
-    """获取视频可用的格式列表"""
-    logger.info(f"开始获取视频格式列表: {url}")
+def is_proxy_error(error):
+    """判断下载或提取错误是否可能由代理引起（换一个代理可能成功）"""
+    return bool(PROXY_ERROR_PATTERN.search(str(error)))
+
+def get_video_info(url, cancel_event=None):
+    """获取视频信息，优先使用缓存，只有未命中时才请求YouTube（阻塞调用）
     
-    # 更新状态消息
-    if status_message:
-        await status_message.edit_text("🔍 正在获取视频信息...")
+    从提取代理池中选择代理，遇到可能由代理引起的错误时换一个代理重试
+    """
+    video_id = extract_video_id(url)
+    if video_id:
+        info = info_cache.get(video_id)
+        if info is not None:
+            logger.info(f"命中视频信息缓存: {video_id}")
+            metrics.inc('ytbot_info_cache_requests_total', result='hit')
+            return info
+    metrics.inc('ytbot_info_cache_requests_total', result='miss')
     
+    start_time = time.monotonic()
+    attempts = min(max(len(extract_proxy_pool.proxies), 1), 3)
+    for attempt in range(1, attempts + 1):
+        proxy = extract_proxy_pool.acquire()
+        try:
+            info = extract_video_info(url, proxy.url if proxy else None, cancel_event)
+        except yt_dlp.utils.DownloadCancelled:
+            raise
+        except Exception as e:
+            proxy_error = is_proxy_error(e)
+            extract_proxy_pool.report(proxy, not proxy_error)
+            if not proxy_error or attempt == attempts:
+                metrics.observe('ytbot_extraction_seconds', time.monotonic() - start_time, result='error')
+                raise
+            logger.warning(f"通过代理 {proxy.label} 提取信息失败，更换代理重试: {str(e)}")
+            continue
+        finally:
+            extract_proxy_pool.release(proxy)
+        extract_proxy_pool.report(proxy, True)
+        break
+    
+    metrics.observe('ytbot_extraction_seconds', time.monotonic() - start_time, result='ok')
+    info_cache.put(info.get('id') or video_id, info)
+    return info
+
+def extract_video_info(url, proxy, cancel_event=None):
+    """通过指定代理请求YouTube提取视频信息（阻塞调用）"""
     ydl_opts = {
         'proxy': proxy,
         'quiet': True,
@@ -306,305 +845,2376 @@ async def list_formats(url, proxy=None, status_message=None):
         'youtube_include_dash_manifest': True,  # 确保包含DASH格式
         'youtube_include_hls_manifest': True,   # 确保包含HLS格式
     }
+    if cancel_event is not None:
+        ydl_opts['logger'] = ChineseLogger(logger, cancel_event)
     
-    try:
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            logger.info("正在提取视频信息...")
-            try:
-                info = ydl.extract_info(url, download=False)
-                
-                if not info:
-                    logger.error("无法获取视频信息，可能视频已被删除或设为私有")
-                    raise Exception("无法获取视频信息，可能视频已被删除或设为私有")
-            except yt_dlp.utils.DownloadError as e:
-                error_msg = str(e).lower()
-                if "account associated with this video has been terminated" in error_msg:
-                    logger.error(f"YouTube账号已被终止: {error_msg}")
-                    raise Exception("此视频不可用，因为关联的YouTube账号已被终止")
-                elif "private video" in error_msg:
-                    logger.error(f"私有视频: {error_msg}")
-                    raise Exception("这是一个私有视频，需要登录才能查看")
-                elif "unavailable" in error_msg or "not available" in error_msg:
-                    logger.error(f"视频不可用: {error_msg}")
-                    raise Exception("此视频目前不可用或已被删除")
-                elif "copyright" in error_msg:
-                    logger.error(f"版权限制: {error_msg}")
-                    raise Exception("此视频因版权问题不可用")
-                elif "sign in" in error_msg or "login" in error_msg:
-                    logger.error(f"需要登录: {error_msg}")
-                    raise Exception("此视频需要登录才能查看")
-                elif "removed" in error_msg:
-                    logger.error(f"视频已被移除: {error_msg}")
-                    raise Exception("此视频已被作者或YouTube移除")
-                elif "uploader has not made this video available" in error_msg:
-                    logger.error(f"上传者未公开视频: {error_msg}")
-                    raise Exception("上传者未公开此视频，目前无法访问")
-                else:
-                    logger.error(f"获取视频信息失败: {error_msg}")
-                    raise Exception(f"获取视频信息失败: {e}")
-                
-            title = info.get('title', '未知标题')
-            logger.info(f"成功获取视频信息: {title}")
-            
-            # 使用更完善的方式处理格式
-            all_formats = []
-            
-            try:
-                if 'formats' in info:
-                    # 从所有格式中筛选视频格式
-                    video_formats = [f for f in info['formats'] if f.get('vcodec') != 'none' and f.get('height')]
-                    
-                    # 创建分辨率映射以实现更好的去重
-                    format_dict = {}
-                    
-                    for f in video_formats:
-                        height = f.get('height', 0)
-                        width = f.get('width', 0)
-                        fps = f.get('fps', 0)
-                        tbr = f.get('tbr', 0) or 0
-                        
-                        # 检测特殊标记
-                        is_hdr = 'hdr' in f.get('format_note', '').lower() or 'hdr' in f.get('format', '').lower()
-                        is_high_fps = fps and fps > 30
-                        
-                        # 创建标准化的分辨率标签
-                        if height >= 4320:  # 8K
-                            base_label = '4320p'
-                        elif height >= 2160:  # 4K
-                            base_label = '2160p'
-                        elif height >= 1440:  # 2K/QHD
-                            base_label = '1440p'
-                        elif height >= 1080:  # Full HD
-                            base_label = '1080p'
-                        elif height >= 720:   # HD
-                            base_label = '720p'
-                        elif height >= 480:   # SD
-                            base_label = '480p'
-                        elif height >= 360:   # 低清
-                            base_label = '360p'
-                        elif height >= 240:   # 超低清
-                            base_label = '240p'
-                        elif height >= 144:   # 最低清
-                            base_label = '144p'
-                        else:
-                            base_label = f"{height}p"
-                        
-                        # 添加帧率和HDR标记
-                        label = base_label
-                        if is_high_fps:
-                            label = f"{base_label}60"
-                        if is_hdr:
-                            label = f"{label} HDR"
-                        
-                        # 计算分辨率质量得分，用于选择每个分辨率的最佳版本
-                        # 优先考虑有音频的格式
-                        has_audio = f.get('acodec') != 'none'
-                        quality_score = (tbr * 100) + (50000 if has_audio else 0)
-                        
-                        # 确保相同分辨率只保留质量最高的版本
-                        key = base_label  # 使用基础分辨率作为键，确保每个分辨率只有一个版本
-                        
-                        if key not in format_dict or quality_score > format_dict[key]['quality_score']:
-                            format_dict[key] = {
-                                'format_id': f.get('format_id', ''),
-                                'key': label,  # 显示带fps/HDR的完整标签
-                                'base_key': base_label,  # 存储基础分辨率，用于去重
-                                'height': height,
-                                'width': width,
-                                'fps': fps,
-                                'quality_score': quality_score,
-                                'filesize_mb': 0,
-                                'url': url,
-                                'title': title
-                            }
-                    
-                    # 转换为列表
-                    all_formats = list(format_dict.values())
-                    
-                    # 确保格式列表不为空
-                    if not all_formats:
-                        logger.warning("没有找到视频格式，将使用备选方案")
-                        raise Exception("没有找到视频格式")
-            except Exception as e:
-                logger.warning(f"解析formats时出错: {str(e)}")
-                all_formats = []
-            
-            # 如果上面的处理失败或没有找到格式，使用备选方案
-            if not all_formats:
-                logger.info("使用备选分辨率选项")
-                
-                # 为各种视频提供全面的分辨率选项
-                default_formats = [
-                    {"key": "4320p", "base_key": "4320p", "format_id": "bestvideo[height>=4320]+bestaudio/best", "height": 4320},
-                    {"key": "2160p", "base_key": "2160p", "format_id": "bestvideo[height>=2160]+bestaudio/best", "height": 2160},
-                    {"key": "1440p", "base_key": "1440p", "format_id": "bestvideo[height>=1440]+bestaudio/best", "height": 1440},
-                    {"key": "1080p60", "base_key": "1080p", "format_id": "bestvideo[height>=1080][fps>30]+bestaudio/best", "height": 1080},
-                    {"key": "1080p", "base_key": "1080p", "format_id": "bestvideo[height>=1080]+bestaudio/best", "height": 1080},
-                    {"key": "720p60", "base_key": "720p", "format_id": "bestvideo[height>=720][fps>30]+bestaudio/best", "height": 720},
-                    {"key": "720p", "base_key": "720p", "format_id": "bestvideo[height>=720]+bestaudio/best", "height": 720},
-                    {"key": "480p", "base_key": "480p", "format_id": "bestvideo[height>=480]+bestaudio/best", "height": 480},
-                    {"key": "360p", "base_key": "360p", "format_id": "bestvideo[height>=360]+bestaudio/best", "height": 360},
-                    {"key": "240p", "base_key": "240p", "format_id": "bestvideo[height>=240]+bestaudio/best", "height": 240},
-                    {"key": "144p", "base_key": "144p", "format_id": "bestvideo[height>=144]+bestaudio/best", "height": 144},
-                ]
-                
-                # 添加其他必要信息
-                for fmt in default_formats:
-                    fmt.update({
-                        'url': url,
-                        'title': title,
-                        'quality_score': fmt['height'] * 10
-                    })
-                
-                all_formats = default_formats
-            
-            # 按分辨率排序
-            all_formats.sort(key=lambda x: x.get('height', 0), reverse=True)
-            
-            # 限制数量，同时确保保留最常用的分辨率
-            if len(all_formats) > 8:
-                # 确保保留最高和最低的几个分辨率选项
-                high_res = all_formats[:3]  # 保留最高的3个
-                low_res = all_formats[-3:]  # 保留最低的3个
-                mid_res = all_formats[3:-3]  # 中间的分辨率
-                
-                # 如果中间分辨率过多，进行筛选
-                if len(mid_res) > 2:
-                    # 优先保留1080p和720p
-                    priority_res = []
-                    remaining_res = []
-                    
-                    for fmt in mid_res:
-                        base_key = fmt.get('base_key', '')
-                        if base_key in ['1080p', '720p']:
-                            priority_res.append(fmt)
-                        else:
-                            remaining_res.append(fmt)
-                    
-                    # 选择中间范围的分辨率
-                    if len(remaining_res) > 0:
-                        # 选择一个中间分辨率，优先选择480p
-                        middle_choice = None
-                        for fmt in remaining_res:
-                            if fmt.get('base_key') == '480p':
-                                middle_choice = fmt
-                                break
-                        
-                        # 如果没有480p，选择列表中间的一项
-                        if not middle_choice and remaining_res:
-                            middle_index = len(remaining_res) // 2
-                            middle_choice = remaining_res[middle_index]
-                        
-                        if middle_choice:
-                            priority_res.append(middle_choice)
-                    
-                    # 最终的中间分辨率选择
-                    mid_res = priority_res
-                
-                # 合并最终结果
-                all_formats = high_res + mid_res + low_res
-            
-            # 始终添加"最佳质量"选项在最前面
-            all_formats.insert(0, {
-                'format_id': 'best',
-                'key': '最佳质量',
-                'base_key': 'best',
-                'height': 9999,  # 用于排序
-                'quality_score': 999999,
-                'url': url,
-                'title': title
-            })
-            
-            # 转为格式化后的列表返回
-            formatted_formats = []
-            for i, fmt in enumerate(all_formats):
-                formatted_formats.append({
-                    'id': i,
-                    'key': fmt['key'],
-                    'format_id': fmt['format_id'],
-                    'url': url,
-                    'title': title
-                })
-            
-            logger.info(f"找到 {len(formatted_formats)} 种视频格式")
-            return formatted_formats
-            
-    except Exception as e:
-        logger.error(f"获取视频格式失败: {str(e)}")
-        raise Exception(f"获取视频信息失败: {str(e)}")
+    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+        logger.info("正在提取视频信息...")
+        info = ydl.extract_info(url, download=False)
+        if not info:
+            logger.error("无法获取视频信息，可能视频已被删除或设为私有")
+            raise Exception("无法获取视频信息，可能视频已被删除或设为私有")
+        # 清理为可序列化的字典，下载时可直接交给 process_ie_result 使用
+        info = ydl.sanitize_info(info, remove_private_keys=True)
+    # 直链与提取时的出口IP绑定，记录使用的代理以便下载时沿用
+    info['extraction_proxy'] = proxy
+    return info
 
-async def process_download_queue(context: ContextTypes.DEFAULT_TYPE):
-    """处理下载队列"""
-    global is_downloading
+class ExtractionService:
+    """视频信息提取服务
     
-    if not download_queue:
-        is_downloading = False
-        return
+    在独立的线程池中运行阻塞的 extract_info，不占用事件循环和下载线程池。
+    同一视频的并发请求只会触发一次提取；所有等待者都放弃后通知提取线程中止。
+    """
+    def __init__(self, max_workers=2, timeout=60):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='extract')
+        self.timeout = timeout
+        self._inflight = {}  # 视频ID -> 正在进行的提取
+
+    async def get_info(self, url):
+        """获取视频信息，超时抛出 asyncio.TimeoutError"""
+        video_id = extract_video_id(url)
+        if video_id:
+            # 只查内存缓存；磁盘缓存由提取线程中的 get_video_info 读取
+            info = info_cache.get(video_id, disk=False)
+            if info is not None:
+                metrics.inc('ytbot_info_cache_requests_total', result='hit')
+                return info
         
-    is_downloading = True
-    
-    try:
-        tasks = []
-        # 同时处理多个下载任务
-        while len(tasks) < concurrent_downloads and download_queue:
-            task = download_queue[0]  # 先不移除任务
-            
-            # 创建下载任务
-            download_task = asyncio.create_task(
-                start_download(
-                    task['message'],
-                    task['url'],
-                    task['format_id'],
-                    task['title']
-                )
+        key = video_id or url
+        entry = self._inflight.get(key)
+        if entry is None:
+            cancel_event = threading.Event()
+            future = asyncio.get_running_loop().run_in_executor(
+                self.executor, get_video_info, url, cancel_event
             )
-            tasks.append(download_task)
-            download_queue.pop(0)  # 任务开始后再移除
-            
-        # 等待所有任务完成
-        if tasks:
-            await asyncio.gather(*tasks)
-            
-    except Exception as e:
-        logger.error(f"Queue processing error: {str(e)}")
-    finally:
-        # 如果还有任务，继续处理
-        if download_queue:
-            await asyncio.sleep(1)  # 短暂延迟避免CPU过载
-            await process_download_queue(context)
+            entry = {'future': future, 'cancel_event': cancel_event, 'waiters': 0}
+            self._inflight[key] = entry
+            future.add_done_callback(lambda f, key=key, entry=entry: self._on_done(key, entry))
         else:
-            is_downloading = False
+            logger.info(f"合并重复的信息提取请求: {key}")
+        
+        entry['waiters'] += 1
+        try:
+            return await asyncio.wait_for(asyncio.shield(entry['future']), self.timeout)
+        finally:
+            entry['waiters'] -= 1
+            if entry['waiters'] == 0 and not entry['future'].done():
+                # 已经没有人等待结果，取消排队中的任务并通知运行中的线程尽快退出
+                logger.warning(f"取消信息提取: {key}")
+                entry['cancel_event'].set()
+                entry['future'].cancel()
+                if self._inflight.get(key) is entry:
+                    del self._inflight[key]
 
-async def add_to_queue(message, url, format_id, title):
-    """添加下载任务到队列"""
-    queue_position = len(download_queue) + 1
-    
-    # 添加到队列
-    download_queue.append({
-        'message': message,
-        'url': url,
-        'format_id': format_id,
-        'title': title
-    })
-    
-    # 显示队列位置
-    await message.edit_text(
-        f"⏳ 已加入下载队列\n\n"
-        f"📹 {title}\n"
+    def _on_done(self, key, entry):
+        if self._inflight.get(key) is entry:
+            del self._inflight[key]
+        future = entry['future']
+        # 取走异常，避免无人等待时出现 "exception was never retrieved" 警告
+        if not future.cancelled():
+            future.exception()
+
+extraction_service = ExtractionService(EXTRACT_CONCURRENCY, EXTRACT_TIMEOUT)
+
+class SQLiteStore:
+    """SQLite(WAL模式)存储的公共部分，子类通过 SCHEMA 定义表结构"""
+    SCHEMA = ""
+
+    def __init__(self, db_path):
+        db_dir = os.path.dirname(db_path)
+        if db_dir:
+            os.makedirs(db_dir, exist_ok=True)
+        self._lock = threading.RLock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(self.SCHEMA)
+        self._migrate()
+        self._conn.commit()
+
+    def _migrate(self):
+        """兼容旧版本创建的数据库"""
+
+    def _ensure_column(self, table, column, definition):
+        columns = [row['name'] for row in self._conn.execute(f"PRAGMA table_info({table})")]
+        if column not in columns:
+            self._conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+
+    def _query(self, sql, params=()):
+        with self._lock:
+            return [dict(row) for row in self._conn.execute(sql, params)]
+
+class JobStore(SQLiteStore):
+    """基于SQLite(WAL模式)的持久化下载任务队列
+    
+    写操作先在当前事务中执行，再由定时器批量提交，保证入队足够快；
+    任务进入终态时立即提交。进程重启后可以从数据库中恢复未完成的任务。
+    
+    多个工作进程共用同一个数据库时，领取任务会记录 worker_id 和租约到期时间，
+    工作进程定期续约；租约过期的任务重新排队。工作进程的状态消息通过 messages 表转发给机器人进程。
+    """
+    STATES = ('queued', 'extracting', 'downloading', 'postprocessing', 'paused',
+              'done', 'failed', 'cancelled')
+    # 优先级：用户单独发送的视频优先于批量任务
+    PRIORITY_INTERACTIVE = 10
+    PRIORITY_BULK = 0
+    ACTIVE_STATES = ('extracting', 'downloading', 'postprocessing')
+    FINAL_STATES = ('done', 'failed', 'cancelled')
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            url TEXT NOT NULL,
+            video_id TEXT,
+            format_id TEXT NOT NULL,
+            title TEXT,
+            chat_id INTEGER,
+            message_id INTEGER,
+            state TEXT NOT NULL DEFAULT 'queued',
+            priority INTEGER NOT NULL DEFAULT 0,
+            format_key TEXT,
+            batch_id TEXT,
+            user_id INTEGER,
+            error TEXT,
+            output_path TEXT,
+            downloaded_bytes INTEGER,
+            worker_id TEXT,
+            lease_expires REAL,
+            control TEXT,
+            created_at REAL NOT NULL,
+            updated_at REAL NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS messages (
+            chat_id INTEGER NOT NULL,
+            message_id INTEGER NOT NULL,
+            text TEXT NOT NULL,
+            reply_markup TEXT,
+            seq INTEGER NOT NULL,
+            updated_at REAL NOT NULL,
+            PRIMARY KEY (chat_id, message_id)
+        );
+        CREATE INDEX IF NOT EXISTS idx_messages_seq ON messages(seq);
+    """
+
+    def __init__(self, db_path, commit_interval=0.05, commit_batch=50):
+        self.commit_interval = commit_interval
+        self.commit_batch = commit_batch
+        self._pending = 0
+        self._flush_timer = None
+        super().__init__(db_path)
+        atexit.register(self.flush)
+
+    def _migrate(self):
+        self._ensure_column('jobs', 'priority', 'INTEGER NOT NULL DEFAULT 0')
+        self._ensure_column('jobs', 'format_key', 'TEXT')
+        self._ensure_column('jobs', 'batch_id', 'TEXT')
+        self._ensure_column('jobs', 'user_id', 'INTEGER')
+        self._ensure_column('jobs', 'downloaded_bytes', 'INTEGER')
+        self._ensure_column('jobs', 'worker_id', 'TEXT')
+        self._ensure_column('jobs', 'lease_expires', 'REAL')
+        self._ensure_column('jobs', 'control', 'TEXT')
+        self._conn.executescript("""
+            DROP INDEX IF EXISTS idx_jobs_state;
+            CREATE INDEX IF NOT EXISTS idx_jobs_queue ON jobs(state, priority DESC, id);
+            CREATE INDEX IF NOT EXISTS idx_jobs_video ON jobs(video_id);
+            CREATE INDEX IF NOT EXISTS idx_jobs_batch ON jobs(batch_id);
+            CREATE INDEX IF NOT EXISTS idx_jobs_user ON jobs(user_id, state);
+            CREATE INDEX IF NOT EXISTS idx_jobs_worker ON jobs(worker_id, state);
+        """)
+
+    def _execute(self, sql, params=(), commit=False):
+        with self._lock:
+            cursor = self._conn.execute(sql, params)
+            self._pending += 1
+            if commit or self._pending >= self.commit_batch:
+                self._commit()
+            elif self._flush_timer is None:
+                self._flush_timer = threading.Timer(self.commit_interval, self.flush)
+                self._flush_timer.daemon = True
+                self._flush_timer.start()
+            return cursor
+
+    def _commit(self):
+        if self._flush_timer is not None:
+            self._flush_timer.cancel()
+            self._flush_timer = None
+        if self._pending:
+            self._conn.commit()
+            self._pending = 0
+
+    def flush(self):
+        """立即提交所有未提交的写操作"""
+        with self._lock:
+            self._commit()
+
+    def enqueue(self, url, format_id, title=None, chat_id=None, message_id=None,
+                priority=PRIORITY_INTERACTIVE, format_key=None, batch_id=None, user_id=None):
+        """添加任务，返回任务ID；format_key 为分辨率标签，用于去重；batch_id 标识所属的批量任务"""
+        now = time.time()
+        cursor = self._execute(
+            "INSERT INTO jobs (url, video_id, format_id, format_key, batch_id, user_id, title, chat_id, message_id, "
+            "state, priority, created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, 'queued', ?, ?, ?)",
+            (url, extract_video_id(url), format_id, format_key, batch_id, user_id, title, chat_id, message_id,
+             priority, now, now)
+        )
+        return cursor.lastrowid
+
+    def get(self, job_id):
+        rows = self._query("SELECT * FROM jobs WHERE id = ?", (job_id,))
+        return rows[0] if rows else None
+
+    def set_state(self, job_id, state, **fields):
+        """更新任务状态，可同时更新 title/error/output_path 等字段"""
+        if state not in self.STATES:
+            raise ValueError(f"未知的任务状态: {state}")
+        fields['state'] = state
+        fields['updated_at'] = time.time()
+        assignments = ', '.join(f"{name} = ?" for name in fields)
+        self._execute(
+            f"UPDATE jobs SET {assignments} WHERE id = ?",
+            (*fields.values(), job_id),
+            commit=state in self.FINAL_STATES
+        )
+
+    def claim_next(self, choose=None, worker_id=None, lease=None):
+        """取出下一个任务并标记为提取中，没有任务时返回 None
+        
+        默认取优先级最高、最早排队的任务；传入 choose 时把每个用户排在最前的任务交给它选择。
+        传入 worker_id 时按租约领取并立即提交，其他进程同时领取同一个任务时只有一个会成功
+        """
+        for _ in range(5):
+            with self._lock:
+                if choose is None:
+                    rows = self._query(
+                        "SELECT * FROM jobs WHERE state = 'queued' ORDER BY priority DESC, id LIMIT 1"
+                    )
+                    job = rows[0] if rows else None
+                else:
+                    job = choose(self._query(
+                        "SELECT * FROM (SELECT *, ROW_NUMBER() OVER (PARTITION BY user_id ORDER BY priority DESC, id) AS rank "
+                        "FROM jobs WHERE state = 'queued') WHERE rank = 1"
+                    ))
+                if job is None:
+                    return None
+                if worker_id is None:
+                    self.set_state(job['id'], 'extracting')
+                else:
+                    now = time.time()
+                    cursor = self._execute(
+                        "UPDATE jobs SET state = 'extracting', worker_id = ?, lease_expires = ?, control = NULL, "
+                        "updated_at = ? WHERE id = ? AND state = 'queued'",
+                        (worker_id, now + lease, now, job['id']),
+                        commit=True
+                    )
+                    if cursor.rowcount == 0:
+                        continue  # 已被其他工作进程领取
+                    job.update(worker_id=worker_id, lease_expires=now + lease)
+                job['state'] = 'extracting'
+                return job
+        return None
+
+    def heartbeat(self, worker_id, job_ids, lease):
+        """延长工作进程所持任务的租约，返回机器人进程发来的控制请求 {任务ID: 'cancel'/'pause'}"""
+        with self._lock:
+            now = time.time()
+            if job_ids:
+                placeholders = ', '.join('?' for _ in job_ids)
+                self._execute(
+                    f"UPDATE jobs SET lease_expires = ? WHERE worker_id = ? AND id IN ({placeholders})",
+                    (now + lease, worker_id, *job_ids)
+                )
+            rows = self._query(
+                "SELECT id, control FROM jobs WHERE worker_id = ? AND control IS NOT NULL", (worker_id,)
+            )
+            if rows:
+                self._execute("UPDATE jobs SET control = NULL WHERE worker_id = ? AND control IS NOT NULL", (worker_id,))
+            self.flush()
+            return {row['id']: row['control'] for row in rows}
+
+    def request_control(self, action, job_id=None):
+        """请求持有任务的工作进程取消或暂停任务（job_id 为空时针对所有任务），返回请求的任务数"""
+        placeholders = ', '.join('?' for _ in self.ACTIVE_STATES)
+        sql = f"UPDATE jobs SET control = ? WHERE worker_id IS NOT NULL AND state IN ({placeholders})"
+        params = (action, *self.ACTIVE_STATES)
+        if job_id is not None:
+            sql += " AND id = ?"
+            params += (job_id,)
+        return self._execute(sql, params, commit=True).rowcount
+
+    def requeue_expired(self):
+        """把租约已过期（工作进程退出或失联）的任务重新放回队列，返回任务数"""
+        placeholders = ', '.join('?' for _ in self.ACTIVE_STATES)
+        now = time.time()
+        return self._execute(
+            f"UPDATE jobs SET state = 'queued', worker_id = NULL, lease_expires = NULL, control = NULL, updated_at = ? "
+            f"WHERE state IN ({placeholders}) AND worker_id IS NOT NULL AND lease_expires < ?",
+            (now, *self.ACTIVE_STATES, now),
+            commit=True
+        ).rowcount
+
+    def release_worker(self, worker_id):
+        """工作进程退出时把仍未完成的任务放回队列，返回任务数"""
+        placeholders = ', '.join('?' for _ in self.ACTIVE_STATES)
+        return self._execute(
+            f"UPDATE jobs SET state = 'queued', worker_id = NULL, lease_expires = NULL, control = NULL, updated_at = ? "
+            f"WHERE state IN ({placeholders}) AND worker_id = ?",
+            (time.time(), *self.ACTIVE_STATES, worker_id),
+            commit=True
+        ).rowcount
+
+    def post_message(self, chat_id, message_id, text, reply_markup=None):
+        """工作进程记录状态消息的最新内容，同一条消息只保留最后一次编辑"""
+        with self._lock:
+            self._execute(
+                "INSERT OR REPLACE INTO messages (chat_id, message_id, text, reply_markup, seq, updated_at) "
+                "VALUES (?, ?, ?, ?, (SELECT COALESCE(MAX(seq), 0) + 1 FROM messages), ?)",
+                (chat_id, message_id, text, reply_markup, time.time())
+            )
+
+    def messages_since(self, seq, since=0):
+        """按顺序列出 seq 之后、since 时间之后更新的状态消息"""
+        return self._query(
+            "SELECT * FROM messages WHERE seq > ? AND updated_at >= ? ORDER BY seq", (seq, since)
+        )
+
+    def find_unfinished(self, video_id, format_key):
+        """查找同一视频、同一格式尚未结束的任务"""
+        placeholders = ', '.join('?' for _ in self.FINAL_STATES)
+        rows = self._query(
+            f"SELECT * FROM jobs WHERE video_id = ? AND format_key = ? AND state NOT IN ({placeholders}) "
+            f"ORDER BY id LIMIT 1",
+            (video_id, format_key, *self.FINAL_STATES)
+        )
+        return rows[0] if rows else None
+
+    def batch_counts(self, batch_id):
+        """统计批量任务中各状态的任务数量"""
+        rows = self._query("SELECT state, COUNT(*) AS n FROM jobs WHERE batch_id = ? GROUP BY state", (batch_id,))
+        return {row['state']: row['n'] for row in rows}
+
+    def unfinished_batches(self):
+        """还有未完成任务的批量任务ID"""
+        placeholders = ', '.join('?' for _ in self.FINAL_STATES)
+        rows = self._query(
+            f"SELECT DISTINCT batch_id FROM jobs WHERE batch_id IS NOT NULL AND state NOT IN ({placeholders})",
+            self.FINAL_STATES
+        )
+        return [row['batch_id'] for row in rows]
+
+    def queue_position(self, job_id):
+        job = self.get(job_id)
+        if job is None:
+            return 0
+        rows = self._query(
+            "SELECT COUNT(*) AS n FROM jobs WHERE state = 'queued' "
+            "AND (priority > ? OR (priority = ? AND id <= ?))",
+            (job['priority'], job['priority'], job_id)
+        )
+        return rows[0]['n']
+
+    def daily_usage(self, user_id, since):
+        """用户从 since 开始已完成下载的字节数"""
+        rows = self._query(
+            "SELECT COALESCE(SUM(downloaded_bytes), 0) AS n FROM jobs "
+            "WHERE user_id = ? AND state = 'done' AND updated_at >= ?",
+            (user_id, since)
+        )
+        return rows[0]['n']
+
+    def count_user(self, user_id, *states):
+        placeholders = ', '.join('?' for _ in states)
+        rows = self._query(
+            f"SELECT COUNT(*) AS n FROM jobs WHERE user_id = ? AND state IN ({placeholders})", (user_id, *states)
+        )
+        return rows[0]['n']
+
+    def list_paused(self):
+        return self._query("SELECT * FROM jobs WHERE state = 'paused' ORDER BY id")
+
+    def list_unfinished(self):
+        placeholders = ', '.join('?' for _ in self.FINAL_STATES)
+        return self._query(f"SELECT * FROM jobs WHERE state NOT IN ({placeholders}) ORDER BY id", self.FINAL_STATES)
+
+    def list_active(self):
+        """所有进程中正在运行的任务"""
+        placeholders = ', '.join('?' for _ in self.ACTIVE_STATES)
+        return self._query(f"SELECT * FROM jobs WHERE state IN ({placeholders}) ORDER BY updated_at", self.ACTIVE_STATES)
+
+    def count_running_by_user(self):
+        """各用户在所有工作进程中正在下载的任务数"""
+        rows = self._query(
+            "SELECT user_id, COUNT(*) AS n FROM jobs WHERE state IN ('extracting', 'downloading') GROUP BY user_id"
+        )
+        return Counter({row['user_id']: row['n'] for row in rows})
+
+    def list_queued(self, limit=10):
+        """按调度顺序列出等待中的任务"""
+        return self._query(
+            "SELECT * FROM jobs WHERE state = 'queued' ORDER BY priority DESC, id LIMIT ?", (limit,)
+        )
+
+    def count(self, *states):
+        placeholders = ', '.join('?' for _ in states)
+        rows = self._query(f"SELECT COUNT(*) AS n FROM jobs WHERE state IN ({placeholders})", states)
+        return rows[0]['n']
+
+    def cancel_pending(self):
+        """取消所有等待中和已暂停的任务，返回被取消的任务ID"""
+        with self._lock:
+            rows = self._query("SELECT id FROM jobs WHERE state IN ('queued', 'paused')")
+            for row in rows:
+                self.set_state(row['id'], 'cancelled')
+            return [row['id'] for row in rows]
+
+    def recover(self):
+        """将上次运行中断的任务重新放回队列，返回所有待处理的任务
+        
+        租约仍然有效的任务属于正在运行的工作进程，不会被放回队列
+        """
+        placeholders = ', '.join('?' for _ in self.ACTIVE_STATES)
+        with self._lock:
+            now = time.time()
+            self._execute(
+                f"UPDATE jobs SET state = 'queued', worker_id = NULL, lease_expires = NULL, control = NULL, "
+                f"updated_at = ? WHERE state IN ({placeholders}) AND (worker_id IS NULL OR lease_expires < ?)",
+                (now, *self.ACTIVE_STATES, now),
+                commit=True
+            )
+            return self._query("SELECT * FROM jobs WHERE state = 'queued' ORDER BY priority DESC, id")
+
+    def purge_finished(self, max_age=7 * 24 * 3600):
+        """清理过期的已结束任务记录"""
+        placeholders = ', '.join('?' for _ in self.FINAL_STATES)
+        self._execute(
+            f"DELETE FROM jobs WHERE state IN ({placeholders}) AND updated_at < ?",
+            (*self.FINAL_STATES, time.time() - max_age),
+            commit=True
+        )
+        self._execute("DELETE FROM messages WHERE updated_at < ?", (time.time() - max_age,), commit=True)
+
+job_store = JobStore(JOB_DB_PATH)
+
+VIDEO_EXTENSIONS = ('.mp4', '.webm', '.mkv')
+# yt-dlp 合并前单独下载的音视频流，例如 "标题.f137.mp4"、"标题.f251-drc.webm"
+STREAM_FILE_PATTERN = re.compile(r'\.f\d+[\w-]*\.(mp4|webm|m4a|mkv)$')
+
+class LibraryIndex(SQLiteStore):
+    """已下载视频的持久化索引
+    
+    下载完成时直接写入；后台定期对比各视频文件夹的修改时间，
+    只重新扫描发生变化的文件夹，避免每次查询都遍历整个下载目录。
+    数量和大小的汇总在写入时同步更新，/status 不需要对整张表求和。
+    
+    shared=True 时数据库同时由下载工作进程写入：重复检查直接查询数据库，
+    内存中的汇总在发现其他进程写入后重新加载。
+    """
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS videos (
+            path TEXT PRIMARY KEY,
+            folder TEXT NOT NULL,
+            video_id TEXT,
+            title TEXT,
+            channel TEXT,
+            resolution TEXT,
+            user_id INTEGER,
+            size INTEGER NOT NULL DEFAULT 0,
+            mtime REAL NOT NULL DEFAULT 0,
+            added_at REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_videos_folder ON videos(folder);
+        CREATE INDEX IF NOT EXISTS idx_videos_video_id ON videos(video_id);
+        CREATE TABLE IF NOT EXISTS folders (
+            path TEXT PRIMARY KEY,
+            mtime REAL NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS probes (
+            path TEXT PRIMARY KEY,
+            size INTEGER NOT NULL,
+            mtime REAL NOT NULL,
+            data TEXT NOT NULL,
+            probed_at REAL NOT NULL
+        );
+    """
+
+    def __init__(self, db_path, shared=False):
+        super().__init__(db_path)
+        self.shared = shared
+        self.last_reconcile = None
+        self._data_version = None
+        self._load()
+
+    def _load(self):
+        """从数据库加载内存中的计数和汇总"""
+        with self._lock:
+            # 内存中的 视频ID -> {分辨率: 文件数}，用于在提取信息之前判断是否重复下载
+            self._downloaded = {}
+            # 汇总统计：总数、各文件夹的视频数、按频道/分辨率分组的 {'videos', 'size'}
+            self._totals = {'videos': 0, 'size': 0}
+            self._folders = Counter()
+            self._groups = {'channel': {}, 'resolution': {}}
+            for row in self._conn.execute(f"SELECT {self.ACCOUNT_COLUMNS} FROM videos"):
+                self._account(row, 1)
+            # data_version 只在其他连接提交修改后变化
+            self._data_version = self._conn.execute("PRAGMA data_version").fetchone()[0]
+
+    def refresh(self):
+        """其他进程写入过数据库时重新加载内存中的汇总，返回是否重新加载（阻塞调用）"""
+        with self._lock:
+            if self._conn.execute("PRAGMA data_version").fetchone()[0] == self._data_version:
+                return False
+            self._load()
+            return True
+
+    ACCOUNT_COLUMNS = "video_id, resolution, folder, channel, size"
+
+    def _migrate(self):
+        self._ensure_column('videos', 'user_id', 'INTEGER')
+
+    def _account(self, row, delta):
+        """一条索引记录加入(delta=1)或移出(delta=-1)时更新内存中的计数和汇总"""
+        if row['video_id']:
+            self._count(row['video_id'], row['resolution'], delta)
+        self._totals['videos'] += delta
+        self._totals['size'] += delta * row['size']
+        self._folders[row['folder']] += delta
+        if self._folders[row['folder']] <= 0:
+            del self._folders[row['folder']]
+        for column, groups in self._groups.items():
+            name = row[column] or '未知'
+            group = groups.setdefault(name, {'videos': 0, 'size': 0})
+            group['videos'] += delta
+            group['size'] += delta * row['size']
+            if group['videos'] <= 0:
+                del groups[name]
+
+    def _count(self, video_id, resolution, delta):
+        counts = self._downloaded.setdefault(video_id, Counter())
+        counts[resolution] += delta
+        if counts[resolution] <= 0:
+            del counts[resolution]
+            if not counts:
+                del self._downloaded[video_id]
+
+    def has_video(self, video_id, resolution=None):
+        """是否已经下载过该视频（指定分辨率时只检查该分辨率）"""
+        if self.shared:
+            # 工作进程下载的视频只写入数据库，内存中的计数看不到
+            rows = self._query(
+                "SELECT 1 FROM videos WHERE video_id = ? AND (? IS NULL OR resolution = ?) LIMIT 1",
+                (video_id, resolution, resolution)
+            )
+            return bool(rows)
+        # 后台同步在线程中修改计数，读取时同样需要持有锁
+        with self._lock:
+            counts = self._downloaded.get(video_id)
+            if not counts:
+                return False
+            return resolution is None or counts[resolution] > 0
+
+    def downloaded_resolutions(self, video_id):
+        """该视频已下载的所有分辨率"""
+        if self.shared:
+            return {row['resolution'] for row in self._query(
+                "SELECT DISTINCT resolution FROM videos WHERE video_id = ?", (video_id,)
+            )}
+        with self._lock:
+            return set(self._downloaded.get(video_id, ()))
+
+    def _forget(self, where, params):
+        """删除索引记录，同时更新内存中的计数"""
+        for row in self._conn.execute(f"SELECT {self.ACCOUNT_COLUMNS} FROM videos WHERE {where}", params):
+            self._account(row, -1)
+        self._conn.execute(f"DELETE FROM videos WHERE {where}", params)
+
+    def _remove(self, where, params):
+        """文件已从磁盘上删除，同时清理缓存的媒体流信息"""
+        self._conn.execute(f"DELETE FROM probes WHERE path IN (SELECT path FROM videos WHERE {where})", params)
+        self._forget(where, params)
+
+    def _upsert(self, path, size, mtime, video_id=None, title=None, channel=None, resolution=None, user_id=None):
+        old = self._conn.execute(f"SELECT {self.ACCOUNT_COLUMNS} FROM videos WHERE path = ?", (path,)).fetchone()
+        if old is not None:
+            self._account(old, -1)
+        # 已有的元数据不会被扫描结果中的空值覆盖
+        self._conn.execute(
+            "INSERT INTO videos (path, folder, video_id, title, channel, resolution, user_id, size, mtime, added_at) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT(path) DO UPDATE SET size = excluded.size, mtime = excluded.mtime, "
+            "video_id = COALESCE(excluded.video_id, videos.video_id), "
+            "title = COALESCE(excluded.title, videos.title), "
+            "channel = COALESCE(excluded.channel, videos.channel), "
+            "resolution = COALESCE(excluded.resolution, videos.resolution), "
+            "user_id = COALESCE(excluded.user_id, videos.user_id)",
+            (path, os.path.dirname(path), video_id, title, channel, resolution, user_id, size, mtime, time.time())
+        )
+        row = self._conn.execute(f"SELECT {self.ACCOUNT_COLUMNS} FROM videos WHERE path = ?", (path,)).fetchone()
+        self._account(row, 1)
+
+    def add_video(self, path, video_id=None, title=None, channel=None, resolution=None, user_id=None):
+        """记录机器人刚下载完成的视频，user_id 为发起下载的用户，用于统计存储配额"""
+        stat = os.stat(path)
+        folder = os.path.dirname(path)
+        with self._lock:
+            self._upsert(path, stat.st_size, stat.st_mtime, video_id, title, channel, resolution, user_id)
+            # 同步文件夹的修改时间，后台扫描时就不必重新扫描这个文件夹
+            self._conn.execute(
+                "INSERT OR REPLACE INTO folders (path, mtime) VALUES (?, ?)",
+                (folder, os.stat(folder).st_mtime)
+            )
+            self._conn.commit()
+
+    def get_probe(self, path, size, mtime):
+        """读取缓存的媒体流信息，文件大小或修改时间变化后缓存失效"""
+        rows = self._query("SELECT data FROM probes WHERE path = ? AND size = ? AND mtime = ?", (path, size, mtime))
+        return json.loads(rows[0]['data']) if rows else None
+
+    def save_probe(self, path, size, mtime, data):
+        """保存 ffprobe 读取到的媒体流信息"""
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO probes (path, size, mtime, data, probed_at) VALUES (?, ?, ?, ?, ?)",
+                (path, size, mtime, json.dumps(data, ensure_ascii=False), time.time())
+            )
+            self._conn.commit()
+
+    def folder_video_id(self, folder):
+        """文件夹中已保存视频的ID，用于区分同名的不同视频"""
+        rows = self._query("SELECT video_id FROM videos WHERE folder = ? AND video_id IS NOT NULL LIMIT 1", (folder,))
+        if rows:
+            return rows[0]['video_id']
+        nfo_path = os.path.join(folder, f"{os.path.basename(folder)}.nfo")
+        return read_nfo_metadata(nfo_path).get('video_id')
+
+    def summary(self):
+        """返回视频数量、文件夹数量和总大小"""
+        with self._lock:
+            return {'videos': self._totals['videos'], 'folders': len(self._folders), 'size': self._totals['size']}
+
+    def user_usage(self, user_id):
+        """用户下载的视频占用的空间"""
+        return self._query("SELECT COALESCE(SUM(size), 0) AS size FROM videos WHERE user_id = ?", (user_id,))[0]['size']
+
+    def breakdown(self, column, limit=5):
+        """按频道或分辨率统计占用空间"""
+        if column not in self._groups:
+            raise ValueError(f"不支持的统计字段: {column}")
+        with self._lock:
+            groups = [{'name': name, **group} for name, group in self._groups[column].items()]
+        return heapq.nlargest(limit, groups, key=lambda group: group['size'])
+
+    def reconcile(self, root):
+        """与磁盘上的文件同步，返回重新扫描的文件夹数量（阻塞调用）"""
+        if not os.path.isdir(root):
+            return 0
+        if self.shared:
+            # 工作进程写入时已同步文件夹的修改时间，这些文件夹不会被重新扫描，需要先重新加载汇总
+            self.refresh()
+        
+        known = {row['path']: row['mtime'] for row in self._query("SELECT path, mtime FROM folders")}
+        seen = set()
+        changed = 0
+        with os.scandir(root) as entries:
+            for entry in entries:
+                # 跳过 .ytbot 等隐藏的状态目录
+                if entry.name.startswith('.') or not entry.is_dir():
+                    continue
+                seen.add(entry.path)
+                mtime = entry.stat().st_mtime
+                if known.get(entry.path) != mtime:
+                    self._scan_folder(entry.path, mtime)
+                    changed += 1
+        
+        removed = set(known) - seen
+        if removed:
+            with self._lock:
+                for folder in removed:
+                    self._remove("folder = ?", (folder,))
+                    self._conn.execute("DELETE FROM folders WHERE path = ?", (folder,))
+                self._conn.commit()
+        
+        self.last_reconcile = time.time()
+        if changed or removed:
+            logger.info(f"媒体库索引已同步: 更新 {changed} 个文件夹，移除 {len(removed)} 个文件夹")
+        return changed
+
+    def _scan_folder(self, folder, mtime):
+        files = {}
+        metadata = {}
+        for entry in os.scandir(folder):
+            if not entry.is_file():
+                continue
+            if entry.name.endswith('.nfo'):
+                metadata = read_nfo_metadata(entry.path)
+            elif entry.name.endswith(VIDEO_EXTENSIONS) and not STREAM_FILE_PATTERN.search(entry.name):
+                files[entry.path] = entry.stat()
+        
+        with self._lock:
+            indexed = {row['path'] for row in self._conn.execute(
+                "SELECT path FROM videos WHERE folder = ?", (folder,)
+            )}
+            for path in indexed - set(files):
+                self._remove("path = ?", (path,))
+            for path, stat in files.items():
+                self._upsert(path, stat.st_size, stat.st_mtime, **metadata)
+            self._conn.execute("INSERT OR REPLACE INTO folders (path, mtime) VALUES (?, ?)", (folder, mtime))
+            self._conn.commit()
+
+def read_nfo_metadata(nfo_path):
+    """从机器人生成的NFO文件中读取视频ID、标题和频道"""
+    try:
+        with open(nfo_path, 'r', encoding='utf-8') as f:
+            content = f.read()
+    except OSError:
+        return {}
+    
+    metadata = {}
+    for key, pattern in (('video_id', r'<uniqueid type="YouTube"[^>]*>([^<]+)</uniqueid>'),
+                         ('title', r'<title>([^<]*)</title>'),
+                         ('channel', r'<director>([^<]*)</director>')):
+        match = re.search(pattern, content)
+        if match and match.group(1).strip():
+            metadata[key] = match.group(1).strip()
+    return metadata
+
+library_index = LibraryIndex(LIBRARY_DB_PATH, shared=REMOTE_WORKERS)
+
+BEST_FORMAT_KEY = '最佳质量'
+
+def find_duplicate(video_id, format_key):
+    """检查是否重复下载，返回原因，不重复时返回 None（不访问网络）"""
+    if not video_id or not format_key:
+        return None
+    if library_index.has_video(video_id, format_key):
+        return f"该视频的 {format_key} 版本已下载"
+    if job_store.find_unfinished(video_id, format_key):
+        return f"该视频的 {format_key} 版本已在下载队列中"
+    return None
+
+async def library_watcher():
+    """后台定期同步媒体库索引"""
+    while True:
+        try:
+            await asyncio.to_thread(library_index.reconcile, DOWNLOAD_PATH)
+        except Exception as e:
+            logger.error(f"同步媒体库索引失败: {str(e)}")
+        await asyncio.sleep(LIBRARY_SCAN_INTERVAL)
+
+HDR_TRANSFERS = {'smpte2084': 'hdr10', 'arib-std-b67': 'hlg'}
+
+def summarize_probe(data):
+    """从 ffprobe 的输出中提取需要的媒体流信息"""
+    def number(value, cast=float):
+        try:
+            return cast(value)
+        except (TypeError, ValueError):
+            return None
+
+    def frame_rate(value):
+        num, _, den = (value or '').partition('/')
+        num, den = number(num), number(den or 1)
+        return round(num / den, 3) if num and den else None
+
+    fmt = data.get('format', {})
+    result = {
+        'container': fmt.get('format_name'),
+        'duration': number(fmt.get('duration')),
+        'bitrate': number(fmt.get('bit_rate'), int),
+        'video': [],
+        'audio': [],
+    }
+    for stream in data.get('streams', []):
+        if stream.get('codec_type') == 'video' and not stream.get('disposition', {}).get('attached_pic'):
+            hdr = HDR_TRANSFERS.get(stream.get('color_transfer'))
+            if any(side.get('side_data_type') == 'DOVI configuration record' for side in stream.get('side_data_list', [])):
+                hdr = 'dolbyvision'
+            result['video'].append({
+                'codec': stream.get('codec_name'),
+                'width': stream.get('width'),
+                'height': stream.get('height'),
+                'fps': frame_rate(stream.get('avg_frame_rate')),
+                'bitrate': number(stream.get('bit_rate'), int),
+                'pix_fmt': stream.get('pix_fmt'),
+                'hdr': hdr,
+            })
+        elif stream.get('codec_type') == 'audio':
+            result['audio'].append({
+                'codec': stream.get('codec_name'),
+                'channels': stream.get('channels'),
+                'sample_rate': number(stream.get('sample_rate'), int),
+                'bitrate': number(stream.get('bit_rate'), int),
+                'language': stream.get('tags', {}).get('language'),
+            })
+    return result
+
+class MediaProbeService:
+    """异步读取视频文件的媒体流信息
+    
+    使用 asyncio 子进程运行 ffprobe，不阻塞事件循环，并限制同时运行的数量；
+    结果按 (路径, 大小, 修改时间) 缓存在媒体库索引中，文件未变化时不再重复读取。
+    """
+    def __init__(self, concurrency=2, timeout=120):
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.timeout = timeout
+
+    async def probe(self, path):
+        """返回文件的媒体流信息，读取失败时抛出异常"""
+        stat = os.stat(path)
+        cached = library_index.get_probe(path, stat.st_size, stat.st_mtime)
+        if cached is not None:
+            return cached
+        
+        async with self.semaphore:
+            process = await asyncio.create_subprocess_exec(
+                'ffprobe', '-v', 'quiet', '-print_format', 'json', '-show_streams', '-show_format', path,
+                stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.DEVNULL
+            )
+            try:
+                output, _ = await asyncio.wait_for(process.communicate(), self.timeout)
+            except (asyncio.TimeoutError, asyncio.CancelledError):
+                process.kill()
+                await process.wait()
+                raise
+        if process.returncode != 0:
+            raise Exception(f"ffprobe 返回错误码 {process.returncode}")
+        
+        result = summarize_probe(json.loads(output))
+        library_index.save_probe(path, stat.st_size, stat.st_mtime, result)
+        return result
+
+media_probe = MediaProbeService(PROBE_CONCURRENCY, PROBE_TIMEOUT)
+job_messages = {}  # 任务ID -> 状态消息（仅当前进程内有效）
+
+class StatusMessage:
+    """通过 chat_id 和 message_id 编辑状态消息，用于重启后恢复的任务"""
+    def __init__(self, bot, chat_id, message_id):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.message_id = message_id
+
+    async def edit_text(self, text, **kwargs):
+        await self.bot.edit_message_text(text, chat_id=self.chat_id, message_id=self.message_id, **kwargs)
+        return self
+
+class SilentMessage:
+    """批量任务中的单个视频没有自己的状态消息，编辑操作直接忽略"""
+    chat_id = None
+    message_id = None
+
+    async def edit_text(self, text, **kwargs):
+        return self
+
+def get_job_message(job):
+    """获取任务对应的状态消息"""
+    message = job_messages.get(job['id'])
+    if message is None and telegram_bot is not None and job.get('chat_id') and job.get('message_id'):
+        message = StatusMessage(telegram_bot, job['chat_id'], job['message_id'])
+        job_messages[job['id']] = message
+    return message
+
+class RelayBot:
+    """工作进程中代替 Telegram Bot：状态消息的编辑写入任务数据库，由机器人进程转发"""
+    def __init__(self, store):
+        self.store = store
+
+    async def edit_message_text(self, text, chat_id=None, message_id=None, reply_markup=None, **kwargs):
+        reply_markup = json.dumps(reply_markup.to_dict(), ensure_ascii=False) if reply_markup else None
+        self.store.post_message(chat_id, message_id, text, reply_markup)
+        return True
+
+async def relay_worker_messages(interval=1.0):
+    """机器人进程中运行：把工作进程写入数据库的状态消息编辑转发到 Telegram"""
+    seq = 0
+    since = time.time() - 3600  # 启动时只转发最近一小时内的编辑
+    while True:
+        try:
+            for row in job_store.messages_since(seq, since):
+                seq = row['seq']
+                reply_markup = None
+                if row['reply_markup']:
+                    reply_markup = InlineKeyboardMarkup.de_json(json.loads(row['reply_markup']), telegram_bot)
+                progress_publisher.publish(StatusMessage(telegram_bot, row['chat_id'], row['message_id']),
+                                           row['text'], reply_markup)
+        except Exception as e:
+            logger.error(f"转发工作进程的状态消息出错: {str(e)}")
+        await asyncio.sleep(interval)
+
+def task_keyboard(job_id, paused=False):
+    """状态消息下方的任务控制按钮"""
+    if job_id is None:
+        return None
+    if paused:
+        first = InlineKeyboardButton("▶️ 继续", callback_data=f"task_resume_{job_id}")
+    else:
+        first = InlineKeyboardButton("⏸ 暂停", callback_data=f"task_pause_{job_id}")
+    cancel = InlineKeyboardButton("✖️ 取消", callback_data=f"task_cancel_{job_id}")
+    return InlineKeyboardMarkup([[first, cancel]])
+
+def update_job_state(job_id, state, **fields):
+    """更新持久化队列中的任务状态（不是队列任务时忽略）"""
+    if job_id is None:
+        return
+    try:
+        job_store.set_state(job_id, state, **fields)
+    except Exception as e:
+        logger.error(f"更新任务 {job_id} 状态失败: {str(e)}")
+    if state in JobStore.FINAL_STATES:
+        manifest_store.remove(job_id)
+        metrics.inc('ytbot_jobs_finished_total', state=state)
+
+def find_partial_files(folder):
+    """查找目录中未完成的下载分片文件"""
+    if not folder or not os.path.isdir(folder):
+        return []
+    return [f for f in os.listdir(folder) if f.endswith(('.part', '.ytdl')) or '.part-Frag' in f]
+
+class ManifestStore:
+    """正在下载的任务的清单文件
+    
+    每个任务在 STATE_DIR/manifests 中保存一个JSON文件，记录链接、视频ID、格式选择、
+    输出模板、代理，以及已经开始下载的每个音视频流的临时文件和总大小。
+    进程意外退出后，重启时根据清单检查未完成的文件，并按原来的文件名从已下载的位置继续。
+    """
+    def __init__(self, manifest_dir):
+        self.manifest_dir = manifest_dir
+        self._lock = threading.Lock()
+        self._known = {}  # 任务ID -> 清单中已记录的临时文件名，进度回调不必每次读取清单文件
+        os.makedirs(manifest_dir, exist_ok=True)
+
+    def _path(self, job_id):
+        return os.path.join(self.manifest_dir, f"{job_id}.json")
+
+    def load(self, job_id):
+        try:
+            with open(self._path(job_id), 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _write(self, manifest):
+        manifest['updated_at'] = time.time()
+        tmp_path = self._path(manifest['job_id']) + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(manifest, f, ensure_ascii=False)
+        os.replace(tmp_path, self._path(manifest['job_id']))
+
+    def create(self, job_id, url, video_id, format_spec, outtmpl):
+        manifest = {
+            'job_id': job_id,
+            'url': url,
+            'video_id': video_id,
+            'format': format_spec,
+            'outtmpl': outtmpl,
+            'proxy': None,
+            'streams': [],
+            'created_at': time.time(),
+        }
+        with self._lock:
+            self._write(manifest)
+            self._known[job_id] = set()
+        return manifest
+
+    def update(self, job_id, **fields):
+        with self._lock:
+            manifest = self.load(job_id)
+            if manifest is not None:
+                manifest.update(fields)
+                self._write(manifest)
+
+    def record_stream(self, job_id, d):
+        """进度回调：记录新开始下载的音视频流"""
+        if d.get('status') != 'downloading' or not d.get('tmpfilename'):
+            return
+        with self._lock:
+            known = self._known.get(job_id)
+            if known is None:
+                # 重启后继续的任务：读取一次清单中已有的流
+                manifest = self.load(job_id)
+                if manifest is None:
+                    return
+                known = self._known[job_id] = {s['tmpfilename'] for s in manifest['streams']}
+            if d['tmpfilename'] in known:
+                return
+            # 只有出现新的流时才读写清单文件
+            manifest = self.load(job_id)
+            if manifest is None:
+                return
+            manifest['streams'].append({
+                'format_id': (d.get('info_dict') or {}).get('format_id'),
+                'filename': d['filename'],
+                'tmpfilename': d['tmpfilename'],
+                'total_bytes': d.get('total_bytes') or (d.get('info_dict') or {}).get('filesize'),
+            })
+            self._write(manifest)
+            known.add(d['tmpfilename'])
+
+    def remove(self, job_id):
+        with self._lock:
+            self._known.pop(job_id, None)
+        try:
+            os.remove(self._path(job_id))
+        except FileNotFoundError:
+            pass
+
+    def all(self):
+        manifests = []
+        for name in os.listdir(self.manifest_dir):
+            if name.endswith('.json'):
+                manifest = self.load(name[:-len('.json')])
+                if manifest is not None:
+                    manifests.append(manifest)
+        return manifests
+
+    def verify(self, manifest):
+        """检查清单中记录的未完成文件，删除损坏的文件，返回可以继续下载的字节数"""
+        resumable = 0
+        for stream in manifest['streams']:
+            if os.path.exists(stream['filename']):
+                continue  # 这个流已经下载完成
+            part_path = stream['tmpfilename']
+            state_path = stream['filename'] + '.ytdl'
+            problem = None
+            size = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+            if stream.get('total_bytes') and size > stream['total_bytes']:
+                problem = f"大小 {format_size(size)} 超过预期的 {format_size(stream['total_bytes'])}"
+            elif os.path.exists(state_path):
+                # 分段下载的进度文件损坏时无法确定已下载的分段
+                try:
+                    with open(state_path, 'r', encoding='utf-8') as f:
+                        json.load(f)
+                except (OSError, ValueError):
+                    problem = "分段进度文件已损坏"
+            if problem:
+                logger.warning(f"任务 {manifest['job_id']} 的未完成文件无效（{problem}），将重新下载: {part_path}")
+                for path in [part_path, state_path, *glob.glob(glob.escape(part_path) + '-Frag*')]:
+                    try:
+                        os.remove(path)
+                    except FileNotFoundError:
+                        pass
+            else:
+                fragments = glob.glob(glob.escape(part_path) + '-Frag*')
+                resumable += size + sum(os.path.getsize(path) for path in fragments)
+        return resumable
+
+manifest_store = ManifestStore(os.path.join(STATE_DIR, 'manifests'))
+
+def clean_stale_partials(root, max_age, keep_folders=()):
+    """删除超过 max_age 秒未修改、且不属于未完成任务的未完成文件，返回删除的文件数量（阻塞调用）"""
+    if not max_age or not os.path.isdir(root):
+        return 0
+    removed = 0
+    cutoff = time.time() - max_age
+    with os.scandir(root) as entries:
+        for entry in entries:
+            if entry.name.startswith('.') or not entry.is_dir() or entry.path in keep_folders:
+                continue
+            for filename in find_partial_files(entry.path):
+                path = os.path.join(entry.path, filename)
+                try:
+                    if os.path.getmtime(path) < cutoff:
+                        os.remove(path)
+                        removed += 1
+                except OSError as e:
+                    logger.warning(f"删除过期的未完成文件失败: {str(e)}")
+    return removed
+
+def parse_user_weights(text):
+    """解析 "123456=2,789012=1" 形式的用户权重"""
+    weights = {}
+    for item in text.split(','):
+        if not item.strip():
+            continue
+        user_id, _, weight = item.partition('=')
+        weights[user_id.strip()] = float(weight)
+        if weights[user_id.strip()] <= 0:
+            raise ValueError(f"用户权重必须大于0: {item}")
+    return weights
+
+def today_start():
+    return datetime.datetime.combine(datetime.date.today(), datetime.time.min).timestamp()
+
+class FairQueue:
+    """按用户权重公平分配下载槽位（开始时间公平排队）
+    
+    每个用户有一个虚拟时间，领取该用户的任务后增加 1/权重，调度时选择虚拟时间最小的用户，
+    因此某个用户积压再多任务，其他用户的新任务也只需要等待一个空闲槽位。
+    空闲过的用户从当前的系统虚拟时间开始计算，不能积攒额度。
+    管理员同样参与排队，但不受并发数和配额限制。
+    """
+    def __init__(self, weights, max_concurrent, daily_quota, storage_quota):
+        self.weights = weights
+        self.max_concurrent = max_concurrent
+        self.daily_quota = daily_quota  # 字节，0 表示不限制
+        self.storage_quota = storage_quota
+        self.clock = 0.0
+        self.finish = {}  # 用户ID -> 虚拟时间
+
+    def _start_tag(self, user_id):
+        return max(self.finish.get(user_id, 0.0), self.clock)
+
+    def quota_error(self, user_id):
+        """用户超出配额时返回原因，否则返回 None"""
+        if user_id is None or is_admin(user_id):
+            return None
+        if self.daily_quota and job_store.daily_usage(user_id, today_start()) >= self.daily_quota:
+            return f"今日下载量已达上限 ({format_size(self.daily_quota)})"
+        if self.storage_quota and library_index.user_usage(user_id) >= self.storage_quota:
+            return f"存储空间已达上限 ({format_size(self.storage_quota)})"
+        return None
+
+    def blocked(self, user_id, running):
+        """用户现在不能开始新任务的原因，running 为各用户正在下载的任务数"""
+        if (user_id is not None and not is_admin(user_id) and self.max_concurrent
+                and running.get(user_id, 0) >= self.max_concurrent):
+            return f"同时下载数已达上限 ({self.max_concurrent})"
+        return self.quota_error(user_id)
+
+    def choose(self, heads, running):
+        """从每个用户排在最前的任务中选出下一个任务，并推进该用户的虚拟时间"""
+        candidates = [job for job in heads if not self.blocked(job['user_id'], running)]
+        if not candidates:
+            return None
+        # 交互任务仍然优先于批量任务，同一优先级内按虚拟时间轮流
+        job = min(candidates, key=lambda job: (-job['priority'], self._start_tag(job['user_id']), job['id']))
+        user_id = job['user_id']
+        self.clock = self._start_tag(user_id)
+        self.finish[user_id] = self.clock + 1 / self.weights.get(str(user_id), 1)
+        return job
+
+fair_queue = FairQueue(parse_user_weights(USER_WEIGHTS), USER_MAX_CONCURRENT,
+                       USER_DAILY_QUOTA * 1000 ** 3, USER_STORAGE_QUOTA * 1000 ** 3)  # 与 format_size 一致
+
+class DownloadScheduler:
+    """常驻的下载调度器
+    
+    启动固定数量的工作协程，每个槽位完成任务后立即从队列领取下一个，
+    不必等待同批次的其他任务结束。调整槽位数量时不会中断正在进行的任务。
+    任务由 policy 在各用户之间公平选择。
+    
+    设置 worker_id 后作为独立的工作进程运行：按租约领取任务并定期续约，
+    执行机器人进程通过数据库发来的取消/暂停请求。
+    """
+    def __init__(self, store, size, policy, worker_id=None, lease=WORKER_LEASE_TIMEOUT):
+        self.store = store
+        self.size = size
+        self.policy = policy
+        self.worker_id = worker_id
+        self.lease = lease
+        self.slots = {}  # 槽位编号 -> {'job_id', 'user_id', 'priority', 'started_at'}
+        self._workers = {}  # 槽位编号 -> asyncio.Task
+        self._wakeup = None
+
+    def start(self):
+        """在当前事件循环中启动所有工作协程"""
+        self._wakeup = asyncio.Event()
+        self._workers = {}
+        self.slots = {}
+        self._spawn_workers()
+        if self.worker_id:
+            asyncio.create_task(self._heartbeat())
+        logger.info(f"下载调度器已启动，共 {self.size} 个下载槽位")
+
+    def _spawn_workers(self):
+        for slot in range(self.size):
+            if slot not in self._workers:
+                self._workers[slot] = asyncio.create_task(self._run_slot(slot))
+
+    def notify(self):
+        """有新任务入队时唤醒空闲的工作协程"""
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    def resize(self, size):
+        """调整下载槽位数量，多余的槽位在当前任务完成后退出"""
+        self.size = size
+        if self._wakeup is None:
+            return
+        self._spawn_workers()
+        # 唤醒空闲的槽位，让多余的槽位及时退出
+        self._wakeup.set()
+
+    @property
+    def active_count(self):
+        return len(self.slots)
+
+    def running_by_user(self):
+        if self.worker_id:
+            # 用户的并发上限和公平排队针对所有工作进程
+            return self.store.count_running_by_user()
+        return Counter(info['user_id'] for info in list(self.slots.values()))
+
+    def make_room(self, user_id):
+        """槽位全部被其他用户的批量任务占用时，让其中一个回到队列，交互任务不必等它下载完"""
+        if len(self.slots) < self.size:
+            return
+        running = self.running_by_user()
+        if self.policy.blocked(user_id, running):
+            return
+        candidates = []
+        for info in list(self.slots.values()):
+            handle = task_handles.get(info['job_id'])
+            if handle is None or info['priority'] >= JobStore.PRIORITY_INTERACTIVE or info['user_id'] == user_id:
+                continue
+            if handle.requeue_requested:
+                return  # 已经有任务正在让出槽位
+            candidates.append(info)
+        if not candidates:
+            return
+        # 让出占用槽位最多的用户最晚开始的任务，损失的进度最少；已下载的部分会保留
+        victim = max(candidates, key=lambda info: (running[info['user_id']], info['started_at']))
+        task_handles[victim['job_id']].requeue_requested = True
+        logger.info(f"任务 {victim['job_id']} 让出下载槽位给用户 {user_id} 的交互任务")
+
+    async def _run_slot(self, slot):
+        try:
+            while slot < self.size:
+                job = self.store.claim_next(lambda heads: self.policy.choose(heads, self.running_by_user()),
+                                            worker_id=self.worker_id, lease=self.lease)
+                if job is None:
+                    self._wakeup.clear()
+                    # 因配额暂时不能开始的任务，定期重新检查；工作进程收不到入队通知，需要轮询数据库
+                    try:
+                        await asyncio.wait_for(self._wakeup.wait(), 1 if self.worker_id else 60)
+                    except asyncio.TimeoutError:
+                        pass
+                    continue
+                
+                # 任务最后一次进入等待状态（入队或继续）的时间记录在 updated_at 中
+                metrics.observe('ytbot_queue_wait_seconds', max(time.time() - job['updated_at'], 0),
+                                priority='interactive' if job['priority'] >= JobStore.PRIORITY_INTERACTIVE else 'bulk')
+                handle = TaskHandle(job['id'])
+                handle.slot_released = asyncio.Event()
+                task_handles[job['id']] = handle
+                self.slots[slot] = {'job_id': job['id'], 'user_id': job['user_id'],
+                                    'priority': job['priority'], 'started_at': time.time()}
+                handle.task = asyncio.create_task(start_download(
+                    get_job_message(job),
+                    job['url'],
+                    job['format_id'],
+                    job['title'],
+                    job_id=job['id'],
+                    handle=handle,
+                    format_key=job['format_key'],
+                    user_id=job['user_id']
+                ))
+                handle.task.add_done_callback(lambda task, job_id=job['id']: self._on_task_done(job_id, task))
+                # 任务结束或进入后期处理时释放槽位，领取下一个任务
+                released = asyncio.create_task(handle.slot_released.wait())
+                try:
+                    await asyncio.wait({handle.task, released}, return_when=asyncio.FIRST_COMPLETED)
+                finally:
+                    released.cancel()
+                    self.slots.pop(slot, None)
+        finally:
+            if self._workers.get(slot) is asyncio.current_task():
+                del self._workers[slot]
+
+    async def _heartbeat(self):
+        """定期续约正在运行的任务，执行控制请求，并回收其他工作进程过期的任务"""
+        while True:
+            try:
+                controls = self.store.heartbeat(self.worker_id, list(task_handles), self.lease)
+                for job_id, action in controls.items():
+                    handle = task_handles.get(job_id)
+                    if handle is None:
+                        continue
+                    logger.info(f"任务 {job_id} 收到{'取消' if action == 'cancel' else '暂停'}请求")
+                    if action == 'cancel':
+                        handle.cancel_requested = True
+                        job = self.store.get(job_id)
+                        if job and job['state'] == 'extracting' and handle.task is not None:
+                            handle.task.cancel()
+                    elif action == 'pause':
+                        handle.pause_requested = True
+                expired = self.store.requeue_expired()
+                if expired:
+                    logger.warning(f"{expired} 个任务的工作进程已失联，任务已重新排队")
+            except Exception as e:
+                logger.error(f"工作进程心跳失败: {str(e)}")
+            await asyncio.sleep(min(self.lease / 3, 5))
+
+    async def drain(self, timeout=30):
+        """停止领取新任务，让正在运行的任务停止并重新排队，已下载的部分由下一个工作进程继续"""
+        self.size = 0
+        if self._wakeup is not None:
+            self._wakeup.set()
+        handles = list(task_handles.values())
+        for handle in handles:
+            handle.requeue_requested = True
+        tasks = [handle.task for handle in handles if handle.task is not None]
+        if tasks:
+            await asyncio.wait(tasks, timeout=timeout)
+        if self.worker_id:
+            released = self.store.release_worker(self.worker_id)
+            if released:
+                logger.info(f"已将 {released} 个未完成的任务放回队列")
+
+    def _on_task_done(self, job_id, task):
+        # 让出槽位的任务可能已经被另一个槽位重新领取，只移除属于自己的句柄
+        handle = task_handles.get(job_id)
+        if handle is not None and handle.task is task:
+            del task_handles[job_id]
+        if task.cancelled() or task.exception() is None:
+            return
+        logger.error(f"处理任务 {job_id} 出错: {str(task.exception())}")
+        update_job_state(job_id, 'failed', error=str(task.exception()))
+
+download_scheduler = DownloadScheduler(job_store, MAX_CONCURRENT_DOWNLOADS, fair_queue)
+
+class ConcurrencyController:
+    """自动调整同时下载数量（AIMD）
+    
+    定期采样下载总速度、CPU 与 ffmpeg 负载、磁盘写入延迟和限流(429)次数：
+    出现限流或资源过载时槽位数减半；队列有积压且槽位全部占满时每次增加一个，
+    增加后总速度没有明显提高则退回并暂停试探一段时间。每次调整都会写入日志。
+    """
+    CPU_HIGH = 85  # CPU/ffmpeg 负载上限(%)
+    DISK_LATENCY_HIGH = 200  # 平均每次写入耗时上限(毫秒)
+    PLATEAU_COOLDOWN = 10  # 增加槽位无效后暂停试探的检查次数
+
+    def __init__(self, scheduler, min_size, max_size, interval, auto=False):
+        self.scheduler = scheduler
+        self.min_size = max(min_size, 1)
+        self.max_size = max(max_size, self.min_size)
+        self.interval = interval
+        self.auto = auto
+        self.last_signals = {}
+        self._bytes = 0
+        self._throttled = 0
+        self._lock = threading.Lock()
+        self._probe = None  # 上次增加槽位前的总速度
+        self._cooldown = 0
+        self._disk_io = None
+        self._ffmpeg_procs = {}  # pid -> psutil.Process，用于计算两次采样之间的CPU占用
+
+    def add_bytes(self, amount):
+        """下载线程报告新下载的字节数"""
+        with self._lock:
+            self._bytes += amount
+
+    def report_throttle(self):
+        """下载过程中遇到 429 等限流响应"""
+        with self._lock:
+            self._throttled += 1
+
+    def start(self):
+        asyncio.create_task(self._run())
+
+    async def _run(self):
+        import psutil  # 延迟导入，不占用启动时间
+        psutil.cpu_percent(interval=None)  # 第一次调用只用于建立基准
+        self._disk_io = psutil.disk_io_counters()
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                self._tick()
+            except Exception as e:
+                logger.error(f"自动并发调整出错: {str(e)}")
+
+    def _sample(self):
+        import psutil
+        with self._lock:
+            nbytes, self._bytes = self._bytes, 0
+            throttled, self._throttled = self._throttled, 0
+        
+        disk_latency = 0
+        disk_io = psutil.disk_io_counters()
+        if disk_io and self._disk_io:
+            writes = disk_io.write_count - self._disk_io.write_count
+            if writes > 0:
+                disk_latency = (disk_io.write_time - self._disk_io.write_time) / writes
+        self._disk_io = disk_io
+        
+        return {
+            'throughput': nbytes / self.interval,
+            'cpu': psutil.cpu_percent(interval=None),
+            'ffmpeg': self._ffmpeg_load(),
+            'disk_latency': disk_latency,
+            'throttled': throttled,
+        }
+
+    def _ffmpeg_load(self):
+        """ffmpeg 子进程占用的CPU（按全部核心折算的百分比）"""
+        import psutil
+        load = 0
+        procs = {}
+        for child in psutil.Process().children(recursive=True):
+            try:
+                if not child.name().startswith(('ffmpeg', 'ffprobe')):
+                    continue
+                proc = self._ffmpeg_procs.get(child.pid, child)
+                load += proc.cpu_percent(interval=None)
+                procs[child.pid] = proc
+            except (psutil.NoSuchProcess, psutil.AccessDenied):
+                continue
+        self._ffmpeg_procs = procs
+        return load / (psutil.cpu_count() or 1)
+
+    def _tick(self):
+        signals = self.last_signals = self._sample()
+        if not self.auto:
+            return
+        
+        size = self.scheduler.size
+        new_size = size
+        reasons = []
+        if signals['throttled']:
+            reasons.append(f"收到 {signals['throttled']} 次限流响应")
+        if signals['cpu'] >= self.CPU_HIGH or signals['ffmpeg'] >= self.CPU_HIGH:
+            reasons.append(f"CPU {signals['cpu']:.0f}% / ffmpeg {signals['ffmpeg']:.0f}%")
+        if signals['disk_latency'] >= self.DISK_LATENCY_HIGH:
+            reasons.append(f"磁盘写入延迟 {signals['disk_latency']:.0f}ms")
+        
+        if reasons:
+            new_size = max(self.min_size, size // 2)
+            self._probe = None
+            self._cooldown = 2
+        elif self._cooldown > 0:
+            self._cooldown -= 1
+        elif self._probe is not None:
+            # 上次增加了槽位，检查总速度是否随之提高
+            if signals['throughput'] < self._probe * 1.05:
+                new_size = max(self.min_size, size - 1)
+                reasons.append("增加槽位后总速度没有提高")
+                self._cooldown = self.PLATEAU_COOLDOWN
+            self._probe = None
+        elif (size < self.max_size and self.scheduler.active_count >= size
+              and self.scheduler.store.count('queued')):
+            new_size = size + 1
+            reasons.append("队列有积压且资源充足")
+            self._probe = signals['throughput']
+        
+        if new_size != size:
+            logger.info(
+                f"自动并发: {size} -> {new_size} ({'; '.join(reasons)}) | "
+                f"速度 {format_size(signals['throughput'])}/s, CPU {signals['cpu']:.0f}%, "
+                f"ffmpeg {signals['ffmpeg']:.0f}%, 磁盘延迟 {signals['disk_latency']:.0f}ms"
+            )
+            self.scheduler.resize(new_size)
+
+concurrency_controller = ConcurrencyController(
+    download_scheduler, CONCURRENCY_MIN, CONCURRENCY_MAX, CONCURRENCY_INTERVAL, AUTO_CONCURRENCY)
+
+def remove_partial_files(folder, prefix):
+    """删除被取消任务留下的未完成文件和未合并的单独音视频流"""
+    if not prefix or not folder or not os.path.isdir(folder):
+        return
+    partial_files = set(find_partial_files(folder))
+    for filename in os.listdir(folder):
+        if not filename.startswith(prefix):
+            continue
+        if filename in partial_files or STREAM_FILE_PATTERN.search(filename):
+            try:
+                os.remove(os.path.join(folder, filename))
+            except OSError as e:
+                logger.warning(f"删除未完成文件失败: {str(e)}")
+
+class TokenBucket:
+    """令牌桶限流器（线程安全）"""
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(rate, 1)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def try_consume(self, amount=1):
+        """令牌足够时扣除并返回 True，否则返回 False"""
+        with self._lock:
+            self._refill()
+            if self.tokens >= amount:
+                self.tokens -= amount
+                return True
+            return False
+
+    def consume(self, amount):
+        """扣除令牌（允许透支），返回需要等待的秒数"""
+        with self._lock:
+            self._refill()
+            self.tokens -= amount
+            return -self.tokens / self.rate if self.tokens < 0 else 0
+
+    def refund(self, amount=1):
+        """退还没有用上的令牌"""
+        with self._lock:
+            self.tokens = min(self.capacity, self.tokens + amount)
+
+    @property
+    def full(self):
+        """令牌已满，与新建的令牌桶没有区别"""
+        with self._lock:
+            self._refill()
+            return self.tokens >= self.capacity
+
+    def set_rate(self, rate, capacity=None):
+        with self._lock:
+            self._refill()
+            self.rate = rate
+            self.capacity = capacity if capacity is not None else max(rate, 1)
+            self.tokens = min(self.tokens, self.capacity)
+
+class ProgressPublisher:
+    """限速、合并的 Telegram 进度消息编辑器
+    
+    下载线程通过 publish() 提交进度，每条消息只保留最新内容；
+    事件循环中的后台任务按消息间隔、单个聊天和全局的发送预算进行编辑，
+    内容没有变化时跳过，避免触发 Telegram 的频率限制。
+    """
+    PRIVATE_CHAT_RATE = 1.0  # 私聊每秒最多1条
+    GROUP_CHAT_RATE = 20 / 60  # 群组每分钟最多20条
+    PRUNE_INTERVAL = 60  # 清理闲置记录的间隔(秒)
+    IDLE_TTL = 3600  # 超过此时间(秒)没有编辑的消息不再保留发送记录
+
+    def __init__(self, interval=3.0, global_rate=20.0):
+        self.interval = interval
+        self._global_budget = TokenBucket(global_rate)
+        self._chat_budgets = {}  # chat_id -> TokenBucket
+        self._pending = {}  # (chat_id, message_id) -> (message, text, reply_markup)
+        self._last_sent = {}  # (chat_id, message_id) -> (发送时间, 文本)
+        self._edit_locks = {}  # (chat_id, message_id) -> asyncio.Lock
+        self._lock = threading.Lock()
+        self._paused_until = 0
+        self._pruned_at = time.monotonic()
+        self._task = None
+
+    @staticmethod
+    def _key(message):
+        return (message.chat_id, message.message_id)
+
+    def publish(self, message, text, reply_markup=None):
+        """提交消息的最新内容，可以在任意线程中调用"""
+        with self._lock:
+            self._pending[self._key(message)] = (message, text, reply_markup)
+
+    async def close(self, message):
+        """丢弃尚未发送的进度并等待正在进行的编辑完成，之后可以安全地发送最终状态"""
+        key = self._key(message)
+        with self._lock:
+            self._pending.pop(key, None)
+        lock = self._edit_locks.pop(key, None)
+        if lock is not None:
+            async with lock:
+                pass
+        self._last_sent.pop(key, None)
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    def _chat_budget(self, chat_id):
+        budget = self._chat_budgets.get(chat_id)
+        if budget is None:
+            # 群组的 chat_id 为负数
+            rate = self.GROUP_CHAT_RATE if chat_id < 0 else self.PRIVATE_CHAT_RATE
+            budget = self._chat_budgets[chat_id] = TokenBucket(rate, capacity=1)
+        return budget
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(0.5)
+            try:
+                await self._flush()
+                if time.monotonic() - self._pruned_at > self.PRUNE_INTERVAL:
+                    self._prune()
+            except Exception as e:
+                logger.error(f"更新进度消息出错: {str(e)}")
+
+    def _prune(self):
+        """清理没有调用 close() 的消息（例如任务异常退出）留下的记录，以及闲置聊天的令牌桶"""
+        now = time.monotonic()
+        self._pruned_at = now
+        with self._lock:
+            pending = set(self._pending)
+        for key, (sent_at, _) in list(self._last_sent.items()):
+            if key not in pending and now - sent_at > self.IDLE_TTL:
+                del self._last_sent[key]
+        for key, lock in list(self._edit_locks.items()):
+            if key not in pending and key not in self._last_sent and not lock.locked():
+                del self._edit_locks[key]
+        active_chats = {chat_id for chat_id, _ in pending}
+        for chat_id, budget in list(self._chat_budgets.items()):
+            if chat_id not in active_chats and budget.full:
+                del self._chat_budgets[chat_id]
+
+    async def _flush(self):
+        if time.monotonic() < self._paused_until:
+            return
+        
+        with self._lock:
+            keys = list(self._pending)
+        # 最久没有更新的消息优先，保证同一聊天中的多个任务轮流更新
+        keys.sort(key=lambda k: self._last_sent.get(k, (0, None))[0])
+        
+        for key in keys:
+            now = time.monotonic()
+            with self._lock:
+                entry = self._pending.get(key)
+                if entry is None:
+                    continue
+                last = self._last_sent.get(key)
+                if last is not None and last[1] == entry[1]:
+                    # 内容没有变化，不需要编辑
+                    del self._pending[key]
+                    continue
+            if last is not None and now - last[0] < self.interval:
+                continue
+            chat_budget = self._chat_budget(key[0])
+            if not chat_budget.try_consume():
+                continue
+            if not self._global_budget.try_consume():
+                chat_budget.refund()
+                break
+            
+            with self._lock:
+                entry = self._pending.pop(key, None)
+            if entry is None:
+                # 期间已被 close() 取走
+                chat_budget.refund()
+                self._global_budget.refund()
+                continue
+            message, text, reply_markup = entry
+            
+            lock = self._edit_locks.setdefault(key, asyncio.Lock())
+            async with lock:
+                try:
+                    await message.edit_text(text, reply_markup=reply_markup)
+                except RetryAfter as e:
+                    # 被限流时暂停所有编辑，并把这条内容放回队列
+                    logger.warning(f"编辑进度消息被限流，暂停 {e.retry_after} 秒")
+                    self._paused_until = time.monotonic() + e.retry_after
+                    with self._lock:
+                        self._pending.setdefault(key, entry)
+                    return
+                except BadRequest as e:
+                    if 'not modified' not in str(e).lower():
+                        logger.debug(f"编辑进度消息失败: {str(e)}")
+                except (NetworkError, TimedOut) as e:
+                    logger.debug(f"编辑进度消息失败: {str(e)}")
+                self._last_sent[key] = (time.monotonic(), text)
+
+progress_publisher = ProgressPublisher(PROGRESS_EDIT_INTERVAL, PROGRESS_GLOBAL_RATE)
+
+COLLECTION_URL_PATTERN = re.compile(
+    r'youtube\.com/(?:playlist\?(?:[^#]*&)?list=[\w-]+'
+    r'|(?:@[\w.-]+|channel/UC[\w-]{22}|c/[^/?#]+|user/[^/?#]+)(?:/(?:videos|shorts|streams))?/?(?:[?#]|$))'
+)
+
+def is_collection_url(url):
+    """是否为播放列表或频道链接"""
+    return bool(COLLECTION_URL_PATTERN.search(url))
+
+def normalize_collection_url(url):
+    """频道首页链接默认展开"视频"标签页，而不是所有标签页"""
+    if 'playlist?' in url:
+        return url
+    path = url.split('?')[0].split('#')[0].rstrip('/')
+    if not path.endswith(('/videos', '/shorts', '/streams')):
+        return f"{path}/videos"
+    return path
+
+def is_valid_url(url: str) -> bool:
+    """检查URL是否为支持的格式"""
+    try:
+        # 检查是否包含支持的域名
+        if not any(site in url.lower() for site in SUPPORTED_URLS):
+            return False
+            
+        # 检查是否是完整的YouTube链接
+        if 'youtube.com/watch?v=' in url:
+            video_id = url.split('watch?v=')[1].split('&')[0]
+            return len(video_id) == 11  # YouTube视频ID通常是11个字符
+        elif 'youtu.be/' in url:
+            video_id = url.split('youtu.be/')[1].split('?')[0]
+            return len(video_id) == 11
+        elif 'youtube.com/shorts/' in url:  # 添加对 Shorts 的支持
+            video_id = url.split('shorts/')[1].split('?')[0]
+            return len(video_id) == 11
+        elif is_collection_url(url):  # 播放列表和频道
+            return True
+            
+        return False
+        
+    except Exception:
+        return False
+
+def is_admin(user_id):
+    return str(user_id) == str(ADMIN_USER_ID)
+
+def has_access(user_id, chat_id):
+    """管理员、允许的用户，以及允许的群组中的成员可以使用机器人"""
+    return is_admin(user_id) or str(user_id) in ALLOWED_USERS or str(chat_id) in ALLOWED_USERS
+
+async def check_admin(update: Update) -> bool:
+    """检查用户是否是管理员"""
+    user_id = update.effective_user.id
+    if not is_admin(user_id):
+        await update.message.reply_text("⛔️ 抱歉，你没有使用此机器人的权限。")
+        return False
+    return True
+
+async def check_access(update: Update) -> bool:
+    """检查用户是否可以下载视频"""
+    if not has_access(update.effective_user.id, update.effective_chat.id):
+        await update.message.reply_text("⛔️ 抱歉，你没有使用此机器人的权限。")
+        return False
+    return True
+
+async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """处理 /start 命令"""
+    logger.info(f"收到 /start 命令 from user {update.effective_user.id}")
+    
+    if not await check_access(update):
+        logger.warning(f"未授权用户 {update.effective_user.id} 尝试使用机器人")
+        return
+        
+    try:
+        await update.message.reply_text(
+            "👋 你好! 我是一个YouTube视频下载机器人。\n"
+            "只需要发送YouTube视频链接给我，我就会帮你下载视频。\n"
+            "支持的链接格式: youtube.com"
+        )
+        logger.info(f"成功响应 /start 命令 to user {update.effective_user.id}")
+    except Exception as e:
+        logger.error(f"处理 /start 命令时出错: {str(e)}")
+        raise
+
+async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """处理 /help 命令"""
+    logger.info(f"收到 /help 命令 from user {update.effective_user.id}")
+    
+    if not await check_access(update):
+        return
+        
+    proxy_count = len(download_proxy_pool.proxies)
+    proxy_status = f'已启用 ✅ ({proxy_count} 个)' if proxy_count else '未启用 ❌'
+    proxy_address = ', '.join(proxy.label for proxy in download_proxy_pool.proxies) or 'N/A'
+    if not is_admin(update.effective_user.id):
+        proxy_address = '仅管理员可见'
+    
+    quality_mode = "手动选择" if enable_quality_selection else "自动最高质量"
+    
+    help_text = f"""
+📖 使用说明
+
+🤖 基本命令:
+/start - 启动机器人
+/help - 显示此帮助信息
+/queue - 查看下载队列和自己的配额
+/status - 显示机器人状态（管理员）
+/bandwidth - 查看或设置带宽限制（管理员）
+/profile 30s - 采样分析性能（管理员）
+
+📥 下载视频:
+1. 直接发送YouTube视频链接给我
+2. {quality_mode}下载质量
+3. 等待下载完成
+
+🔗 支持的链接格式:
+- https://www.youtube.com/watch?v=...
+- https://www.youtube.com/playlist?list=... (批量下载)
+- https://www.youtube.com/@频道名 (批量下载)
+
+📁 下载内容:
+- 视频文件 ({quality_mode})
+- NFO元数据文件 (用于Emby/Plex)
+- 视频封面图片
+
+💾 保存位置:
+{DOWNLOAD_PATH}
+
+⚙️ 其他信息:
+- 代理状态: {proxy_status}
+- 代理地址: {proxy_address}
+- 质量选择: {quality_mode}
+"""
+
+    await update.message.reply_text(help_text)
+    logger.info(f"成功响应 /help 命令 to user {update.effective_user.id}")
+
+async def status_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """处理 /status 命令"""
+    logger.info(f"收到 /status 命令 from user {update.effective_user.id}")
+    
+    if not await check_admin(update):
+        return
+
+    # 检查下载目录
+    if not os.path.exists(DOWNLOAD_PATH):
+        status_text = "❌ 下载目录不存在！"
+    else:
+        # 从媒体库索引中查询，不再遍历下载目录
+        if library_index.shared:
+            await asyncio.to_thread(library_index.refresh)
+        summary = library_index.summary()
+        by_channel = library_index.breakdown('channel')
+        by_resolution = library_index.breakdown('resolution')
+        
+        channel_lines = "\n".join(
+            f"  {row['name']}: {row['videos']} 个, {format_size(row['size'])}" for row in by_channel
+        ) or "  暂无"
+        resolution_lines = "\n".join(
+            f"  {row['name']}: {row['videos']} 个, {format_size(row['size'])}" for row in by_resolution
+        ) or "  暂无"
+        if library_index.last_reconcile:
+            synced_at = datetime.datetime.fromtimestamp(library_index.last_reconcile).strftime('%H:%M:%S')
+        else:
+            synced_at = "同步中..."
+        
+        extract_proxy_text = (
+            f"🔍 提取代理:\n{extract_proxy_pool.describe()}\n"
+            if extract_proxy_pool is not download_proxy_pool else ""
+        )
+        
+        status_text = f"""
+📊 机器人状态
+
+🎥 已下载视频: {summary['videos']} 个
+💾 总占用空间: {summary['size'] / (1024*1024*1024):.2f} GB
+
+📺 按频道:
+{channel_lines}
+
+🎞 按分辨率:
+{resolution_lines}
+
+📁 下载目录: {DOWNLOAD_PATH}
+🔄 索引同步时间: {synced_at}
+🌐 下载代理:
+{download_proxy_pool.describe()}
+{extract_proxy_text}
+
+⚡️ 机器人运行正常
+"""
+    
+    await update.message.reply_text(status_text)
+    logger.info(f"成功响应 /status 命令 to user {update.effective_user.id}")
+
+async def list_formats(url, status_message=None):
+    """获取视频可用的格式列表"""
+    logger.info(f"开始获取视频格式列表: {url}")
+    
+    # 更新状态消息
+    if status_message:
+        await status_message.edit_text("🔍 正在获取视频信息...")
+    
+    try:
+        try:
+            info = await extraction_service.get_info(url)
+        except yt_dlp.utils.DownloadError as e:
+            error_msg = str(e).lower()
+            if "account associated with this video has been terminated" in error_msg:
+                logger.error(f"YouTube账号已被终止: {error_msg}")
+                raise Exception("此视频不可用，因为关联的YouTube账号已被终止")
+            elif "private video" in error_msg:
+                logger.error(f"私有视频: {error_msg}")
+                raise Exception("这是一个私有视频，需要登录才能查看")
+            elif "unavailable" in error_msg or "not available" in error_msg:
+                logger.error(f"视频不可用: {error_msg}")
+                raise Exception("此视频目前不可用或已被删除")
+            elif "copyright" in error_msg:
+                logger.error(f"版权限制: {error_msg}")
+                raise Exception("此视频因版权问题不可用")
+            elif "sign in" in error_msg or "login" in error_msg:
+                logger.error(f"需要登录: {error_msg}")
+                raise Exception("此视频需要登录才能查看")
+            elif "removed" in error_msg:
+                logger.error(f"视频已被移除: {error_msg}")
+                raise Exception("此视频已被作者或YouTube移除")
+            elif "uploader has not made this video available" in error_msg:
+                logger.error(f"上传者未公开视频: {error_msg}")
+                raise Exception("上传者未公开此视频，目前无法访问")
+            else:
+                logger.error(f"获取视频信息失败: {error_msg}")
+                raise Exception(f"获取视频信息失败: {e}")
+            
+        title = info.get('title', '未知标题')
+        logger.info(f"成功获取视频信息: {title}")
+        
+        # 使用更完善的方式处理格式
+        all_formats = []
+        
+        try:
+            if 'formats' in info:
+                # 从所有格式中筛选视频格式
+                video_formats = [f for f in info['formats'] if f.get('vcodec') != 'none' and f.get('height')]
+                
+                # 创建分辨率映射以实现更好的去重
+                format_dict = {}
+                
+                for f in video_formats:
+                    height = f.get('height', 0)
+                    width = f.get('width', 0)
+                    fps = f.get('fps', 0)
+                    tbr = f.get('tbr', 0) or 0
+                    
+                    # 检测特殊标记
+                    is_hdr = 'hdr' in f.get('format_note', '').lower() or 'hdr' in f.get('format', '').lower()
+                    is_high_fps = fps and fps > 30
+                    
+                    # 创建标准化的分辨率标签
+                    if height >= 4320:  # 8K
+                        base_label = '4320p'
+                    elif height >= 2160:  # 4K
+                        base_label = '2160p'
+                    elif height >= 1440:  # 2K/QHD
+                        base_label = '1440p'
+                    elif height >= 1080:  # Full HD
+                        base_label = '1080p'
+                    elif height >= 720:   # HD
+                        base_label = '720p'
+                    elif height >= 480:   # SD
+                        base_label = '480p'
+                    elif height >= 360:   # 低清
+                        base_label = '360p'
+                    elif height >= 240:   # 超低清
+                        base_label = '240p'
+                    elif height >= 144:   # 最低清
+                        base_label = '144p'
+                    else:
+                        base_label = f"{height}p"
+                    
+                    # 添加帧率和HDR标记
+                    label = base_label
+                    if is_high_fps:
+                        label = f"{base_label}60"
+                    if is_hdr:
+                        label = f"{label} HDR"
+                    
+                    # 计算分辨率质量得分，用于选择每个分辨率的最佳版本
+                    # 优先考虑有音频的格式
+                    has_audio = f.get('acodec') != 'none'
+                    quality_score = (tbr * 100) + (50000 if has_audio else 0)
+                    # 帧率和HDR相同时优先选择 mp4 封装的版本，下载后无需转封装
+                    rank = (bool(is_high_fps), is_hdr, f.get('ext') == 'mp4', quality_score)
+                    
+                    # 确保相同分辨率只保留质量最高的版本
+                    key = base_label  # 使用基础分辨率作为键，确保每个分辨率只有一个版本
+                    
+                    if key not in format_dict or rank > format_dict[key]['rank']:
+                        format_dict[key] = {
+                            'format_id': f.get('format_id', ''),
+                            'key': label,  # 显示带fps/HDR的完整标签
+                            'base_key': base_label,  # 存储基础分辨率，用于去重
+                            'height': height,
+                            'width': width,
+                            'fps': fps,
+                            'quality_score': quality_score,
+                            'rank': rank,
+                            'filesize_mb': 0,
+                            'url': url,
+                            'title': title
+                        }
+                
+                # 转换为列表
+                all_formats = list(format_dict.values())
+                
+                # 确保格式列表不为空
+                if not all_formats:
+                    logger.warning("没有找到视频格式，将使用备选方案")
+                    raise Exception("没有找到视频格式")
+        except Exception as e:
+            logger.warning(f"解析formats时出错: {str(e)}")
+            all_formats = []
+        
+        # 如果上面的处理失败或没有找到格式，使用备选方案
+        if not all_formats:
+            logger.info("使用备选分辨率选项")
+            
+            # 为各种视频提供全面的分辨率选项
+            default_formats = [
+                {"key": "4320p", "base_key": "4320p", "format_id": "bestvideo[height>=4320]+bestaudio/best", "height": 4320},
+                {"key": "2160p", "base_key": "2160p", "format_id": "bestvideo[height>=2160]+bestaudio/best", "height": 2160},
+                {"key": "1440p", "base_key": "1440p", "format_id": "bestvideo[height>=1440]+bestaudio/best", "height": 1440},
+                {"key": "1080p60", "base_key": "1080p", "format_id": "bestvideo[height>=1080][fps>30]+bestaudio/best", "height": 1080},
+                {"key": "1080p", "base_key": "1080p", "format_id": "bestvideo[height>=1080]+bestaudio/best", "height": 1080},
+                {"key": "720p60", "base_key": "720p", "format_id": "bestvideo[height>=720][fps>30]+bestaudio/best", "height": 720},
+                {"key": "720p", "base_key": "720p", "format_id": "bestvideo[height>=720]+bestaudio/best", "height": 720},
+                {"key": "480p", "base_key": "480p", "format_id": "bestvideo[height>=480]+bestaudio/best", "height": 480},
+                {"key": "360p", "base_key": "360p", "format_id": "bestvideo[height>=360]+bestaudio/best", "height": 360},
+                {"key": "240p", "base_key": "240p", "format_id": "bestvideo[height>=240]+bestaudio/best", "height": 240},
+                {"key": "144p", "base_key": "144p", "format_id": "bestvideo[height>=144]+bestaudio/best", "height": 144},
+            ]
+            
+            # 添加其他必要信息
+            for fmt in default_formats:
+                fmt.update({
+                    'url': url,
+                    'title': title,
+                    'quality_score': fmt['height'] * 10
+                })
+            
+            all_formats = default_formats
+        
+        # 按分辨率排序
+        all_formats.sort(key=lambda x: x.get('height', 0), reverse=True)
+        
+        # 限制数量，同时确保保留最常用的分辨率
+        if len(all_formats) > 8:
+            # 确保保留最高和最低的几个分辨率选项
+            high_res = all_formats[:3]  # 保留最高的3个
+            low_res = all_formats[-3:]  # 保留最低的3个
+            mid_res = all_formats[3:-3]  # 中间的分辨率
+            
+            # 如果中间分辨率过多，进行筛选
+            if len(mid_res) > 2:
+                # 优先保留1080p和720p
+                priority_res = []
+                remaining_res = []
+                
+                for fmt in mid_res:
+                    base_key = fmt.get('base_key', '')
+                    if base_key in ['1080p', '720p']:
+                        priority_res.append(fmt)
+                    else:
+                        remaining_res.append(fmt)
+                
+                # 选择中间范围的分辨率
+                if len(remaining_res) > 0:
+                    # 选择一个中间分辨率，优先选择480p
+                    middle_choice = None
+                    for fmt in remaining_res:
+                        if fmt.get('base_key') == '480p':
+                            middle_choice = fmt
+                            break
+                    
+                    # 如果没有480p，选择列表中间的一项
+                    if not middle_choice and remaining_res:
+                        middle_index = len(remaining_res) // 2
+                        middle_choice = remaining_res[middle_index]
+                    
+                    if middle_choice:
+                        priority_res.append(middle_choice)
+                
+                # 最终的中间分辨率选择
+                mid_res = priority_res
+            
+            # 合并最终结果
+            all_formats = high_res + mid_res + low_res
+        
+        # 始终添加"最佳质量"选项在最前面
+        all_formats.insert(0, {
+            'format_id': 'best',
+            'key': '最佳质量',
+            'base_key': 'best',
+            'height': 9999,  # 用于排序
+            'quality_score': 999999,
+            'url': url,
+            'title': title
+        })
+        
+        # 转为格式化后的列表返回
+        formatted_formats = []
+        for i, fmt in enumerate(all_formats):
+            formatted_formats.append({
+                'id': i,
+                'key': fmt['key'],
+                'format_id': fmt['format_id'],
+                'url': url,
+                'title': title
+            })
+        
+        logger.info(f"找到 {len(formatted_formats)} 种视频格式")
+        return formatted_formats
+        
+    except asyncio.TimeoutError:
+        # 交给调用方处理超时重试
+        raise
+    except Exception as e:
+        logger.error(f"获取视频格式失败: {str(e)}")
+        raise Exception(f"获取视频信息失败: {str(e)}")
+
+async def add_to_queue(message, url, format_id, title, priority=JobStore.PRIORITY_INTERACTIVE,
+                       format_key=None, user_id=None):
+    """添加下载任务到队列"""
+    job_id = job_store.enqueue(
+        url, format_id, title,
+        chat_id=message.chat_id,
+        message_id=message.message_id,
+        priority=priority,
+        format_key=format_key,
+        user_id=user_id
+    )
+    job_messages[job_id] = message
+    queue_position = job_store.queue_position(job_id)
+    
+    # 显示队列位置
+    await message.edit_text(
+        f"⏳ 已加入下载队列\n\n"
+        f"📹 {title}\n"
         f"📊 队列位置: {queue_position}\n"
-        f"⌛️ 等待下载..."
+        f"⌛️ 等待下载...",
+        reply_markup=task_keyboard(job_id)
+    )
+    
+    # 唤醒空闲的下载槽位；槽位都被其他用户的批量任务占用时让出一个
+    download_scheduler.notify()
+    if priority >= JobStore.PRIORITY_INTERACTIVE:
+        download_scheduler.make_room(user_id)
+
+async def on_startup(application: Application):
+    """Application 初始化完成后启动后台服务"""
+    global telegram_bot
+    telegram_bot = application.bot
+    
+    progress_publisher.start()
+    await recover_download_queue()
+    if REMOTE_WORKERS:
+        # 下载由工作进程完成，这里只转发它们的状态消息
+        asyncio.create_task(relay_worker_messages())
+    else:
+        postprocess_service.start()
+        await recover_partial_downloads()
+        download_scheduler.start()
+        concurrency_controller.start()
+        asyncio.create_task(bandwidth_governor.run())
+    for pool in {download_proxy_pool, extract_proxy_pool}:
+        if pool.proxies:
+            asyncio.create_task(pool.run())
+    asyncio.create_task(library_watcher())
+    if METRICS_PORT:
+        try:
+            await serve_metrics(METRICS_HOST, METRICS_PORT)
+        except OSError as e:
+            logger.error(f"指标接口启动失败: {str(e)}")
+
+async def recover_download_queue():
+    """启动时恢复上次未完成的下载任务"""
+    job_store.purge_finished()
+    jobs = job_store.recover()
+    
+    # 恢复批量任务的汇总消息
+    for batch_id in job_store.unfinished_batches():
+        chat_id, message_id = batch_id.split(':')
+        summary_message = StatusMessage(telegram_bot, int(chat_id), int(message_id))
+        batch = {'title': '批量下载 (已恢复)', 'found': 0, 'queued': 0, 'skipped': 0, 'expanded': True}
+        asyncio.create_task(track_batch(batch_id, summary_message, batch))
+    
+    if not jobs:
+        return
+    
+    logger.info(f"🔄 恢复 {len(jobs)} 个未完成的下载任务")
+    for job in jobs:
+        message = get_job_message(job)
+        if message is None:
+            continue
+        try:
+            await message.edit_text(
+                f"🔄 机器人已重启，任务已恢复\n\n"
+                f"📹 {job['title'] or job['url']}\n"
+                f"📊 队列位置: {job_store.queue_position(job['id'])}\n"
+                f"⌛️ 等待下载...",
+                reply_markup=task_keyboard(job['id'])
+            )
+        except Exception as e:
+            logger.warning(f"更新恢复任务的状态消息失败: {str(e)}")
+
+async def recover_partial_downloads():
+    """检查未完成任务已下载的部分，清理无人认领的过期未完成文件（在执行下载的进程中运行）"""
+    jobs = job_store.list_unfinished()
+    
+    # 已结束或已删除的任务不再需要清单；其余任务的文件夹中的未完成文件不会被当作过期文件清理
+    manifests = {}
+    keep_folders = set()
+    for manifest in manifest_store.all():
+        job = job_store.get(manifest['job_id'])
+        if job is None or job['state'] in JobStore.FINAL_STATES:
+            manifest_store.remove(manifest['job_id'])
+        else:
+            manifests[job['id']] = manifest
+            keep_folders.add(os.path.dirname(manifest['outtmpl']))
+    keep_folders.update(job['output_path'] for job in jobs if job.get('output_path'))
+    removed = await asyncio.to_thread(clean_stale_partials, DOWNLOAD_PATH, PARTIAL_MAX_AGE * 3600, keep_folders)
+    if removed:
+        logger.info(f"已清理 {removed} 个超过 {PARTIAL_MAX_AGE} 小时未更新的未完成文件")
+    
+    for job in jobs:
+        if job['state'] != 'queued':
+            continue
+        manifest = manifests.get(job['id'])
+        if manifest is not None:
+            resumable = await asyncio.to_thread(manifest_store.verify, manifest)
+            if resumable:
+                logger.info(f"任务 {job['id']} 将从已下载的 {format_size(resumable)} 处继续: "
+                            f"{os.path.basename(manifest['outtmpl']).replace('.%(ext)s', '')}")
+            continue
+        partial_files = find_partial_files(job.get('output_path'))
+        if partial_files:
+            logger.info(f"任务 {job['id']} 存在未完成的文件，将继续下载: {', '.join(partial_files)}")
+
+def iter_collection_entries(url, put, stop_event=None):
+    """在线程中分页展开播放列表/频道（扁平提取），每得到一个条目就调用 put（阻塞调用）
+    
+    put 返回 False 或 stop_event 被设置时停止展开
+    """
+    proxy = extract_proxy_pool.acquire()
+    ydl_opts = {
+        'proxy': proxy.url if proxy else None,
+        'quiet': True,
+        'no_warnings': True,
+        'socket_timeout': 30,
+        'extract_flat': 'in_playlist',
+        'lazy_playlist': True,
+        'logger': ChineseLogger(logger, stop_event),
+    }
+    try:
+        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+            # process=False 时 entries 是按页请求的生成器，不会一次性解析整个列表
+            info = ydl.extract_info(url, download=False, process=False)
+            if not put(('title', info.get('title') or url)):
+                return
+            count = 0
+            for entry in info.get('entries') or []:
+                if not entry or not entry.get('id'):
+                    continue
+                if not put(('entry', entry)):
+                    return
+                count += 1
+                if PLAYLIST_MAX_ENTRIES and count >= PLAYLIST_MAX_ENTRIES:
+                    break
+    finally:
+        extract_proxy_pool.release(proxy)
+        put(None)
+
+def render_batch_summary(batch):
+    """生成批量任务的汇总消息"""
+    counts = batch.get('counts', {})
+    total = batch['queued']
+    finished = sum(counts.get(state, 0) for state in JobStore.FINAL_STATES)
+    text = (
+        f"📦 批量下载: {batch['title']}\n\n"
+        f"🔍 已发现: {batch['found']} 个视频{'' if batch['expanded'] else ' (展开中...)'}\n"
+        f"➕ 已加入队列: {total}\n"
+        f"⏭️ 已跳过: {batch['skipped']} (已下载或已在队列中)\n"
     )
+    if total:
+        text += (
+            f"\n⬇️ 下载进度: {finished}/{total}\n"
+            f"✅ 完成: {counts.get('done', 0)}  ❌ 失败: {counts.get('failed', 0)}  "
+            f"⏹ 取消: {counts.get('cancelled', 0)}"
+        )
+    return text
+
+ingest_tasks = set()  # 正在后台展开的播放列表/频道
+
+async def ingest_collection(status_message, chat_id, url, user_id=None):
+    """展开播放列表或频道，边展开边加入队列，只维护一条汇总消息"""
+    batch_id = f"{chat_id}:{status_message.message_id}"
+    batch = {'title': url, 'found': 0, 'queued': 0, 'skipped': 0, 'expanded': False}
+    
+    # 有界队列：下载线程展开的速度不会超过入队的速度，内存占用保持恒定
+    loop = asyncio.get_running_loop()
+    entries = asyncio.Queue(maxsize=100)
+    stop_event = threading.Event()
+    
+    def put(item):
+        """队列满时等待入队；入队协程已经退出（出错或被取消）时放弃，返回 False"""
+        future = asyncio.run_coroutine_threadsafe(entries.put(item), loop)
+        while not stop_event.is_set():
+            try:
+                future.result(timeout=1)
+                return True
+            except FutureTimeoutError:
+                continue
+        future.cancel()
+        return False
+    
+    producer = asyncio.create_task(asyncio.to_thread(iter_collection_entries, url, put, stop_event))
+    logger.info(f"开始展开播放列表: {url}")
+    
+    try:
+        while True:
+            item = await entries.get()
+            if item is None:
+                break
+            kind, value = item
+            if kind == 'title':
+                batch['title'] = value
+                continue
+            
+            batch['found'] += 1
+            video_id = value['id']
+            try:
+                if library_index.has_video(video_id) or find_duplicate(video_id, BEST_FORMAT_KEY):
+                    batch['skipped'] += 1
+                else:
+                    job_store.enqueue(
+                        f"https://www.youtube.com/watch?v={video_id}", 'best', value.get('title'),
+                        chat_id=chat_id,
+                        priority=JobStore.PRIORITY_BULK,
+                        format_key=BEST_FORMAT_KEY,
+                        batch_id=batch_id,
+                        user_id=user_id
+                    )
+                    batch['queued'] += 1
+                    download_scheduler.notify()
+            except Exception as e:
+                logger.error(f"添加批量任务失败 {video_id}: {str(e)}")
+            progress_publisher.publish(status_message, render_batch_summary(batch))
+    finally:
+        if not producer.done():
+            # 入队协程异常退出或被取消（例如机器人停止）：通知展开线程停止，不再等待队列空位
+            stop_event.set()
+            logger.warning(f"停止展开播放列表: {batch['title']}，已加入队列 {batch['queued']} 个")
+    
+    try:
+        await producer
+    except Exception as e:
+        logger.error(f"展开播放列表失败: {str(e)}")
+        await progress_publisher.close(status_message)
+        await status_message.edit_text(
+            f"❌ 展开播放列表失败: {str(e)}\n\n" + render_batch_summary(batch)
+        )
+        if not batch['queued']:
+            return
+    
+    batch['expanded'] = True
+    logger.info(f"播放列表展开完成: {batch['title']} - 发现 {batch['found']} 个，加入队列 {batch['queued']} 个")
+    if batch['queued']:
+        asyncio.create_task(track_batch(batch_id, status_message, batch))
+    else:
+        await progress_publisher.close(status_message)
+        await status_message.edit_text(render_batch_summary(batch))
+
+async def track_batch(batch_id, status_message, batch, interval=10):
+    """定期把批量任务的下载进度更新到汇总消息，直到所有任务结束"""
+    while True:
+        counts = job_store.batch_counts(batch_id)
+        batch['counts'] = counts
+        if not batch['queued']:
+            # 重启后恢复的批量任务，只能从数据库统计总数
+            batch['found'] = batch['queued'] = sum(counts.values())
+        unfinished = sum(n for state, n in counts.items() if state not in JobStore.FINAL_STATES)
+        if not unfinished:
+            break
+        progress_publisher.publish(status_message, render_batch_summary(batch))
+        await asyncio.sleep(interval)
     
-    # 如果没有正在下载的任务，开始处理队列
-    if not is_downloading:
-        asyncio.create_task(process_download_queue(None))
+    await progress_publisher.close(status_message)
+    try:
+        await status_message.edit_text("🏁 批量下载已结束\n\n" + render_batch_summary(batch))
+    except Exception as e:
+        logger.warning(f"更新批量任务汇总消息失败: {str(e)}")
+
+chat_locks = weakref.WeakValueDictionary()  # 聊天ID -> asyncio.Lock，没有处理程序使用时自动释放
+
+def chat_lock(chat_id):
+    """同一聊天中需要保持顺序的步骤使用的锁（链接处理程序并发运行）"""
+    lock = chat_locks.get(chat_id)
+    if lock is None:
+        lock = chat_locks[chat_id] = asyncio.Lock()
+    return lock
 
 async def download_and_send_video(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """处理视频链接"""
-    if not await check_admin(update):
+    if not await check_access(update):
         return
         
     url = update.message.text.strip()
+    user_id = update.effective_user.id
     
     if not is_valid_url(url):
         await update.message.reply_text(
@@ -612,12 +3222,62 @@ async def download_and_send_video(update: Update, context: ContextTypes.DEFAULT_
             "请发送正确的 YouTube 视频链接，例如：\n"
             "✅ https://www.youtube.com/watch?v=xxxxxxxxxxx\n"
             "✅ https://youtu.be/xxxxxxxxxxx\n"
-            "✅ https://youtube.com/shorts/xxxxxxxxxxx\n\n"
+            "✅ https://youtube.com/shorts/xxxxxxxxxxx\n"
+            "✅ https://www.youtube.com/playlist?list=...\n"
+            "✅ https://www.youtube.com/@频道名\n\n"
             "其中 'xxxxxxxxxxx' 是11位的视频ID"
         )
         return
+    
+    quota_error = fair_queue.quota_error(user_id)
+    if quota_error:
+        await update.message.reply_text(f"⛔️ {quota_error}，暂时不能添加新的下载")
+        return
+    
+    # 播放列表和频道：流式展开后批量加入队列
+    if is_collection_url(url):
+        status_message = await update.message.reply_text("🔍 正在展开播放列表...")
+        # 展开大型频道可能需要几分钟，在后台进行，停止机器人时取消
+        task = context.application.create_task(
+            ingest_collection(status_message, update.effective_chat.id, normalize_collection_url(url), user_id),
+            update=update
+        )
+        ingest_tasks.add(task)
+        task.add_done_callback(ingest_tasks.discard)
+        return
 
-    status_message = await update.message.reply_text("⏳ 正在获取视频信息...")
+    # 检查 Shorts 视频或禁用质量选择时直接使用最高质量
+    is_shorts = 'shorts' in url
+    auto_best = is_shorts or not enable_quality_selection
+    
+    video_id = extract_video_id(url)
+    # 同一聊天中连续发送的链接按顺序回复和入队；耗时的信息提取在锁外进行，不影响其他链接
+    async with chat_lock(update.effective_chat.id):
+        # 自动下载时在获取视频信息之前就检查是否重复
+        if auto_best:
+            duplicate = find_duplicate(video_id, BEST_FORMAT_KEY)
+            if duplicate:
+                logger.info(f"跳过重复请求: {video_id} - {duplicate}")
+                await update.message.reply_text(f"⏭️ 跳过下载：{duplicate}")
+                return
+        
+        status_message = await update.message.reply_text("⏳ 正在获取视频信息...")
+        
+        if auto_best:
+            # Shorts 视频或禁用质量选择时直接使用最高质量
+            try:
+                await add_to_queue(
+                    status_message,
+                    url,
+                    'best',
+                    '获取中...',
+                    format_key=BEST_FORMAT_KEY,
+                    user_id=user_id
+                )
+            except Exception as e:
+                logger.error(f"Error: {str(e)}")
+                await status_message.edit_text(f"❌ 获取视频信息失败: {str(e)}")
+            return
     
     # 添加重试次数
     max_retries = 3
@@ -625,51 +3285,44 @@ async def download_and_send_video(update: Update, context: ContextTypes.DEFAULT_
     
     while retry_count < max_retries:
         try:
-            # 检查是否是 Shorts 视频
-            is_shorts = 'shorts' in url
+            # 普通视频且启用质量选择时显示质量选择
+            formats = await asyncio.wait_for(
+                list_formats(url, status_message),
+                timeout=60  # 设置60秒超时
+            )
             
-            if is_shorts or not enable_quality_selection:
-                # Shorts 视频或禁用质量选择时直接使用最高质量
-                await add_to_queue(
-                    status_message,
-                    url,
-                    'best',
-                    '获取中...'
-                )
-            else:
-                # 普通视频且启用质量选择时显示质量选择
-                formats = await asyncio.wait_for(
-                    list_formats(url, HTTP_PROXY, status_message),
-                    timeout=60  # 设置60秒超时
-                )
-                
-                # 使用第一个格式的标题作为视频标题
-                video_title = formats[0]['title'] if formats else '未知标题'
-                
-                # 保存格式信息到 context.bot_data
-                context.bot_data['download_info'] = {
-                    'url': url,
-                    'title': video_title,
-                    'formats': {str(fmt['id']): fmt for fmt in formats}
-                }
-                
-                buttons = []
-                for fmt in formats:
-                    if fmt['format_id'] == 'best':
-                        label = f"🎯 {fmt['key']}"
-                    else:
-                        label = f"🎬 {fmt['key']}"
-                    
-                    callback_data = f"dl_{fmt['id']}"
-                    buttons.append([InlineKeyboardButton(label, callback_data=callback_data)])
-                
-                reply_markup = InlineKeyboardMarkup(buttons)
+            # 使用第一个格式的标题作为视频标题
+            video_title = formats[0]['title'] if formats else '未知标题'
+            
+            # 每个菜单的格式信息单独保存，按钮通过令牌找到对应的菜单
+            menu_token = secrets.token_hex(4)
+            format_menus.put(menu_token, {
+                'url': url,
+                'title': video_title,
+                'formats': {str(fmt['id']): fmt for fmt in formats},
+                'user_id': user_id
+            })
+            
+            buttons = []
+            downloaded = library_index.downloaded_resolutions(video_id)
+            for fmt in formats:
+                if fmt['key'] in downloaded:
+                    label = f"✅ {fmt['key']} (已下载)"
+                elif fmt['format_id'] == 'best':
+                    label = f"🎯 {fmt['key']}"
+                else:
+                    label = f"🎬 {fmt['key']}"
                 
-                await status_message.edit_text(
-                    f"🎥 视频: {video_title}\n\n"
-                    "请选择下载质量:",
-                    reply_markup=reply_markup
-                )
+                callback_data = f"dl_{menu_token}_{fmt['id']}"
+                buttons.append([InlineKeyboardButton(label, callback_data=callback_data)])
+            
+            reply_markup = InlineKeyboardMarkup(buttons)
+            
+            await status_message.edit_text(
+                f"🎥 视频: {video_title}\n\n"
+                "请选择下载质量:",
+                reply_markup=reply_markup
+            )
             
             # 如果成功，跳出循环
             break
@@ -696,24 +3349,55 @@ async def download_and_send_video(update: Update, context: ContextTypes.DEFAULT_
 
 async def callback_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
-    await query.answer()
-    
     callback_data = query.data
     chat_id = update.effective_chat.id
+    user_id = query.from_user.id
+    
+    # 取消全部和并发设置只允许管理员操作，单个任务和质量选择菜单只允许发起者和管理员操作
+    denied_text = "⛔️ 抱歉，你没有使用此机器人的权限。"
+    if callback_data == 'cancel_all' or callback_data.startswith('setdl_'):
+        allowed = is_admin(user_id)
+    else:
+        allowed = has_access(user_id, chat_id)
+        if allowed and callback_data.startswith('task_') and not is_admin(user_id):
+            job = job_store.get(int(callback_data.rsplit('_', 1)[1]))
+            allowed = job is None or job['user_id'] == user_id
+        elif allowed and callback_data.startswith('dl_') and not is_admin(user_id):
+            # 群组中的质量选择菜单只有发送链接的用户可以使用
+            menu = format_menus.get(parse_menu_callback(callback_data)[0])
+            allowed = menu is None or menu['user_id'] == user_id
+            denied_text = "⛔️ 只有发送这个链接的用户可以选择下载质量"
+    if not allowed:
+        await query.answer(denied_text, show_alert=True)
+        return
+    await query.answer()
     
     if callback_data.startswith('dl_'):
-        # 处理下载请求
-        format_id = callback_data[3:]  # 移除 'dl_' 前缀
+        # 处理下载请求，callback_data 格式为 dl_<菜单令牌>_<格式编号>
+        menu_token, format_id = parse_menu_callback(callback_data)
+        download_info = format_menus.get(menu_token)
         
-        if 'download_info' in context.bot_data:
-            download_info = context.bot_data['download_info']
+        if download_info is not None:
             url = download_info['url']
+            # 任务和配额记在发送链接的用户名下（管理员代为选择时也是如此）
+            owner_id = download_info['user_id']
             
             if format_id in download_info['formats']:
                 selected_format = download_info['formats'][format_id]
                 format_key = selected_format['key'] 
                 format_code = selected_format['format_id']
                 
+                duplicate = find_duplicate(extract_video_id(url), format_key)
+                if duplicate:
+                    await query.edit_message_text(f"⏭️ 跳过下载：{duplicate}")
+                    return
+                quota_error = fair_queue.quota_error(owner_id)
+                if quota_error:
+                    await query.edit_message_text(f"⛔️ {quota_error}，暂时不能添加新的下载")
+                    return
+                
+                # 菜单已被替换为下载状态，不再需要保留
+                format_menus.invalidate(menu_token)
                 await query.edit_message_text(
                     f"🚀 正在下载: {download_info['title']}\n"
                     f"📊 选择的质量: {format_key}"
@@ -724,65 +3408,687 @@ async def callback_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
                     query.message,
                     url,
                     format_code,
-                    download_info['title']
+                    download_info['title'],
+                    format_key=format_key,
+                    user_id=owner_id
                 )
             else:
                 await query.edit_message_text("⚠️ 格式选择无效，请重试")
         else:
             await query.edit_message_text("⚠️ 下载信息已过期，请重新发送链接")
     
-    elif callback_data == 'cancel_all':
-        # 处理取消所有下载的请求
-        Download.cancel_all_downloads()
-        await query.edit_message_text("已取消所有下载任务")
+    elif callback_data.startswith('task_'):
+        # 处理单个任务的取消/暂停/继续
+        _, action, job_id = callback_data.split('_', 2)
+        await control_task(query, action, int(job_id))
+    
+    elif callback_data == 'cancel_all':
+        # 处理取消所有下载的请求
+        cancelled = cancel_all_downloads()
+        await query.edit_message_text(f"已取消所有下载任务 (共 {cancelled} 个)")
+    
+    elif callback_data.startswith('setdl_'):
+        # 处理设置并发下载数量的请求
+        try:
+            if callback_data == 'setdl_auto':
+                concurrency_controller.auto = True
+                await query.edit_message_text(
+                    f"✅ 已开启自动并发，将在 {concurrency_controller.min_size}-{concurrency_controller.max_size} "
+                    f"之间根据下载速度和服务器负载自动调整"
+                )
+                logger.info(f"已开启自动并发，当前并发下载数: {download_scheduler.size}")
+                return
+            
+            # 从回调数据中提取数量
+            num = int(callback_data[6:])
+            concurrency_controller.auto = False
+            
+            # 调整下载槽位数量，正在进行的任务不受影响
+            download_scheduler.resize(num)
+            
+            await query.edit_message_text(
+                f"✅ 并发下载数量已设置为 {num}",
+            )
+            
+            logger.info(f"并发下载数量已更新为: {num}")
+                
+        except Exception as e:
+            logger.error(f"设置并发下载数量失败: {str(e)}")
+            await query.edit_message_text(f"❌ 设置失败: {str(e)}")
+    
+    # 其他回调处理逻辑...
+
+async def control_task(query, action, job_id):
+    """取消、暂停或继续指定任务"""
+    job = job_store.get(job_id)
+    if job is None or job['state'] in JobStore.FINAL_STATES:
+        await query.edit_message_text("⚠️ 该任务已经结束")
+        return
+    
+    title = job['title'] or job['url']
+    handle = task_handles.get(job_id)
+    
+    if job['state'] == 'postprocessing':
+        await query.edit_message_text(f"🛠 {title} 已下载完成，正在后期处理，无法取消或暂停")
+        return
+    
+    if (handle is None and action in ('cancel', 'pause') and job['state'] in JobStore.ACTIVE_STATES
+            and job_store.request_control(action, job_id)):
+        # 任务正在工作进程中运行，由它在下一次心跳时处理
+        await query.edit_message_text(f"⏹ 正在取消: {title}" if action == 'cancel' else f"⏸ 正在暂停: {title}")
+        logger.info(f"任务 {job_id} 已请求工作进程 {job['worker_id']} {'取消' if action == 'cancel' else '暂停'}")
+        return
+    
+    if action == 'cancel':
+        if handle is not None:
+            # 正在运行的任务：下载线程会在下一次进度回调时中止
+            handle.cancel_requested = True
+            if job['state'] == 'extracting' and handle.task is not None:
+                handle.task.cancel()
+            await query.edit_message_text(f"⏹ 正在取消: {title}")
+        else:
+            job_store.set_state(job_id, 'cancelled')
+            await query.edit_message_text(f"⏹ 已取消: {title}")
+        logger.info(f"任务 {job_id} 已请求取消")
+    
+    elif action == 'pause':
+        if handle is not None:
+            handle.pause_requested = True
+            await query.edit_message_text(f"⏸ 正在暂停: {title}")
+        elif job['state'] == 'queued':
+            job_store.set_state(job_id, 'paused')
+            await query.edit_message_text(
+                f"⏸ 已暂停: {title}",
+                reply_markup=task_keyboard(job_id, paused=True)
+            )
+        logger.info(f"任务 {job_id} 已请求暂停")
+    
+    elif action == 'resume':
+        if job['state'] != 'paused':
+            return
+        job_store.set_state(job_id, 'queued')
+        job_messages[job_id] = query.message
+        await query.edit_message_text(
+            f"▶️ 已继续: {title}\n"
+            f"📊 队列位置: {job_store.queue_position(job_id)}\n"
+            f"⌛️ 等待下载...",
+            reply_markup=task_keyboard(job_id)
+        )
+        download_scheduler.notify()
+        logger.info(f"任务 {job_id} 已恢复")
+
+def cancel_all_downloads():
+    """取消所有等待中、已暂停和正在运行的任务，返回取消的数量"""
+    cancelled = job_store.cancel_pending()
+    for handle in list(task_handles.values()):
+        handle.cancel_requested = True
+        if handle.task is None:
+            continue
+        # 任务记录可能已被调度器同时结束或清理
+        job = job_store.get(handle.job_id)
+        if job and job['state'] == 'extracting':
+            handle.task.cancel()
+    remote = job_store.request_control('cancel')
+    logger.info(f"已取消所有下载任务: 等待中 {len(cancelled)} 个，运行中 {len(task_handles) + remote} 个")
+    return len(cancelled) + len(task_handles) + remote
+
+class SegmentedHttpFD(DashSegmentsFD):
+    """把普通 HTTP 视频文件按字节范围拆成分段，复用分片下载器并行下载
+    
+    与 DASH/HLS 分片一样支持 concurrent_fragment_downloads、分片重试、断点续传和进度回调
+    """
+    FD_NAME = 'segmented'
+
+    def download_and_append_fragments_multiple(self, *args, **kwargs):
+        # DASH/HLS 可以跳过个别缺失的分片，但同一个文件的任何一段缺失都会导致文件损坏
+        kwargs['is_fatal'] = lambda idx: True
+        return super().download_and_append_fragments_multiple(*args, **kwargs)
+
+    def _get_fragments(self, fmt, ctx, extra_query):
+        for fragment in super()._get_fragments(fmt, ctx, extra_query):
+            fragment['byte_range'] = fmt['fragments'][fragment['index']]['byte_range']
+            yield fragment
+
+    def _download_fragment(self, ctx, frag_url, info_dict, headers=None, request_data=None):
+        # 上次中断时已经完整下载、但还没有拼接的分段直接使用，不再重新请求
+        match = re.fullmatch(r'bytes=(\d+)-(\d+)', (headers or {}).get('Range', ''))
+        fragment_filename = '%s-Frag%d' % (ctx['tmpfilename'], ctx['fragment_index'])
+        part_filename = self.temp_name(fragment_filename)
+        if match and self.filesize_or_none(part_filename) == int(match.group(2)) - int(match.group(1)) + 1:
+            os.replace(part_filename, fragment_filename)
+        return super()._download_fragment(ctx, frag_url, info_dict, headers, request_data)
+
+PROTOCOL_MAP['http_segments'] = SegmentedHttpFD
+
+class ConnectionBudget:
+    """所有下载任务共用的连接预算（线程安全）
+    
+    每个任务开始时按建议值申请连接，预算用完时等待其他任务释放。
+    建议值按 1、2、4、8... 逐级试探：记录每个连接数下测得的平均下载速度(EWMA)，
+    增加连接能提速 10% 以上就继续增加，否则退回到较少的连接数。
+    """
+    SAMPLE_TTL = 1800  # 测速结果的有效期(秒)，过期后重新试探
+    MIN_SAMPLE_BYTES = 20 * 1024 * 1024  # 太小的文件测不准速度，不参与调整
+
+    def __init__(self, total, per_job):
+        self.total = max(total, 1)
+        self.levels = sorted({min(2 ** i, per_job) for i in range(8)} | {max(per_job, 1)})
+        self.level = min(4, self.levels[-1])
+        self.leases = {}  # 任务ID -> 正在使用的连接数
+        self._rates = {}  # 连接数 -> (平均速度, 更新时间)
+        self._cond = threading.Condition()
+
+    @property
+    def in_use(self):
+        return sum(self.leases.values())
+
+    def acquire(self, job_id, check=None):
+        """为任务申请连接，至少分配1个，返回分配到的数量"""
+        with self._cond:
+            while self.in_use >= self.total:
+                if check is not None:
+                    check()
+                self._cond.wait(1)
+            granted = min(self.level, self.total - self.in_use)
+            self.leases[job_id] = granted
+            return granted
+
+    def adjust(self, job_id):
+        """在两个音视频流之间按最新建议值增减任务的连接数（不等待）"""
+        with self._cond:
+            current = self.leases.get(job_id, 0)
+            granted = max(1, min(self.level, self.total - self.in_use + current))
+            self.leases[job_id] = granted
+            self._cond.notify_all()
+            return granted
+
+    def release(self, job_id):
+        with self._cond:
+            self.leases.pop(job_id, None)
+            self._cond.notify_all()
+
+    def record(self, connections, nbytes, elapsed):
+        """记录一次分段下载的速度，并据此调整建议的连接数"""
+        if connections not in self.levels or nbytes < self.MIN_SAMPLE_BYTES or not elapsed:
+            return
+        with self._cond:
+            now = time.time()
+            rate = nbytes / elapsed
+            previous = self._get_rate(connections, now)
+            self._rates[connections] = (rate if previous is None else 0.7 * previous + 0.3 * rate, now)
+            if connections != self.level:
+                return
+            index = self.levels.index(connections)
+            rate = self._rates[connections][0]
+            lower = self._get_rate(self.levels[index - 1], now) if index > 0 else None
+            higher = self._get_rate(self.levels[index + 1], now) if index + 1 < len(self.levels) else None
+            if higher is not None and higher > rate * 1.1:
+                self.level = self.levels[index + 1]
+            elif lower is not None and rate < lower * 1.1:
+                self.level = self.levels[index - 1]
+            elif higher is None and index + 1 < len(self.levels):
+                self.level = self.levels[index + 1]  # 试探更多连接是否更快
+            if self.level != connections:
+                logger.info(f"单个任务的建议连接数调整为 {self.level} "
+                            f"({connections} 个连接时平均 {format_size(rate)}/s)")
+
+    def _get_rate(self, connections, now):
+        sample = self._rates.get(connections)
+        if sample is None or now - sample[1] > self.SAMPLE_TTL:
+            return None
+        return sample[0]
+
+connection_budget = ConnectionBudget(DOWNLOAD_CONNECTIONS_TOTAL, DOWNLOAD_CONNECTIONS_PER_JOB)
+
+class SegmentedDownload(PostProcessor):
+    """单个下载任务的多连接下载计划
+    
+    在格式选定后、开始下载前运行：DASH/HLS 分片用多个线程同时下载，
+    大小已知的普通文件改用 SegmentedHttpFD 按字节范围并行下载，连接数从全局预算中申请。
+    """
+    FRAGMENT_PROTOCOLS = ('http_segments', 'http_dash_segments', 'm3u8_native')
+
+    def __init__(self, job_id, segment_size, check=None):
+        super().__init__()
+        self.job_id = job_id
+        self.segment_size = segment_size
+        self.check = check
+        self.connections = 0
+
+    def _hook_progress(self, status, info_dict):
+        # 这一步只是下载前的准备，不在进度消息中显示为后期处理
+        pass
+
+    def run(self, info):
+        formats = info.get('requested_formats') or [info]
+        for fmt in formats:
+            self._split(fmt)
+        if info.get('requested_formats'):
+            info['protocol'] = '+'.join(fmt['protocol'] for fmt in formats)
+        
+        if self.connections:
+            # 缓存的直链失效后重新解析时会再次运行，沿用已申请的连接
+            self.connections = connection_budget.adjust(self.job_id)
+        else:
+            self.connections = connection_budget.acquire(self.job_id, self.check)
+        self._downloader.params['concurrent_fragment_downloads'] = self.connections
+        logger.info(f"下载使用 {self.connections} 个连接 "
+                    f"(全局已用 {connection_budget.in_use}/{connection_budget.total})")
+        return [], info
+
+    def _split(self, fmt):
+        """把大小已知的普通 HTTP 格式拆分为按字节范围下载的分段"""
+        size = fmt.get('filesize')
+        if fmt.get('protocol') not in ('http', 'https') or fmt.get('is_live') or not size:
+            return
+        if size < self.segment_size * 2:
+            return
+        fmt['fragments'] = [
+            {'url': fmt['url'], 'byte_range': {'start': start, 'end': min(start + self.segment_size, size)}}
+            for start in range(0, size, self.segment_size)
+        ]
+        fmt['protocol'] = 'http_segments'
+
+    def progress_hook(self, d):
+        """每个音视频流下载完成后记录速度，并为下一个流调整连接数"""
+        if d.get('status') != 'finished' or 'postprocessor' in d or not self.connections:
+            return
+        if d.get('info_dict', {}).get('protocol') in self.FRAGMENT_PROTOCOLS:
+            connection_budget.record(self.connections, d.get('total_bytes') or 0, d.get('elapsed'))
+        self.connections = connection_budget.adjust(self.job_id)
+        self._downloader.params['concurrent_fragment_downloads'] = self.connections
+
+    def release(self):
+        connection_budget.release(self.job_id)
+        self.connections = 0
+
+def parse_bandwidth_schedule(text):
+    """解析 "01:00-07:00=0,18:00-23:00=10" 格式的带宽时间表，返回 [(开始分钟, 结束分钟, MB/s)]"""
+    schedule = []
+    for item in filter(None, (part.strip() for part in (text or '').split(','))):
+        match = re.fullmatch(r'(\d{1,2}):(\d{2})-(\d{1,2}):(\d{2})=(\d+(?:\.\d+)?)', item)
+        if not match:
+            raise ValueError(f"无法识别的时间段: {item}")
+        start_h, start_m, end_h, end_m, limit = match.groups()
+        start = int(start_h) * 60 + int(start_m)
+        end = int(end_h) * 60 + int(end_m)
+        if start >= 24 * 60 or end > 24 * 60 or int(start_m) >= 60 or int(end_m) >= 60:
+            raise ValueError(f"无效的时间: {item}")
+        schedule.append((start, end, float(limit)))
+    return schedule
+
+def format_bandwidth_schedule(schedule):
+    return ', '.join(
+        f"{start // 60:02d}:{start % 60:02d}-{end // 60:02d}:{end % 60:02d}="
+        f"{'不限' if not limit else f'{limit:g}MB/s'}"
+        for start, end, limit in schedule
+    )
+
+class BandwidthGovernor:
+    """所有下载任务共用的带宽限制器
+    
+    每个任务在进度回调中按新下载的字节数从自己的令牌桶扣除，超出速度时在下载线程中等待。
+    总带宽（按时间表、扣除为 Bot API 预留的部分）每隔几秒按权重重新分配：
+    实际用不完份额的任务只保留略高于当前速度的额度，剩余部分分给其他任务。
+    """
+    WEIGHT_INTERACTIVE = 3  # 手动选择的下载比批量任务多分配带宽
+    WEIGHT_BULK = 1
+    MIN_SHARE = 256 * 1024  # 每个任务至少分配的速度
+    INTERVAL = 2  # 重新分配的间隔(秒)
+
+    def __init__(self, limit, schedule, reserve):
+        self.limit = limit  # 默认总带宽(MB/s)，0 表示不限制
+        self.schedule = schedule
+        self.reserve = reserve
+        self.jobs = {}  # 任务ID -> {'weight', 'bucket', 'bytes', 'rate'}
+        self._lock = threading.Lock()
+
+    def current_limit(self, now=None):
+        """当前时间段的总带宽(MB/s)，0 表示不限制"""
+        now = now or datetime.datetime.now()
+        minute = now.hour * 60 + now.minute
+        for start, end, limit in self.schedule:
+            in_window = start <= minute < end if start <= end else (minute >= start or minute < end)
+            if in_window:
+                return limit
+        return self.limit
+
+    def download_budget(self):
+        """分配给下载任务的总速度(字节/秒)，None 表示不限制"""
+        limit = self.current_limit()
+        if not limit:
+            return None
+        return max(limit - self.reserve, 0.1) * 1024 * 1024
+
+    def register(self, job_id, weight):
+        with self._lock:
+            # 刚开始的任务还没有测得速度，先按需求不限计算
+            self.jobs[job_id] = {'weight': weight, 'bucket': None, 'bytes': 0,
+                                 'demand': float('inf'), 'rate': 0}
+        self.rebalance(measure=False)
+
+    def unregister(self, job_id):
+        with self._lock:
+            self.jobs.pop(job_id, None)
+        self.rebalance(measure=False)
+
+    def consume(self, job_id, amount, check=None):
+        """下载线程报告新下载的字节数，超出分配的速度时等待"""
+        with self._lock:
+            job = self.jobs.get(job_id)
+            if job is None:
+                return
+            job['bytes'] += amount
+            bucket = job['bucket']
+        if bucket is None:
+            return
+        wait = bucket.consume(amount)
+        while wait > 0:
+            # 分段等待，等待期间也能响应取消和暂停
+            time.sleep(min(wait, 1))
+            wait -= 1
+            if check is not None:
+                check()
+
+    def rebalance(self, measure=True):
+        """按权重重新分配总带宽，用不完份额的任务让出多余部分
+        
+        measure 为 True 时先用上一个周期的实际速度更新各任务的需求
+        """
+        budget = self.download_budget()
+        with self._lock:
+            now = time.monotonic()
+            for job in self.jobs.values():
+                if measure and 'measured_at' in job:
+                    job['demand'] = job['bytes'] / max(now - job['measured_at'], 0.1) * 1.25 + self.MIN_SHARE
+                job['bytes'] = 0
+                job['measured_at'] = now
+            if budget is None:
+                for job in self.jobs.values():
+                    job['bucket'] = None
+                    job['rate'] = 0
+                return
+            
+            remaining = budget
+            pending = dict(self.jobs)
+            while pending:
+                total_weight = sum(job['weight'] for job in pending.values())
+                satisfied = {
+                    job_id: job for job_id, job in pending.items()
+                    if job['demand'] <= remaining * job['weight'] / total_weight
+                }
+                if not satisfied:
+                    for job in pending.values():
+                        self._set_rate(job, max(remaining * job['weight'] / total_weight, self.MIN_SHARE))
+                    break
+                for job_id, job in satisfied.items():
+                    self._set_rate(job, job['demand'])
+                    remaining -= job['demand']
+                    del pending[job_id]
+
+    def _set_rate(self, job, rate):
+        job['rate'] = rate
+        if job['bucket'] is None:
+            job['bucket'] = TokenBucket(rate)
+        else:
+            job['bucket'].set_rate(rate)
+
+    async def run(self):
+        """定期按时间表和各任务的实际速度重新分配带宽"""
+        last_limit = self.current_limit()
+        while True:
+            await asyncio.sleep(self.INTERVAL)
+            limit = self.current_limit()
+            if limit != last_limit:
+                logger.info(f"带宽限制切换为: {'不限制' if not limit else f'{limit:g}MB/s'}")
+                last_limit = limit
+            try:
+                self.rebalance()
+            except Exception as e:
+                logger.error(f"分配带宽出错: {str(e)}")
+
+bandwidth_governor = BandwidthGovernor(BANDWIDTH_LIMIT, parse_bandwidth_schedule(BANDWIDTH_SCHEDULE), BANDWIDTH_RESERVE)
+
+class TransferMeter:
+    """单个下载任务的字节统计，在进度回调中把新下载的字节数交给带宽限制器和自动并发"""
+    def __init__(self, job_id, check=None):
+        self.job_id = job_id
+        self.check = check
+        self.proxy = None  # 本次下载使用的代理，用于统计各代理的下载速度
+        self.stream_bytes = {}  # 文件名 -> 已下载字节数
+        self.total = 0  # 本次下载新下载的字节数（不含续传前已有的部分）
+        self._lock = threading.Lock()
+
+    def progress_hook(self, d):
+        if d.get('status') != 'downloading':
+            return
+        stream = d.get('tmpfilename') or d.get('filename')
+        downloaded = d.get('downloaded_bytes') or 0
+        with self._lock:
+            # 续传时第一次回调的字节数是已有文件的大小，不计入
+            delta = downloaded - self.stream_bytes.get(stream, downloaded)
+            self.stream_bytes[stream] = max(downloaded, self.stream_bytes.get(stream, 0))
+        if delta > 0:
+            self.total += delta
+            metrics.inc('ytbot_download_bytes_total', delta)
+            concurrency_controller.add_bytes(delta)
+            download_proxy_pool.add_bytes(self.proxy, delta)
+            bandwidth_governor.consume(self.job_id, delta, self.check)
+
+class MetadataMergerPP(FFmpegMergerPP):
+    """合并音视频时一并写入元数据
+    
+    单独运行 FFmpegMetadata 会把合并好的文件再完整重写一遍，大文件的磁盘读写量因此翻倍
+    """
+    def run(self, info):
+        self._metadata_opts = [arg for opt in FFmpegMetadataPP(self._downloader)._get_metadata_opts(info) for arg in opt]
+        return super().run(info)
+
+    def run_ffmpeg_multiple_files(self, input_paths, out_path, opts, **kwargs):
+        return super().run_ffmpeg_multiple_files(input_paths, out_path, [*opts, *self._metadata_opts], **kwargs)
+
+def plan_postprocessing(postprocessors, deferred):
+    """根据实际下载到的文件决定需要运行的后期处理，返回 (后期处理器列表, 封装说明)
+    
+    已经是目标封装格式时不再转封装；需要合并音视频时在合并命令中写入元数据；
+    单个文件已是目标格式时不再为写入元数据重写文件（元数据已保存在NFO文件中）
+    """
+    info = deferred['info']
+    remuxer = next((pp for pp in postprocessors if pp['key'] == 'FFmpegVideoRemuxer'), None)
+    needs_remux = remuxer is not None and info.get('ext') != remuxer['preferedformat']
+    merging = 'FFmpegMergerPP' in deferred['fixups']
+    # 章节需要额外的元数据文件，无法在合并时一并写入
+    fold_metadata = merging and not needs_remux and not info.get('chapters')
+    if fold_metadata:
+        deferred['fixups'] = ['MetadataMergerPP' if name == 'FFmpegMergerPP' else name for name in deferred['fixups']]
     
-    elif callback_data.startswith('setdl_'):
-        # 处理设置并发下载数量的请求
-        global concurrent_downloads, download_semaphore, thread_pool
-        
+    planned = []
+    for pp in postprocessors:
+        if pp['key'] == 'FFmpegVideoRemuxer' and not needs_remux:
+            continue
+        if pp['key'] == 'FFmpegMetadata' and (fold_metadata or not (merging or needs_remux)):
+            continue
+        planned.append(pp)
+    
+    if needs_remux:
+        container = f"{info.get('ext')} 转封装为 {remuxer['preferedformat']}"
+    elif merging:
+        container = f"{info.get('ext')}（音视频直接合并，无需转封装）"
+    else:
+        container = f"{info.get('ext')}（直接保存，无需合并或转封装）"
+    return planned, container
+
+class DeferredPostProcessYDL(yt_dlp.YoutubeDL):
+    """下载完成后不在下载线程中运行后期处理
+    
+    合并音视频、修复和后期处理器所需的信息保存在 deferred 中，交给后期处理进程池执行
+    """
+    deferred = None
+
+    def post_process(self, filename, info, files_to_move=None):
+        fixups = [type(pp).__name__ for pp in info.pop('__postprocessors', None) or []]
+        info['filepath'] = filename
+        self.deferred = {
+            'filename': filename,
+            'info': self.sanitize_info(info),
+            'files_to_move': files_to_move or {},
+            'fixups': fixups,
+        }
+        return info
+
+def run_postprocessing(postprocessors, filename, info, files_to_move, fixups):
+    """在后期处理进程中合并音视频并运行后期处理器，返回最终的文件路径"""
+    ydl_opts = {
+        'quiet': True,
+        'no_warnings': True,
+        'postprocessors': postprocessors,
+    }
+    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+        info['__postprocessors'] = [
+            MetadataMergerPP(ydl) if name == 'MetadataMergerPP' else getattr(yt_dlp.postprocessor, name)(ydl)
+            for name in fixups
+        ]
+        info = ydl.post_process(filename, info, files_to_move)
+    return info['filepath']
+
+class PostProcessService:
+    """后期处理进程池
+    
+    合并、写入元数据、转换封面和封装格式都是CPU密集型的 ffmpeg 操作，
+    下载线程完成后立即释放下载槽位，后期处理在独立的进程池中按CPU核心数并行进行。
+    """
+    def __init__(self, workers=0):
+        self.workers = workers or os.cpu_count() or 2
+        self.active = 0
+        self.executor = None
+
+    def start(self):
+        """创建进程池并预先启动工作进程，避免之后在下载线程运行时再创建进程"""
+        self.executor = ProcessPoolExecutor(max_workers=self.workers)
+        for _ in range(self.workers):
+            self.executor.submit(os.getpid)
+        logger.info(f"后期处理进程池已启动，共 {self.workers} 个进程")
+
+    async def run(self, postprocessors, deferred):
+        """在进程池中执行后期处理，返回最终的文件路径"""
+        if self.executor is None:
+            self.start()
+        self.active += 1
         try:
-            # 从回调数据中提取数量
-            num = int(callback_data[6:])
-            
-            # 更新并发下载数量
-            concurrent_downloads = num
-            
-            # 更新信号量和线程池
-            download_semaphore = threading.Semaphore(concurrent_downloads)
-            
-            # 关闭旧的线程池并创建新的
-            if thread_pool:
-                thread_pool.shutdown(wait=False)
-            thread_pool = ThreadPoolExecutor(max_workers=concurrent_downloads)
-            
-            await query.edit_message_text(
-                f"✅ 并发下载数量已设置为 {concurrent_downloads}",
+            return await asyncio.get_running_loop().run_in_executor(
+                self.executor, run_postprocessing, postprocessors,
+                deferred['filename'], deferred['info'], deferred['files_to_move'], deferred['fixups']
             )
-            
-            logger.info(f"并发下载数量已更新为: {concurrent_downloads}")
-            
-            # 如果有待处理的队列，触发下载
-            if download_queue and not is_downloading:
-                asyncio.create_task(process_download_queue(context))
-                
-        except Exception as e:
-            logger.error(f"设置并发下载数量失败: {str(e)}")
-            await query.edit_message_text(f"❌ 设置失败: {str(e)}")
-    
-    # 其他回调处理逻辑...
+        except BrokenProcessPool:
+            # 工作进程异常退出后进程池无法继续使用，重新创建
+            logger.error("后期处理进程异常退出，重新创建进程池")
+            self.executor.shutdown(wait=False)
+            self.start()
+            raise Exception("后期处理进程异常退出")
+        finally:
+            self.active -= 1
+
+postprocess_service = PostProcessService(POSTPROCESS_WORKERS)
+
+def error_class(error):
+    """用于统计的错误类型：转换后的错误取原始异常，yt-dlp 的 DownloadError 取其包装的异常"""
+    error = error.__cause__ or error.__context__ or error
+    if isinstance(error, yt_dlp.utils.DownloadError) and error.exc_info:
+        error = error.exc_info[1]
+    return type(error).__name__
+
+def proxy_samples(attribute):
+    """各代理池中每个代理的某项状态，用于指标"""
+    return [({'pool': pool.name, 'proxy': proxy.label}, attribute(proxy))
+            for pool in {download_proxy_pool, extract_proxy_pool} for proxy in pool.proxies]
+
+metrics.gauge('ytbot_queue_depth', '等待中和已暂停的任务数',
+              lambda: [({'state': state}, job_store.count(state)) for state in ('queued', 'paused')])
+metrics.gauge('ytbot_download_slots', '下载槽位总数和正在使用的数量',
+              lambda: [({'state': 'total'}, download_scheduler.size),
+                       ({'state': 'busy'}, download_scheduler.active_count)])
+metrics.gauge('ytbot_postprocess_active', '正在后期处理的任务数', lambda: [({}, postprocess_service.active)])
+metrics.gauge('ytbot_download_connections', '分段下载的连接预算和正在使用的连接数',
+              lambda: [({'state': 'total'}, connection_budget.total),
+                       ({'state': 'in_use'}, connection_budget.in_use)])
+metrics.gauge('ytbot_proxy_up', '代理是否通过健康检查', lambda: proxy_samples(lambda p: int(p.healthy)))
+metrics.gauge('ytbot_proxy_latency_seconds', '代理健康检查的平均延迟',
+              lambda: [(labels, value) for labels, value in proxy_samples(lambda p: p.latency) if value is not None])
+metrics.gauge('ytbot_proxy_active_jobs', '正在使用该代理的任务数', lambda: proxy_samples(lambda p: p.active))
+
+def report_proxy_failure(proxy, error, handle=None):
+    """记录下载失败，由代理引起时让任务下次重试避开该代理"""
+    proxy_error = is_proxy_error(error)
+    download_proxy_pool.report(proxy, not proxy_error)
+    if proxy_error and proxy is not None and handle is not None:
+        handle.failed_proxy = proxy.url
 
 @backoff.on_exception(backoff.expo, 
                       exception=(yt_dlp.utils.DownloadError, Exception),
                       max_tries=5, 
-                      jitter=None)
-def download_video(ydl_opts, url):
-    """在线程池中运行下载任务，加入重试机制"""
+                      jitter=None,
+                      giveup=lambda e: isinstance(e, yt_dlp.utils.DownloadCancelled),
+                      on_backoff=lambda details: metrics.inc('ytbot_download_retries_total',
+                                                             error=error_class(details['exception'])))
+def download_video(ydl_opts, url, info=None, handle=None):
+    """在线程池中运行下载任务，加入重试机制
+    
+    传入已缓存的视频信息时直接用 process_ie_result 下载，不再重新解析URL。
+    只负责网络下载，返回需要交给后期处理进程池的信息
+    """
+    job_id = handle.job_id if handle is not None else id(ydl_opts)
+    check = handle.check if handle is not None else None
+    segmented = SegmentedDownload(job_id, DOWNLOAD_SEGMENT_SIZE * 1024 * 1024, check)
+    meter = TransferMeter(job_id, check)
+    job = job_store.get(job_id) if handle is not None else None
+    # 优先使用提取信息时的代理，直链通常只对该代理的出口IP有效；重新解析时优先使用上次的代理
+    manifest = manifest_store.load(job_id) if job is not None else None
+    prefer = info.get('extraction_proxy') if info else (manifest or {}).get('proxy')
+    # 上次因代理出错失败时立即换用其他代理，不等该代理连续失败被停用
+    failed_proxy = handle.failed_proxy if handle is not None else None
+    proxy = download_proxy_pool.acquire(prefer=None if prefer == failed_proxy else prefer,
+                                        exclude=failed_proxy)
+    proxy_url = proxy.url if proxy else None
+    if manifest is not None:
+        manifest_store.update(job_id, proxy=proxy_url)
+    if info is not None and info.get('extraction_proxy') != proxy_url:
+        logger.info(f"下载代理与提取时不同，将通过 {proxy.label if proxy else '直接连接'} 重新解析链接")
+        info = None
+    # 后期处理器不在下载线程中运行，由 start_download 交给后期处理进程池
+    ydl_opts = dict(ydl_opts, proxy=proxy_url, postprocessors=[])
+    meter.proxy = proxy
+    bandwidth_governor.register(job_id, BandwidthGovernor.WEIGHT_INTERACTIVE
+                                if job is None or job['priority'] >= JobStore.PRIORITY_INTERACTIVE
+                                else BandwidthGovernor.WEIGHT_BULK)
+    start_time = time.monotonic()
     try:
-        with download_semaphore:  # 使用信号量控制并发数
-            with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+        with DeferredPostProcessYDL(ydl_opts) as ydl:
+            ydl.add_post_processor(segmented, when='before_dl')
+            ydl.add_progress_hook(segmented.progress_hook)
+            ydl.add_progress_hook(meter.progress_hook)
+            if manifest is not None:
+                ydl.add_progress_hook(functools.partial(manifest_store.record_stream, job_id))
+            if info is None:
                 ydl.download([url])
-        return True
+            else:
+                try:
+                    ydl.process_ie_result(copy.deepcopy(info), download=True)
+                except yt_dlp.utils.DownloadError as e:
+                    # 缓存中的直链可能已经失效，清除缓存后按URL重新解析下载
+                    logger.warning(f"使用缓存信息下载失败，将重新解析链接: {str(e)}")
+                    info_cache.invalidate(info.get('id'))
+                    ydl.download([url])
+        download_proxy_pool.report(proxy, True)
+        elapsed = time.monotonic() - start_time
+        if meter.total and elapsed > 0:
+            metrics.observe('ytbot_download_throughput_bytes', meter.total / elapsed)
+        return ydl.deferred
+    except yt_dlp.utils.DownloadCancelled:
+        # 用户取消或暂停，不需要重试
+        raise
     except yt_dlp.utils.DownloadError as e:
+        # 可能由代理引起的错误会降低该代理的优先级，重试时换用其他代理
+        report_proxy_failure(proxy, e, handle)
         # 处理特定的下载错误
         error_msg = str(e).lower()
         if "private video" in error_msg:
@@ -804,13 +4110,24 @@ def download_video(ydl_opts, url):
             logger.error(f"未知下载错误: {error_msg}")
             raise  # 重新抛出异常以便 backoff 库进行重试
     except Exception as e:
+        report_proxy_failure(proxy, e, handle)
         logger.error(f"下载过程中遇到异常: {str(e)}")
         raise  # 重新抛出异常以便 backoff 库进行重试
+    finally:
+        segmented.release()
+        bandwidth_governor.unregister(job_id)
+        download_proxy_pool.release(proxy)
 
-async def start_download(message, url, format_id, video_title):
-    """开始下载指定格式的视频"""
-    status_message = await message.edit_text("⏳ 正在准备下载...")
-    progress_handler = DownloadProgress(status_message)
+async def start_download(message, url, format_id, video_title, job_id=None, handle=None, format_key=None,
+                         user_id=None):
+    """开始下载指定格式的视频，format_key 为选择的分辨率标签，user_id 为发起下载的用户"""
+    silent = message is None  # 批量任务中的视频只更新汇总消息
+    if silent:
+        message = SilentMessage()
+    status_message = await message.edit_text("⏳ 正在准备下载...", reply_markup=task_keyboard(job_id))
+    progress_handler = DownloadProgress(None if silent else status_message, handle, task_keyboard(job_id))
+    video_folder = None
+    output_filename = None
     
     try:
         # 记录下载目录信息
@@ -819,159 +4136,205 @@ async def start_download(message, url, format_id, video_title):
         if os.path.exists(DOWNLOAD_PATH):
             logger.info(f"下载目录权限: {oct(os.stat(DOWNLOAD_PATH).st_mode)[-3:]}")
         
-        # 设置代理
-        proxy_config = {}
-        if HTTP_PROXY:
-            proxy_config['proxy'] = HTTP_PROXY
+        # 按视频ID检查是否已经下载过，无需访问网络
+        video_id = extract_video_id(url)
+        if format_key and library_index.has_video(video_id, format_key):
+            logger.info(f"跳过下载: {video_id} - {format_key} 已存在")
+            await status_message.edit_text(f"⏭️ 跳过下载：该视频的 {format_key} 版本已存在")
+            update_job_state(job_id, 'done')
+            return
         
-        # 先获取视频信息
-        with yt_dlp.YoutubeDL({
-            'proxy': HTTP_PROXY if HTTP_PROXY else None,
-            'youtube_include_dash_manifest': True,
-            'youtube_include_hls_manifest': True,
-        }) as ydl:
-            info = ydl.extract_info(url, download=False)
-            video_title = info.get('title', '未知标题')
-            # 清理文件名中的非法字符
-            video_title = re.sub(r'[\\/*?:"<>|]', '', video_title).strip()
-            
-            # 根据format_id确定分辨率标签
-            resolution = "最佳质量"
-            
-            if format_id != 'best':
-                # 检查是否有特殊格式要求（如高帧率、HDR等）
-                is_high_fps = '[fps>30]' in format_id
-                is_hdr = 'HDR' in format_id
-                
-                # 查找对应的格式获取分辨率
-                selected_height = 0
-                for f in info.get('formats', []):
-                    if f.get('format_id') == format_id:
-                        selected_height = f.get('height', 0)
-                        break
-                
-                # 如果没有直接找到格式ID，尝试从格式ID中提取分辨率信息
-                if selected_height == 0 and 'height>=' in format_id:
-                    try:
-                        # 从形如 "bestvideo[height>=1080]" 中提取高度
-                        height_str = format_id.split('height>=')[1].split(']')[0]
-                        selected_height = int(height_str)
-                    except:
-                        selected_height = 0
-                
-                # 设置分辨率标签
-                if selected_height >= 4320:
-                    resolution = "4320p"  # 8K
-                elif selected_height >= 2160:
-                    resolution = "2160p"  # 4K
-                elif selected_height >= 1440:
-                    resolution = "1440p"  # 2K/QHD
-                elif selected_height >= 1080:
-                    resolution = "1080p"  # Full HD
-                elif selected_height >= 720:
-                    resolution = "720p"   # HD
-                elif selected_height >= 480:
-                    resolution = "480p"   # SD
-                elif selected_height >= 360:
-                    resolution = "360p"
-                elif selected_height >= 240:
-                    resolution = "240p"
-                elif selected_height >= 144:
-                    resolution = "144p"
-                else:
-                    resolution = "未知分辨率"
-                
-                # 添加帧率和HDR标记
-                if is_high_fps:
-                    resolution += "60"
-                if is_hdr:
-                    resolution += " HDR"
-            
-            # 创建存放视频的文件夹 (只创建一级目录)
-            video_folder = os.path.join(DOWNLOAD_PATH, video_title)
-            os.makedirs(video_folder, exist_ok=True)
+        # 先获取视频信息（优先使用格式列表阶段缓存的结果）
+        info = await extraction_service.get_info(url)
+        video_title = info.get('title', '未知标题')
+        # 清理文件名中的非法字符
+        video_title = re.sub(r'[\\/*?:"<>|]', '', video_title).strip()
+        
+        # 根据format_id确定分辨率标签
+        resolution = BEST_FORMAT_KEY
+        
+        if format_key:
+            # 使用选择菜单中的标签，与去重记录保持一致
+            resolution = format_key
+        elif format_id != 'best':
+            # 检查是否有特殊格式要求（如高帧率、HDR等）
+            is_high_fps = '[fps>30]' in format_id
+            is_hdr = 'HDR' in format_id
             
-            # 检查是否已经下载过相同分辨率的视频
-            existing_files = [f for f in os.listdir(video_folder) 
-                            if f.endswith(('.mp4', '.webm', '.mkv')) 
-                            and resolution in f]
+            # 查找对应的格式获取分辨率
+            selected_height = 0
+            for f in info.get('formats', []):
+                if f.get('format_id') == format_id:
+                    selected_height = f.get('height', 0)
+                    break
             
-            if existing_files:
-                logger.info(f"跳过下载: {video_title} - {resolution} 已存在")
-                await status_message.edit_text(f"⏭️ 跳过下载：该视频的 {resolution} 版本已存在")
-                return
+            # 如果没有直接找到格式ID，尝试从格式ID中提取分辨率信息
+            if selected_height == 0 and 'height>=' in format_id:
+                try:
+                    # 从形如 "bestvideo[height>=1080]" 中提取高度
+                    height_str = format_id.split('height>=')[1].split(']')[0]
+                    selected_height = int(height_str)
+                except:
+                    selected_height = 0
             
-            # 设置下载格式
-            if format_id == 'best':
-                format_opt = 'bestvideo[ext=mp4]+bestaudio[ext=m4a]/best[ext=mp4]/best'
+            # 设置分辨率标签
+            if selected_height >= 4320:
+                resolution = "4320p"  # 8K
+            elif selected_height >= 2160:
+                resolution = "2160p"  # 4K
+            elif selected_height >= 1440:
+                resolution = "1440p"  # 2K/QHD
+            elif selected_height >= 1080:
+                resolution = "1080p"  # Full HD
+            elif selected_height >= 720:
+                resolution = "720p"   # HD
+            elif selected_height >= 480:
+                resolution = "480p"   # SD
+            elif selected_height >= 360:
+                resolution = "360p"
+            elif selected_height >= 240:
+                resolution = "240p"
+            elif selected_height >= 144:
+                resolution = "144p"
             else:
-                format_opt = f'{format_id}+bestaudio[ext=m4a]/best'
+                resolution = "未知分辨率"
             
-            # 使用视频标题作为文件名，但添加分辨率后缀
-            # 确保文件名不超过系统限制(一般文件系统最大长度为255字符)
-            max_filename_length = 200  # 预留一些空间给扩展名和路径
-            safe_title = video_title
-            if len(safe_title) > max_filename_length:
-                safe_title = safe_title[:max_filename_length]
-                
-            output_filename = f"{safe_title}_{resolution}"
+            # 添加帧率和HDR标记
+            if is_high_fps:
+                resolution += "60"
+            if is_hdr:
+                resolution += " HDR"
+        
+        # 创建存放视频的文件夹 (只创建一级目录)
+        # 同名文件夹属于另一个视频时，在文件夹名后加上视频ID
+        video_folder = os.path.join(DOWNLOAD_PATH, video_title)
+        folder_owner = library_index.folder_video_id(video_folder) if os.path.isdir(video_folder) else None
+        if folder_owner and folder_owner != info['id']:
+            video_folder = os.path.join(DOWNLOAD_PATH, f"{video_title} [{info['id']}]")
+        os.makedirs(video_folder, exist_ok=True)
+        
+        if library_index.has_video(info['id'], resolution):
+            logger.info(f"跳过下载: {video_title} - {resolution} 已存在")
+            await status_message.edit_text(f"⏭️ 跳过下载：该视频的 {resolution} 版本已存在")
+            update_job_state(job_id, 'done', title=video_title, output_path=video_folder)
+            return
+        
+        # 设置下载格式
+        # 优先选择可以直接放进 mp4 的音视频流，避免下载后再转封装
+        selected_format = next((f for f in info.get('formats', []) if f.get('format_id') == format_id), None)
+        if format_id == 'best':
+            format_opt = 'bestvideo[ext=mp4]+bestaudio[ext=m4a]/best[ext=mp4]/best'
+        elif selected_format and selected_format.get('acodec') != 'none' and selected_format.get('ext') == 'mp4':
+            # 所选格式本身已包含音频，直接保存，无需合并
+            format_opt = f'{format_id}/best'
+        elif selected_format:
+            # m4a 音频可以直接合并进 mp4，没有时再使用其他音频
+            format_opt = f'{format_id}+bestaudio[ext=m4a]/{format_id}+bestaudio/best'
+        else:
+            format_opt = f'{format_id}+bestaudio[ext=m4a]/best'
+        
+        # 使用视频标题作为文件名，但添加分辨率后缀
+        # 确保文件名不超过系统限制(一般文件系统最大长度为255字符)
+        max_filename_length = 200  # 预留一些空间给扩展名和路径
+        safe_title = video_title
+        if len(safe_title) > max_filename_length:
+            safe_title = safe_title[:max_filename_length]
             
-            ydl_opts = {
-                'format': format_opt,
-                'outtmpl': f'{video_folder}/{output_filename}.%(ext)s',
-                'noplaylist': True,
-                'writethumbnail': True,
-                'write_all_thumbnails': False,
-                'convert_thumbnails': 'jpg',
-                'proxy': HTTP_PROXY if HTTP_PROXY else None,
-                'quiet': False,
-                'no_warnings': True,
-                'postprocessors': [
-                    {
-                        'key': 'FFmpegMetadata',
-                        'add_metadata': True,
-                    },
-                    {
-                        'key': 'FFmpegThumbnailsConvertor',
-                        'format': 'jpg',
-                        'when': 'before_dl'
-                    },
-                    {
-                        # 使用 FFmpegVideoRemuxer 而不是 FFmpegVideoConvertor
-                        'key': 'FFmpegVideoRemuxer',
-                        'preferedformat': 'mp4',
-                    }
-                ],
-                'merge_output_format': 'mp4',
-                'logger': ChineseLogger(logger),
-                'progress_hooks': [progress_handler.progress_hook],
-                'postprocessor_hooks': [progress_handler.progress_hook],
-                # 增加更多重试选项，处理瞬时连接问题
-                'retries': 10,
-                'fragment_retries': 10,
-                'skip_unavailable_fragments': True,
-                'ignoreerrors': False,
-                # 添加对DASH和HLS格式的支持
-                'youtube_include_dash_manifest': True,
-                'youtube_include_hls_manifest': True,
-            }
+        output_filename = f"{safe_title}_{resolution}"
+        
+        # 重启后继续下载时沿用清单中的文件名和格式，才能接上已下载的未完成文件
+        manifest = manifest_store.load(job_id) if job_id is not None else None
+        if manifest is not None:
+            video_folder = os.path.dirname(manifest['outtmpl'])
+            output_filename = os.path.basename(manifest['outtmpl']).replace('.%(ext)s', '')
+            format_opt = manifest['format']
+            os.makedirs(video_folder, exist_ok=True)
+            logger.info(f"按下载清单继续任务 {job_id}: {output_filename}")
+        elif job_id is not None:
+            manifest_store.create(job_id, url, info['id'], format_opt, f'{video_folder}/{output_filename}.%(ext)s')
         
+        ydl_opts = {
+            'format': format_opt,
+            'outtmpl': f'{video_folder}/{output_filename}.%(ext)s',
+            'noplaylist': True,
+            'writethumbnail': True,
+            'write_all_thumbnails': False,
+            'convert_thumbnails': 'jpg',
+            'quiet': False,
+            'no_warnings': True,
+            'postprocessors': [
+                {
+                    'key': 'FFmpegMetadata',
+                    'add_metadata': True,
+                },
+                {
+                    'key': 'FFmpegThumbnailsConvertor',
+                    'format': 'jpg',
+                },
+                {
+                    # 使用 FFmpegVideoRemuxer 而不是 FFmpegVideoConvertor
+                    'key': 'FFmpegVideoRemuxer',
+                    'preferedformat': 'mp4',
+                }
+            ],
+            'merge_output_format': 'mp4',
+            'logger': ChineseLogger(logger),
+            'progress_hooks': [progress_handler.progress_hook],
+            'postprocessor_hooks': [progress_handler.progress_hook],
+            # 增加更多重试选项，处理瞬时连接问题
+            'retries': 10,
+            'fragment_retries': 10,
+            'skip_unavailable_fragments': True,
+            'ignoreerrors': False,
+            # 添加对DASH和HLS格式的支持
+            'youtube_include_dash_manifest': True,
+            'youtube_include_hls_manifest': True,
+        }
+    
         logger.info(f"开始下载视频: {video_title} - {resolution}")
-        await status_message.edit_text(f"🔍 开始下载: {video_title}")
+        if handle is not None:
+            handle.check()
+        await status_message.edit_text(f"🔍 开始下载: {video_title}", reply_markup=task_keyboard(job_id))
+        
+        update_job_state(job_id, 'downloading', title=video_title, output_path=video_folder)
         
         # 在新线程池中运行下载任务
+        progress_handler.current_title = video_title
         loop = asyncio.get_event_loop()
-        await loop.run_in_executor(thread_pool, download_video, ydl_opts, url)
+        start_time = time.monotonic()
+        try:
+            deferred = await loop.run_in_executor(thread_pool, download_video, ydl_opts, url, info, handle)
+        finally:
+            # 下载结束后不再发送进度，避免覆盖最终状态
+            await progress_publisher.close(status_message)
+        metrics.observe('ytbot_download_seconds', time.monotonic() - start_time)
         
-        # 查找实际下载的视频文件
-        video_files = [f for f in os.listdir(video_folder) if f.endswith(('.mp4', '.webm', '.mkv'))]
+        # 网络下载已经结束，释放下载槽位，合并和后期处理在进程池中进行
+        if handle is not None:
+            handle.release_slot()
+        update_job_state(job_id, 'postprocessing')
+        container = None
+        if deferred is not None:
+            postprocessors, container = plan_postprocessing(ydl_opts['postprocessors'], deferred)
+            logger.info(f"封装格式: {container}，后期处理: "
+                        f"{', '.join(deferred['fixups'] + [pp['key'] for pp in postprocessors]) or '无'}")
+            # 后期处理无法中途停止，不再显示任务控制按钮
+            await status_message.edit_text(f"🛠 正在后期处理: {video_title}")
+            start_time = time.time()
+            await postprocess_service.run(postprocessors, deferred)
+            metrics.observe('ytbot_postprocess_seconds', time.time() - start_time)
+            logger.info(f"后期处理完成: {video_title} ({time.time() - start_time:.1f}秒)")
+        
+        # 查找本次下载的视频文件（文件夹中可能还有其他分辨率的版本）
+        video_files = [f for f in os.listdir(video_folder)
+                       if f.startswith(output_filename) and f.endswith(VIDEO_EXTENSIONS)
+                       and not STREAM_FILE_PATTERN.search(f)]
         if not video_files:
             raise Exception("未找到下载的视频文件")
         
         # 获取最新下载的视频文件（按修改时间排序）
         video_files.sort(key=lambda x: os.path.getmtime(os.path.join(video_folder, x)), reverse=True)
         video_path = os.path.join(video_folder, video_files[0])
-        video_filename = os.path.splitext(video_files[0])[0]  # 获取视频文件名（不含扩展名）
         
         # 等待文件写入完成
         await asyncio.sleep(2)
@@ -979,6 +4342,31 @@ async def start_download(message, url, format_id, video_title):
         # 获取视频信息
         video_size = os.path.getsize(video_path)
         logger.info(f"视频文件大小: {format_size(video_size)}")
+        folder_name = os.path.basename(video_folder)
+            
+        # 重命名下载的缩略图为poster.jpg
+        thumb_files = [f for f in os.listdir(video_folder) if f.endswith('.jpg') and f != "poster.jpg"]
+        if thumb_files:
+            old_thumb_path = os.path.join(video_folder, thumb_files[0])
+            new_thumb_path = os.path.join(video_folder, "poster.jpg")
+            os.rename(old_thumb_path, new_thumb_path)
+        
+        # 将下载的视频文件更名为文件夹名称
+        _, ext = os.path.splitext(video_path)
+        new_video_path = os.path.join(video_folder, f"{folder_name}{ext}")
+        if os.path.exists(new_video_path):
+            # 已有其他分辨率的版本，按 Emby/Plex 多版本命名规则保存
+            new_video_path = os.path.join(video_folder, f"{folder_name} - {resolution}{ext}")
+        os.rename(video_path, new_video_path)
+        video_path = new_video_path
+        
+        # 读取媒体流信息（结果缓存在媒体库索引中），失败时不影响下载结果
+        try:
+            media = await media_probe.probe(video_path)
+        except Exception as e:
+            logger.error(f"读取视频流信息失败: {str(e)}")
+            media = None
+        duration = (media or {}).get('duration') or info.get('duration') or 0
         
         # 生成NFO文件 - 使用视频标题作为文件名
         nfo_content = f"""<?xml version="1.0" encoding="UTF-8" standalone="yes" ?>
@@ -988,7 +4376,7 @@ async def start_download(message, url, format_id, video_title):
     <sorttitle>{info['title']}</sorttitle>
     <year>{info.get('upload_date', '')[:4]}</year>
     <plot>{info.get('description', '')}</plot>
-    <runtime>{int(info.get('duration', 0) / 60)}</runtime>
+    <runtime>{int(duration / 60)}</runtime>
     <thumb>{info.get('thumbnail', '')}</thumb>
     <genre>YouTube</genre>
     <studio>YouTube</studio>
@@ -996,36 +4384,26 @@ async def start_download(message, url, format_id, video_title):
     <premiered>{info.get('upload_date', '')}</premiered>
     <source>YouTube</source>
     <uniqueid type="YouTube" default="true">{info['id']}</uniqueid>
-    <trailer>{url}</trailer>
+    <trailer>{url}</trailer>{nfo_stream_details(media)}
 </movie>"""
         
         # 保存NFO文件，使用文件夹名称作为文件名
-        folder_name = os.path.basename(video_folder)
         nfo_path = os.path.join(video_folder, f"{folder_name}.nfo")
         with open(nfo_path, 'w', encoding='utf-8') as f:
             f.write(nfo_content)
-            
-        # 重命名下载的缩略图为poster.jpg
-        thumb_files = [f for f in os.listdir(video_folder) if f.endswith('.jpg') and f != "poster.jpg"]
-        if thumb_files:
-            old_thumb_path = os.path.join(video_folder, thumb_files[0])
-            new_thumb_path = os.path.join(video_folder, "poster.jpg")
-            os.rename(old_thumb_path, new_thumb_path)
         
-        # 查找实际下载的视频文件并更名为文件夹名称
-        video_files = [f for f in os.listdir(video_folder) if f.endswith(('.mp4', '.webm', '.mkv'))]
-        if video_files:
-            # 获取当前视频文件的扩展名
-            current_video_path = os.path.join(video_folder, video_files[0])
-            _, ext = os.path.splitext(current_video_path)
-            
-            # 创建与文件夹同名的视频文件名
-            new_video_filename = f"{folder_name}{ext}"
-            new_video_path = os.path.join(video_folder, new_video_filename)
-            
-            # 重命名视频文件
-            os.rename(current_video_path, new_video_path)
-            video_path = new_video_path
+        # 记录到媒体库索引
+        try:
+            library_index.add_video(
+                video_path,
+                video_id=info.get('id'),
+                title=video_title,
+                channel=info.get('channel') or info.get('uploader'),
+                resolution=resolution,
+                user_id=user_id
+            )
+        except Exception as e:
+            logger.error(f"更新媒体库索引失败: {str(e)}")
         
         # 检查字幕文件
         subtitle_files = [f for f in os.listdir(video_folder) if f.endswith(('.srt', '.vtt'))]
@@ -1036,6 +4414,8 @@ async def start_download(message, url, format_id, video_title):
         logger.info(f"✅ 下载完成: {video_title}")
         logger.info(f"📊 分辨率: {resolution} - {format_size(video_size)}")
         logger.info(f"📁 保存路径: {video_folder}")
+        if container:
+            logger.info(f"📦 封装格式: {container}")
         logger.info(f"📝 元数据文件: {'已生成' if os.path.exists(nfo_path) else '未生成'}")
         logger.info(f"🖼 封面图片: {'已下载' if os.path.exists(os.path.join(video_folder, 'poster.jpg')) else '未下载'}")
         logger.info("=" * 50)
@@ -1046,31 +4426,79 @@ async def start_download(message, url, format_id, video_title):
             f"📹 {video_title}\n"
             f"📊 分辨率: {resolution}\n"
             f"💾 大小: {format_size(video_size)}\n"
+            + (f"📦 封装: {container}\n" if container else "") +
             f"📝 元数据: {'✅' if os.path.exists(nfo_path) else '❌'}\n"
             f"🖼 封面图: {'✅' if os.path.exists(os.path.join(video_folder, 'poster.jpg')) else '❌'}"
         )
             
-        # 在视频下载完成后添加检查
-        has_video, has_audio = check_video_audio(video_path)
-        if not has_audio:
+        # 在视频下载完成后添加检查（读取失败时无法判断，不发出警告）
+        if media is not None and not media['audio']:
             logger.warning(f"警告：视频 {video_path} 没有音频流！")
+        update_job_state(job_id, 'done', output_path=video_path, downloaded_bytes=video_size)
+        
+    except TaskPaused:
+        if handle is not None and handle.requeue_requested:
+            # 为其他用户的交互任务让出槽位，回到队列后从断点继续
+            logger.info(f"任务已让出下载槽位: {video_title}")
+            update_job_state(job_id, 'queued')
+            await status_message.edit_text(
+                f"⏳ 已让出下载槽位: {video_title}\n"
+                f"已下载的部分会保留，稍后自动从断点继续",
+                reply_markup=task_keyboard(job_id)
+            )
+            download_scheduler.notify()
+            return
+        logger.info(f"任务已暂停: {video_title}")
+        update_job_state(job_id, 'paused')
+        await status_message.edit_text(
+            f"⏸ 已暂停: {video_title}\n"
+            f"已下载的部分会保留，继续后从断点处下载",
+            reply_markup=task_keyboard(job_id, paused=True)
+        )
+    
+    except TaskCancelled:
+        logger.info(f"任务已取消: {video_title}")
+        update_job_state(job_id, 'cancelled')
+        remove_partial_files(video_folder, output_filename)
+        await status_message.edit_text(f"⏹ 已取消: {video_title}")
+    
+    except asyncio.CancelledError:
+        # 在获取信息阶段取消任务时会直接取消协程
+        if handle is None or not handle.cancel_requested:
+            raise
+        logger.info(f"任务已取消: {video_title}")
+        update_job_state(job_id, 'cancelled')
+        await status_message.edit_text(f"⏹ 已取消: {video_title}")
         
     except Exception as e:
         logger.error(f"下载失败: {str(e)}")
+        update_job_state(job_id, 'failed', error=str(e))
         await status_message.edit_text(f"❌ 下载失败: {str(e)}")
 
-def check_video_audio(video_path):
-    """检查视频是否包含音频流"""
-    cmd = ['ffprobe', '-v', 'quiet', '-print_format', 'json', '-show_streams', video_path]
-    try:
-        output = subprocess.check_output(cmd)
-        streams = json.loads(output)['streams']
-        has_video = any(s['codec_type'] == 'video' for s in streams)
-        has_audio = any(s['codec_type'] == 'audio' for s in streams)
-        return has_video, has_audio
-    except Exception as e:
-        logger.error(f"检查视频音频流失败: {str(e)}")
-        return True, False
+def nfo_stream_details(media):
+    """根据媒体流信息生成NFO中的 fileinfo 部分（Kodi/Emby/Plex 通用格式）"""
+    if not media:
+        return ""
+    details = []
+    for video in media['video']:
+        details.append(
+            "            <video>\n"
+            f"                <codec>{video['codec'] or ''}</codec>\n"
+            f"                <width>{video['width'] or ''}</width>\n"
+            f"                <height>{video['height'] or ''}</height>\n"
+            f"                <durationinseconds>{int(media['duration'] or 0)}</durationinseconds>\n"
+            + (f"                <hdrtype>{video['hdr']}</hdrtype>\n" if video['hdr'] else "") +
+            "            </video>"
+        )
+    for audio in media['audio']:
+        details.append(
+            "            <audio>\n"
+            f"                <codec>{audio['codec'] or ''}</codec>\n"
+            f"                <channels>{audio['channels'] or ''}</channels>\n"
+            + (f"                <language>{audio['language']}</language>\n" if audio['language'] else "") +
+            "            </audio>"
+        )
+    return "\n    <fileinfo>\n        <streamdetails>\n" + "\n".join(details) + "\n        </streamdetails>\n    </fileinfo>"
 
 async def toggle_quality(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """切换质量选择模式"""
@@ -1098,7 +4526,9 @@ async def set_commands(application: Application):
         ("status", "显示机器人状态"),
         ("toggle_quality", "切换质量选择模式"),
         ("queue", "显示下载队列"),
-        ("concurrent", "设置并发下载数量")  # 新增命令
+        ("concurrent", "设置并发下载数量"),  # 新增命令
+        ("bandwidth", "查看或设置带宽限制"),
+        ("profile", "采样分析性能")
     ]
     
     try:
@@ -1142,38 +4572,103 @@ def format_size(bytes):
     # 统一使用一位小数
     return f"{size:.1f} {units[unit_index]}"
 
+def describe_user_usage(user_id):
+    """用户自己的任务数和配额使用情况，管理员不受限制时返回空字符串"""
+    if is_admin(user_id):
+        return ""
+    lines = [
+        f"👤 我的任务: 下载中 {download_scheduler.running_by_user()[user_id]} 个"
+        f"{f' (上限 {fair_queue.max_concurrent})' if fair_queue.max_concurrent else ''}，"
+        f"等待中 {job_store.count_user(user_id, 'queued')} 个"
+    ]
+    if fair_queue.daily_quota:
+        lines.append(f"📅 今日已下载: {format_size(job_store.daily_usage(user_id, today_start()))} / "
+                     f"{format_size(fair_queue.daily_quota)}")
+    if fair_queue.storage_quota:
+        lines.append(f"💾 已占用空间: {format_size(library_index.user_usage(user_id))} / "
+                     f"{format_size(fair_queue.storage_quota)}")
+    return "\n".join(lines)
+
 async def queue_status(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """显示下载队列状态"""
     logger.info(f"收到 /queue 命令 from user {update.effective_user.id}")
     
-    if not await check_admin(update):
+    if not await check_access(update):
         return
         
-    if not download_queue and not is_downloading:
-        await update.message.reply_text("📭 下载队列为空")
+    user_id = update.effective_user.id
+    queued_count = job_store.count('queued')
+    usage_text = describe_user_usage(user_id)
+    
+    remote_jobs = job_store.list_active() if REMOTE_WORKERS else []
+    if not queued_count and not remote_jobs and not download_scheduler.active_count and not postprocess_service.active:
+        await update.message.reply_text("📭 下载队列为空" + (f"\n\n{usage_text}" if usage_text else ""))
         return
+    
+    state_labels = {
+        'extracting': '🔍 获取信息',
+        'downloading': '⬇️ 下载中',
+        'postprocessing': '🛠 后期处理',
+    }
         
     status_text = "📋 下载列表状态:\n\n"
+    now = time.time()
     
-    # 显示正在下载的任务
-    if is_downloading:
-        status_text += "⏳ 正在下载:\n"
-        if download_queue:
-            status_text += f"当前有 {min(len(download_queue), concurrent_downloads)} 个任务正在下载中...\n"
-        else:
-            status_text += "当前有 1 个任务正在下载中...\n"
+    if REMOTE_WORKERS:
+        # 下载在工作进程中进行，按工作进程显示正在运行的任务
+        status_text += f"🖥 工作进程中运行的任务 ({len(remote_jobs)} 个):\n"
+        for job in remote_jobs:
+            elapsed = int(now - job['updated_at'])
+            status_text += (
+                f"- {state_labels.get(job['state'], job['state'])} {job['title'] or job['url']} "
+                f"({elapsed // 60}:{elapsed % 60:02d}) @ {job['worker_id']}\n"
+            )
+    else:
+        # 显示每个下载槽位的状态
+        status_text += f"⏳ 下载槽位 ({download_scheduler.active_count}/{download_scheduler.size}, "
+        status_text += f"连接 {connection_budget.in_use}/{connection_budget.total}):\n"
+        for slot in range(max(download_scheduler.size, max(download_scheduler.slots, default=-1) + 1)):
+            slot_info = download_scheduler.slots.get(slot)
+            job = job_store.get(slot_info['job_id']) if slot_info else None
+            if job is None:
+                status_text += f"{slot + 1}. 💤 空闲\n"
+                continue
+            elapsed = int(now - slot_info['started_at'])
+            connections = connection_budget.leases.get(job['id'])
+            status_text += (
+                f"{slot + 1}. {state_labels.get(job['state'], job['state'])} "
+                f"{job['title'] or job['url']} ({elapsed // 60}:{elapsed % 60:02d})"
+                f"{f' 🔗{connections}' if connections else ''}\n"
+            )
+    
+    # 显示已释放下载槽位、正在后期处理的任务
+    postprocessing = [job for job in map(job_store.get, list(task_handles)) if job and job['state'] == 'postprocessing']
+    if postprocessing:
+        status_text += f"\n🛠 后期处理 ({len(postprocessing)} 个, 进程池 {postprocess_service.workers} 个进程):\n"
+        for job in postprocessing:
+            status_text += f"- {job['title'] or job['url']}\n"
     
     # 显示等待中的任务
-    waiting_tasks = download_queue[concurrent_downloads:]
-    if waiting_tasks:
-        status_text += "\n⌛️ 等待下载:\n"
-        status_text += f"当前有 {len(waiting_tasks)} 个任务正在等待中...\n"
+    if queued_count:
+        status_text += f"\n⌛️ 等待下载 ({queued_count} 个):\n"
+        for position, job in enumerate(job_store.list_queued(10), 1):
+            mark = "⚡️" if job['priority'] >= JobStore.PRIORITY_INTERACTIVE else "📦"
+            status_text += f"{position}. {mark} {job['title'] or job['url']}\n"
+        if queued_count > 10:
+            status_text += f"... 还有 {queued_count - 10} 个任务\n"
     
-    await update.message.reply_text(status_text)
+    if usage_text:
+        status_text += f"\n{usage_text}"
+    
+    reply_markup = None
+    if is_admin(user_id):
+        reply_markup = InlineKeyboardMarkup([[InlineKeyboardButton("✖️ 取消所有任务", callback_data="cancel_all")]])
+    await update.message.reply_text(status_text, reply_markup=reply_markup)
     logger.info(f"成功响应 /queue 命令 to user {update.effective_user.id}")
 
 def get_recommended_concurrent_downloads():
     """根据服务器配置推荐并发下载数"""
+    import psutil
     try:
         # 获取CPU核心数
         cpu_count = psutil.cpu_count()
@@ -1213,17 +4708,22 @@ async def set_concurrent_downloads(update: Update, context: ContextTypes.DEFAULT
                     InlineKeyboardButton("4", callback_data="setdl_4"),
                     InlineKeyboardButton("5", callback_data="setdl_5"),
                     InlineKeyboardButton("6", callback_data="setdl_6"),
+                ],
+                [
+                    InlineKeyboardButton("🤖 自动调整", callback_data="setdl_auto"),
                 ]
             ]
             reply_markup = InlineKeyboardMarkup(buttons)
             
             # 获取服务器信息
+            import psutil
             cpu_count = psutil.cpu_count()
             memory_gb = psutil.virtual_memory().available / (1024 * 1024 * 1024)
             
             await update.message.reply_text(
                 f"🔧 并发下载设置\n\n"
-                f"当前同时下载数: {concurrent_downloads}\n"
+                f"当前同时下载数: {download_scheduler.size}"
+                f"{' (自动调整中)' if concurrency_controller.auto else ''}\n"
                 f"推荐下载数: {recommended}\n\n"
                 f"服务器配置:\n"
                 f"CPU核心数: {cpu_count}\n"
@@ -1237,115 +4737,499 @@ async def set_concurrent_downloads(update: Update, context: ContextTypes.DEFAULT
         logger.error(f"设置并发下载数量失败: {str(e)}")
         await update.message.reply_text(f"❌ 设置失败: {str(e)}")
 
+async def bandwidth_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """查看或设置带宽限制
+    
+    /bandwidth 20 - 总带宽限制为 20MB/s（0 为不限制）
+    /bandwidth schedule 01:00-07:00=0,18:00-23:00=10 - 按时间段设置，off 清除时间表
+    """
+    logger.info(f"收到 /bandwidth 命令 from user {update.effective_user.id}")
+    
+    if not await check_admin(update):
+        return
+    
+    args = context.args or []
+    try:
+        if args and args[0] == 'schedule':
+            text = ''.join(args[1:])
+            bandwidth_governor.schedule = [] if text in ('', 'off') else parse_bandwidth_schedule(text)
+            logger.info(f"带宽时间表已更新为: {format_bandwidth_schedule(bandwidth_governor.schedule) or '无'}")
+        elif args:
+            limit = float(args[0])
+            if limit < 0:
+                raise ValueError("带宽不能为负数")
+            bandwidth_governor.limit = limit
+            logger.info(f"默认带宽限制已更新为: {'不限制' if not limit else f'{limit:g}MB/s'}")
+        if args:
+            bandwidth_governor.rebalance(measure=False)
+    except ValueError as e:
+        await update.message.reply_text(
+            f"❌ 设置失败: {str(e)}\n\n"
+            f"用法:\n"
+            f"/bandwidth 20 - 限制为 20MB/s（0 为不限制）\n"
+            f"/bandwidth schedule 01:00-07:00=0,18:00-23:00=10 - 按时间段限制\n"
+            f"/bandwidth schedule off - 清除时间表"
+        )
+        return
+    
+    limit = bandwidth_governor.current_limit()
+    status_text = (
+        f"🚦 带宽限制\n\n"
+        f"当前限制: {'不限制' if not limit else f'{limit:g}MB/s'}\n"
+        f"默认限制: {'不限制' if not bandwidth_governor.limit else f'{bandwidth_governor.limit:g}MB/s'}\n"
+        f"时间表: {format_bandwidth_schedule(bandwidth_governor.schedule) or '无'}\n"
+        f"Bot API 预留: {bandwidth_governor.reserve:g}MB/s\n"
+    )
+    if limit and bandwidth_governor.jobs:
+        status_text += "\n📊 各任务分配:\n"
+        for job_id, job in list(bandwidth_governor.jobs.items()):
+            record = job_store.get(job_id)
+            title = record['title'] if record else job_id
+            status_text += f"- {title}: {format_size(job['rate'])}/s (权重 {job['weight']})\n"
+    
+    await update.message.reply_text(status_text)
+    logger.info(f"成功响应 /bandwidth 命令 to user {update.effective_user.id}")
+
+class StackSampler:
+    """按需启用的采样分析器
+    
+    采样期间由独立线程定时读取 sys._current_frames()，记录事件循环线程和下载/提取线程池的调用栈；
+    不采样时没有任何钩子或额外开销。结果输出为 flamegraph.pl/speedscope 可读的折叠栈格式。
+    """
+    POOL_PREFIXES = ('download', 'extract')
+
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.running = False
+        self._stop = threading.Event()
+
+    def stop(self):
+        """提前结束正在进行的采样（机器人停止时调用）"""
+        self._stop.set()
+
+    @staticmethod
+    def _frame_label(frame):
+        code = frame.f_code
+        return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+    def _thread_label(self, thread, loop_thread_id):
+        if thread.ident == loop_thread_id:
+            return 'event-loop'
+        if thread.name.startswith(self.POOL_PREFIXES):
+            return thread.name.rsplit('_', 1)[0]  # 同一线程池的线程合并显示
+        return None
+
+    @staticmethod
+    def _pool_idle(frames):
+        """线程池的空闲线程停在 _worker 的 work_queue.get() 中"""
+        for index, frame in enumerate(frames):
+            if frame.f_code.co_name == '_worker' and frame.f_code.co_filename.endswith(os.path.join('futures', 'thread.py')):
+                return index + 1 >= len(frames) or frames[index + 1].f_code.co_name != 'run'
+        return False
+
+    def sample(self, duration, loop_thread_id):
+        """采样 duration 秒，返回 (折叠栈计数, 统计信息)；在独立线程中运行"""
+        stacks = Counter()
+        ticks = loop_busy = pool_busy = 0
+        self_ident = threading.get_ident()
+        deadline = time.monotonic() + duration
+        while time.monotonic() < deadline and not self._stop.is_set():
+            threads = {thread.ident: thread for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == self_ident or ident not in threads:
+                    continue
+                label = self._thread_label(threads[ident], loop_thread_id)
+                if label is None:
+                    continue
+                frames = []
+                while frame is not None:
+                    frames.append(frame)
+                    frame = frame.f_back
+                frames.reverse()
+                if label == 'event-loop':
+                    # 事件循环空闲时停在 selector.select() 中，仍然计入以便看出繁忙比例
+                    if frames[-1].f_code.co_name != 'select':
+                        loop_busy += 1
+                elif self._pool_idle(frames):
+                    continue
+                else:
+                    pool_busy += 1
+                stacks[';'.join([label] + [self._frame_label(f) for f in frames])] += 1
+            ticks += 1
+            self._stop.wait(self.interval)
+        return stacks, {'duration': duration, 'ticks': ticks, 'loop_busy': loop_busy, 'pool_busy': pool_busy}
+
+    def profile(self, duration):
+        """在默认线程池中开始采样（不占用下载线程），返回可等待的 Future
+        
+        在事件循环中调用；running 在返回前就已设置，之后的请求可以立即看到
+        """
+        if self.running:
+            raise RuntimeError("已有分析正在进行")
+        self.running = True
+        self._stop.clear()
+        future = asyncio.get_running_loop().run_in_executor(None, self.sample, duration, threading.get_ident())
+        future.add_done_callback(lambda _: setattr(self, 'running', False))
+        return future
+
+    @staticmethod
+    def collapsed(stacks):
+        return ''.join(f"{stack} {count}\n" for stack, count in stacks.most_common())
+
+    @staticmethod
+    def report(stacks, stats, top=30):
+        """生成按自身耗时和累计耗时排序的前 top 个函数"""
+        self_counts = Counter()
+        total_counts = Counter()
+        for stack, count in stacks.items():
+            frames = stack.split(';')[1:]
+            self_counts[frames[-1]] += count
+            for frame in set(frames):
+                total_counts[frame] += count
+        samples = sum(stacks.values()) or 1
+        ticks = stats['ticks'] or 1
+
+        lines = [
+            f"采样时长: {stats['duration']}s, 采样次数: {stats['ticks']}, 样本数: {sum(stacks.values())}",
+            f"事件循环繁忙: {stats['loop_busy'] / ticks:.1%}",
+            f"线程池平均繁忙线程数: {stats['pool_busy'] / ticks:.2f}",
+            "",
+            f"按自身耗时排序 (前{top}):",
+            f"{'样本':>8} {'占比':>7}  函数",
+        ]
+        lines += [f"{count:>8} {count / samples:>7.1%}  {frame}" for frame, count in self_counts.most_common(top)]
+        lines += ["", f"按累计耗时排序 (前{top}):", f"{'样本':>8} {'占比':>7}  函数"]
+        lines += [f"{count:>8} {count / samples:>7.1%}  {frame}" for frame, count in total_counts.most_common(top)]
+        return '\n'.join(lines) + '\n'
+
+stack_sampler = StackSampler()
+
+def parse_duration(text):
+    """解析 30s、2m、45 这样的时长，返回秒数"""
+    match = re.fullmatch(r'(\d+(?:\.\d+)?)\s*([sm]?)', text.strip().lower())
+    if not match:
+        raise ValueError(f"无法识别的时长: {text}")
+    seconds = float(match.group(1)) * (60 if match.group(2) == 'm' else 1)
+    if not 0 < seconds <= 300:
+        raise ValueError("时长需要在 0 到 300 秒之间")
+    return seconds
+
+async def profile_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """采样分析事件循环和下载线程池
+    
+    /profile 30s - 采样30秒，返回折叠栈文件（可用 flamegraph.pl 或 speedscope 打开）和耗时排行
+    """
+    logger.info(f"收到 /profile 命令 from user {update.effective_user.id}")
+    
+    if not await check_admin(update):
+        return
+    
+    try:
+        duration = parse_duration(context.args[0]) if context.args else 30
+    except ValueError as e:
+        await update.message.reply_text(f"❌ {str(e)}\n\n用法: /profile 30s（最长5分钟）")
+        return
+    if stack_sampler.running:
+        await update.message.reply_text("⏳ 已有分析正在进行，请稍后再试")
+        return
+    
+    sampling = stack_sampler.profile(duration)
+    status_message = await update.message.reply_text(f"🔬 正在采样 {duration:g} 秒...")
+    # 采样期间照常处理其他更新，采样结果也能反映处理更新时的卡顿
+    context.application.create_task(send_profile(update, status_message, sampling), update=update)
+
+async def send_profile(update: Update, status_message, sampling):
+    """等待采样完成，发送折叠栈和耗时排行"""
+    stacks, stats = await sampling
+    logger.info(f"采样分析完成: {stats['ticks']} 次采样, {sum(stacks.values())} 个样本")
+    
+    stamp = datetime.datetime.now().strftime('%Y%m%d-%H%M%S')
+    report = StackSampler.report(stacks, stats)
+    await update.message.reply_document(
+        document=StackSampler.collapsed(stacks).encode('utf-8'),
+        filename=f"profile-{stamp}.folded",
+        caption="🔥 折叠栈，可用 flamegraph.pl 或 https://www.speedscope.app 查看"
+    )
+    await update.message.reply_document(
+        document=report.encode('utf-8'),
+        filename=f"profile-{stamp}.txt",
+        caption=f"📊 事件循环繁忙 {stats['loop_busy'] / (stats['ticks'] or 1):.1%}"
+    )
+    await status_message.delete()
+    logger.info(f"成功响应 /profile 命令 to user {update.effective_user.id}")
+
+class StartupTimer:
+    """记录启动各阶段的耗时，以及从进程启动到开始接收更新、收到第一条更新的时间"""
+    def __init__(self, started_at):
+        self.started_at = started_at
+        self.phases = []  # [(阶段, 耗时)]
+        self.ready_at = None
+        self.first_update_at = None
+        metrics.gauge('ytbot_startup_seconds', '启动各阶段的耗时',
+                      lambda: [({'phase': name}, seconds) for name, seconds in self.phases])
+        metrics.gauge('ytbot_time_to_ready_seconds', '从进程启动到开始接收更新的时间',
+                      lambda: [({}, self.ready_at - self.started_at)] if self.ready_at else [])
+        metrics.gauge('ytbot_time_to_first_update_seconds', '从进程启动到收到第一条更新的时间',
+                      lambda: [({}, self.first_update_at - self.started_at)] if self.first_update_at else [])
+
+    def add(self, name, seconds):
+        self.phases.append((name, seconds))
+
+    async def measure(self, name, awaitable):
+        start_time = time.monotonic()
+        try:
+            return await awaitable
+        finally:
+            self.add(name, time.monotonic() - start_time)
+
+    def ready(self):
+        self.ready_at = time.monotonic()
+        logger.info(f"🚀 启动完成，耗时 {self.ready_at - self.started_at:.2f} 秒")
+
+    def report(self):
+        lines = [f"  {name}: {seconds:.3f}s" for name, seconds in self.phases]
+        if self.ready_at:
+            lines.append(f"  开始接收更新: 启动后 {self.ready_at - self.started_at:.3f}s")
+        if self.first_update_at:
+            lines.append(f"  收到第一条更新: 启动后 {self.first_update_at - self.started_at:.3f}s")
+        return "\n".join(lines)
+
+    async def on_update(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        if self.first_update_at is None:
+            self.first_update_at = time.monotonic()
+            logger.info(f"📨 收到第一条更新，启动耗时报告:\n{self.report()}")
+
+startup_timer = StartupTimer(PROCESS_START)
+
+def collect_system_info():
+    """收集启动通知中的系统信息，包含阻塞调用，在线程中运行"""
+    import platform
+    import psutil
+    hostname = socket.gethostname()
+    try:
+        ip_address = socket.gethostbyname(hostname)
+    except OSError:
+        ip_address = "无法获取"
+    return {
+        'system': platform.platform(),
+        'memory': f"{psutil.virtual_memory().percent}% 使用",
+        'cpu': f"{psutil.cpu_percent(interval=0.5)}% 使用",
+        'disk': f"{psutil.disk_usage('/').percent}% 使用",
+        'hostname': hostname,
+        'ip': ip_address,
+    }
+
+async def notify_admin_startup(application: Application):
+    """向管理员发送启动通知"""
+    try:
+        info = await asyncio.to_thread(collect_system_info)
+        if REMOTE_WORKERS:
+            concurrency_text = "🖥 下载方式: 工作进程"
+        else:
+            concurrency_text = f"🔄 并发下载数: {download_scheduler.size}{' (自动)' if concurrency_controller.auto else ''}"
+        startup_message = (
+            f"🤖 YouTube下载机器人已启动\n\n"
+            f"🖥 系统信息:\n"
+            f"系统: {info['system']}\n"
+            f"内存: {info['memory']}\n"
+            f"CPU: {info['cpu']}\n"
+            f"磁盘: {info['disk']}\n"
+            f"主机名: {info['hostname']}\n"
+            f"IP: {info['ip']}\n\n"
+            f"📁 下载路径: {DOWNLOAD_PATH}\n"
+            f"{concurrency_text}\n"
+            f"🌐 代理状态: {f'已启用 ({len(download_proxy_pool.proxies)} 个)' if download_proxy_pool.proxies else '未启用'}\n"
+            f"⏱ 启动耗时: {startup_timer.ready_at - startup_timer.started_at:.2f} 秒\n\n"
+            f"⚡️ 机器人正常运行中，可以发送YouTube链接开始下载!"
+        )
+        await application.bot.send_message(chat_id=ADMIN_USER_ID, text=startup_message)
+        logger.info(f"✅ 已向管理员 (ID: {ADMIN_USER_ID}) 发送启动通知")
+    except Exception as e:
+        logger.error(f"❌ 发送启动通知失败: {str(e)}")
+
+def warm_up_ytdlp():
+    """提前加载提取器列表，避免第一个链接承担这部分耗时"""
+    yt_dlp.extractor.import_extractors()
+    yt_dlp.YoutubeDL({'quiet': True, 'logger': ChineseLogger(logger)}).close()
+
+async def retry_network(name, func, stop_event):
+    """网络错误时原地重试，等待时间从1秒逐渐增加到30秒；收到停止信号时返回 False"""
+    delay = 1
+    start_time = time.monotonic()
+    while not stop_event.is_set():
+        try:
+            await func()
+            startup_timer.add(name, time.monotonic() - start_time)  # 包括重试等待的时间
+            return True
+        except (NetworkError, TimedOut) as e:
+            logger.warning(f"{name} 失败，{delay} 秒后重试: {str(e)}")
+            try:
+                await asyncio.wait_for(stop_event.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+            delay = min(delay * 2, 30)
+    return False
+
+async def run_bot(application: Application):
+    """启动机器人并运行到收到 SIGINT/SIGTERM
+    
+    默认使用长轮询；设置 WEBHOOK_URL 时改用内置的 webhook 服务。连接失败时原地重试，
+    不重建 Application；运行中的网络错误由 Updater 自行重连。
+    """
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop_event.set)
+        except NotImplementedError:
+            pass
+    
+    webhook = None
+    background = []
+    try:
+        if not await retry_network('连接 Telegram', application.initialize, stop_event):
+            return
+        logger.info("✅ Telegram Bot API 连接成功")
+        await startup_timer.measure('启动后台服务', application.post_init(application))
+        
+        # 不丢弃待处理的更新，重启期间发送的链接在启动后继续处理
+        if WEBHOOK_URL:
+            secret = WEBHOOK_SECRET or secrets.token_urlsafe(32)
+            webhook = WebhookServer(application, urlparse(WEBHOOK_URL).path or '/', secret, WEBHOOK_QUEUE_SIZE)
+            await webhook.start(WEBHOOK_LISTEN, WEBHOOK_PORT)
+            if not await retry_network('设置 webhook', lambda: application.bot.set_webhook(
+                url=WEBHOOK_URL,
+                secret_token=secret,
+                allowed_updates=Update.ALL_TYPES,
+                drop_pending_updates=False
+            ), stop_event):
+                return
+            logger.info(f"✅ 已设置 webhook: {WEBHOOK_URL}")
+        else:
+            await startup_timer.measure('开始轮询', application.updater.start_polling(
+                poll_interval=1.0,           # 降低轮询间隔
+                allowed_updates=Update.ALL_TYPES,
+                drop_pending_updates=False,
+                bootstrap_retries=-1         # 删除 webhook 失败时原地重试
+            ))
+        await application.start()
+        startup_timer.ready()
+        
+        # 命令菜单、启动通知和 yt-dlp 预热互不依赖，在开始接收更新后并行进行
+        background.append(asyncio.create_task(startup_timer.measure('设置命令菜单', set_commands(application))))
+        if ADMIN_USER_ID:
+            background.append(asyncio.create_task(
+                startup_timer.measure('发送启动通知', notify_admin_startup(application))))
+        background.append(asyncio.create_task(
+            startup_timer.measure('预加载 yt-dlp', asyncio.to_thread(warm_up_ytdlp))))
+        
+        await stop_event.wait()
+        logger.info("收到停止信号，正在退出...")
+    finally:
+        for task in background + list(ingest_tasks):
+            task.cancel()
+        stack_sampler.stop()
+        # webhook 模式不删除 webhook：停止期间的更新保留在 Telegram，下次启动后重新推送
+        if webhook:
+            await webhook.stop()
+        if application.updater and application.updater.running:
+            await application.updater.stop()
+        if application.running:
+            await application.stop()
+        await application.shutdown()
+
+async def run_worker():
+    """下载工作进程：从共享的任务数据库领取任务并下载，不连接 Telegram
+    
+    状态消息写入数据库，由机器人进程转发。收到 SIGINT/SIGTERM 时正在下载的任务重新排队，
+    由其他工作进程从已下载的位置继续（需要共享下载目录）。
+    """
+    global telegram_bot
+    telegram_bot = RelayBot(job_store)
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop_event.set)
+        except NotImplementedError:
+            pass
+    
+    download_scheduler.worker_id = WORKER_ID or f"{socket.gethostname()}-{os.getpid()}"
+    library_index.shared = True
+    if WORKER_CONCURRENT_DOWNLOADS > 0:
+        download_scheduler.resize(WORKER_CONCURRENT_DOWNLOADS)
+    progress_publisher.start()
+    postprocess_service.start()
+    await recover_partial_downloads()
+    download_scheduler.start()
+    concurrency_controller.start()
+    asyncio.create_task(bandwidth_governor.run())
+    if download_proxy_pool.proxies:
+        asyncio.create_task(download_proxy_pool.run())
+    if METRICS_PORT:
+        try:
+            await serve_metrics(METRICS_HOST, METRICS_PORT)
+        except OSError as e:
+            logger.error(f"指标接口启动失败: {str(e)}")
+    logger.info(f"🛠 下载工作进程 {download_scheduler.worker_id} 已启动，任务数据库: {JOB_DB_PATH}")
+    
+    await stop_event.wait()
+    logger.info("收到停止信号，正在让正在下载的任务重新排队...")
+    await download_scheduler.drain()
+    job_store.flush()
+
 def main():
     """主函数"""
+    startup_timer.add('导入模块', time.monotonic() - PROCESS_START)
     logger.info("🤖 YouTube下载机器人正在启动...")
     
     # 创建下载目录
     os.makedirs(DOWNLOAD_PATH, exist_ok=True)
     logger.info(f"📁 下载目录: {DOWNLOAD_PATH}")
     
-    while True:
-        try:
-            # 创建基础请求配置
-            base_request_config = {
-                'connection_pool_size': 8,
-                'connect_timeout': 60.0,
-                'read_timeout': 60.0,
-                'write_timeout': 60.0,
-                'pool_timeout': 3.0
-            }
-            
-            # 使用统一的请求配置
-            application = (
-                Application.builder()
-                .token(BOT_TOKEN)
-                .request(HTTPXRequest(**base_request_config))
-                .get_updates_request(ExtHTTPRequest(**base_request_config))  # 只使用 get_updates_request
-                .build()
-            )
-            
-            logger.info("✅ Telegram Bot API 连接成功")
-
-            # 添加处理程序
-            application.add_handler(CommandHandler("start", start))
-            application.add_handler(CommandHandler("help", help_command))
-            application.add_handler(CommandHandler("status", status_command))
-            application.add_handler(CommandHandler("toggle_quality", toggle_quality))
-            application.add_handler(CommandHandler("queue", queue_status))
-            application.add_handler(CommandHandler("concurrent", set_concurrent_downloads))
-            application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, download_and_send_video))
-            application.add_handler(CallbackQueryHandler(callback_handler))
-            
-            # 添加错误处理器
-            application.add_error_handler(error_handler)
-            
-            logger.info("✅ 命令处理程序注册完成")
+    if '--worker' in sys.argv[1:]:
+        asyncio.run(run_worker())
+        return
+    
+    # 创建基础请求配置
+    base_request_config = {
+        'connection_pool_size': 8,
+        'connect_timeout': 60.0,
+        'read_timeout': 60.0,
+        'write_timeout': 60.0,
+        'pool_timeout': 3.0
+    }
+    
+    # 使用统一的请求配置
+    application = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        .request(TimedHTTPXRequest(**base_request_config))
+        .get_updates_request(TimedHTTPXRequest(**base_request_config))  # 只使用 get_updates_request
+        .post_init(on_startup)  # 启动后台服务并恢复未完成的下载任务
+        .build()
+    )
 
-            # 设置命令菜单
-            asyncio.get_event_loop().run_until_complete(set_commands(application))
-            
-            # 发送启动通知给管理员
-            if ADMIN_USER_ID:
-                try:
-                    # 获取系统信息
-                    import platform
-                    system_info = platform.platform()
-                    memory_info = f"{psutil.virtual_memory().percent}% 使用"
-                    cpu_info = f"{psutil.cpu_percent()}% 使用"
-                    disk_info = f"{psutil.disk_usage('/').percent}% 使用"
-                    
-                    # 获取网络IP
-                    import socket
-                    hostname = socket.gethostname()
-                    try:
-                        ip_address = socket.gethostbyname(hostname)
-                    except:
-                        ip_address = "无法获取"
-                    
-                    startup_message = (
-                        f"🤖 YouTube下载机器人已启动\n\n"
-                        f"🖥 系统信息:\n"
-                        f"系统: {system_info}\n"
-                        f"内存: {memory_info}\n"
-                        f"CPU: {cpu_info}\n"
-                        f"磁盘: {disk_info}\n"
-                        f"主机名: {hostname}\n"
-                        f"IP: {ip_address}\n\n"
-                        f"📁 下载路径: {DOWNLOAD_PATH}\n"
-                        f"🔄 并发下载数: {concurrent_downloads}\n"
-                        f"🌐 代理状态: {'已启用' if HTTP_PROXY else '未启用'}\n\n"
-                        f"⚡️ 机器人正常运行中，可以发送YouTube链接开始下载!"
-                    )
-                    
-                    # 异步发送消息
-                    asyncio.get_event_loop().run_until_complete(
-                        application.bot.send_message(
-                            chat_id=ADMIN_USER_ID, 
-                            text=startup_message,
-                            parse_mode=None  # 移除Markdown格式
-                        )
-                    )
-                    logger.info(f"✅ 已向管理员 (ID: {ADMIN_USER_ID}) 发送启动通知")
-                except Exception as e:
-                    logger.error(f"❌ 发送启动通知失败: {str(e)}")
-            
-            # 启动机器人
-            application.run_polling(
-                allowed_updates=Update.ALL_TYPES,
-                drop_pending_updates=True,  # 忽略启动时的待处理更新
-                poll_interval=1.0           # 降低轮询间隔
-            )
-            
-        except (NetworkError, TimedOut) as e:
-            logger.warning(f"网络错误，将在 10 秒后重试: {str(e)}")
-            time.sleep(10)
-            continue
-            
-        except Exception as e:
-            logger.error(f"严重错误，将在 30 秒后重试: {str(e)}")
-            time.sleep(30)
-            continue
+    # 添加处理程序
+    application.add_handler(TypeHandler(Update, startup_timer.on_update, block=False), group=-1)
+    application.add_handler(CommandHandler("start", start))
+    application.add_handler(CommandHandler("help", help_command))
+    application.add_handler(CommandHandler("status", status_command))
+    application.add_handler(CommandHandler("toggle_quality", toggle_quality))
+    application.add_handler(CommandHandler("queue", queue_status))
+    application.add_handler(CommandHandler("concurrent", set_concurrent_downloads))
+    application.add_handler(CommandHandler("bandwidth", bandwidth_command))
+    application.add_handler(CommandHandler("profile", profile_command))  # 采样在后台任务中进行
+    # 链接和按钮处理程序不阻塞更新队列：一个链接的信息提取不会让其他聊天、按钮和命令等待
+    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, download_and_send_video, block=False))
+    application.add_handler(CallbackQueryHandler(callback_handler, block=False))
+    
+    # 添加错误处理器
+    application.add_error_handler(error_handler)
+    
+    logger.info("✅ 命令处理程序注册完成")
+    
+    asyncio.run(run_bot(application))
 
 if __name__ == '__main__':
-    main() 
\ No newline at end of file
+    main()
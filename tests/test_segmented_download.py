@@ -0,0 +1,90 @@
+"""按字节范围分段下载普通 HTTP 文件的测试
+
+在本机启动一个支持 Range 请求的 HTTP 服务器，不访问外网。
+
+用法:
+    python -m unittest discover tests
+"""
+import http.server
+import os
+import sys
+import tempfile
+import threading
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'benchmarks'))
+
+from bench import load_bot
+
+SEGMENT_SIZE = 1024
+PAYLOAD = bytes(range(256)) * (SEGMENT_SIZE * 5 // 256)
+
+class RangeHandler(http.server.BaseHTTPRequestHandler):
+    """返回 PAYLOAD 中请求的字节范围，从 fail_start 开始的分段始终返回 503"""
+    fail_start = None
+
+    def do_GET(self):
+        start, end = self.headers['Range'].split('=')[1].split('-')
+        start, end = int(start), int(end)
+        if start == self.fail_start:
+            self.send_error(503)
+            return
+        body = PAYLOAD[start:end + 1]
+        self.send_response(206)
+        self.send_header('Content-Range', f'bytes {start}-{end}/{len(PAYLOAD)}')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+class SegmentedHttpFDTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.workdir = tempfile.mkdtemp()
+        cls.bot = load_bot(cls.workdir)
+        cls.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), RangeHandler)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def tearDown(self):
+        RangeHandler.fail_start = None
+
+    def download(self, name):
+        url = f'http://127.0.0.1:{self.server.server_address[1]}/video.mp4'
+        fmt = {'url': url, 'protocol': 'http', 'filesize': len(PAYLOAD), 'ext': 'mp4'}
+        self.bot.SegmentedDownload('test', SEGMENT_SIZE)._split(fmt)
+        self.assertEqual(fmt['protocol'], 'http_segments')
+
+        params = {
+            'quiet': True,
+            'no_warnings': True,
+            'noprogress': True,
+            'fragment_retries': 1,
+            'skip_unavailable_fragments': True,
+            'concurrent_fragment_downloads': 2,
+        }
+        filename = os.path.join(self.workdir, name)
+        with self.bot.yt_dlp.YoutubeDL(params) as ydl:
+            self.bot.SegmentedHttpFD(ydl, params).download(filename, fmt)
+        with open(filename, 'rb') as f:
+            return f.read()
+
+    def test_download_all_segments(self):
+        self.assertEqual(self.download('complete.mp4'), PAYLOAD)
+
+    def test_missing_middle_segment_fails(self):
+        # 即使开启了 skip_unavailable_fragments，缺少任何一段都必须报错，而不是生成截断的文件
+        RangeHandler.fail_start = SEGMENT_SIZE * 2
+        with self.assertRaises(self.bot.yt_dlp.utils.DownloadError):
+            self.download('truncated.mp4')
+        self.assertFalse(os.path.exists(os.path.join(self.workdir, 'truncated.mp4')))
+
+if __name__ == '__main__':
+    unittest.main()